@@ -0,0 +1,225 @@
+"""
+An opt-in cache of the results of
+`~astropy_helpers.setup_helpers.get_package_info`, enabled with the
+``ASTROPY_HELPERS_PACKAGE_INFO_CACHE`` environment variable.
+
+Finding the packages, importing all the ``setup_package.py`` modules and
+creating the extensions can take a while for large packages, and has to be
+done for every ``setup.py`` command, including those that do not build
+anything (such as ``egg_info`` or ``--version``). With the cache, the
+packages, package directories, package data and extensions, as well as the
+build options and external libraries declared by the ``setup_package.py``
+modules and the names of the modules defining command hooks, are pickled to
+``build/package_info.pickle`` and restored by later invocations without
+importing any ``setup_package.py`` module.
+
+Results are stored under a digest of the modification times and sizes of
+``setup.py``, ``setup.cfg`` and of the ``__init__.py``, ``setup_package.py``,
+``setup_package.cfg``, Cython and C/C++ source and header files in the
+packages (so that adding or removing a package or a source file also
+invalidates the cache), of the command line, of the ``ASTROPY_*`` and compiler
+environment variables, of the Python interpreter and of the version of
+astropy-helpers.
+
+Since the sources of extensions are often found with glob patterns, possibly
+outside of the packages (e.g. in ``cextern``), the modification times and
+sizes of the sources and dependencies of the cached extensions, and of the
+directories containing them, are also stored with the results, and the
+results are only used if these are unchanged (see `get_extension_inputs`).
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+from distutils import log
+
+CACHE_FILENAME = 'package_info.pickle'
+
+ENV_VARIABLE = 'ASTROPY_HELPERS_PACKAGE_INFO_CACHE'
+
+# The number of results kept in the cache, e.g. for different commands
+MAX_CACHED_RESULTS = 8
+
+# Increased whenever the format of the cached results changes
+_CACHE_VERSION = 1
+
+# The files that can change the results, in the source directory and in each
+# package
+_ROOT_FILES = ('setup.py', 'setup.cfg')
+_PACKAGE_FILES = ('__init__.py', 'setup_package.py', 'setup_package.cfg')
+_PACKAGE_EXTENSIONS = ('.pyx', '.pxd', '.pxi', '.c', '.cc', '.cpp', '.cxx',
+                       '.h', '.hh', '.hpp', '.hxx')
+
+# The environment variables, other than the ASTROPY_* ones, which can change
+# the extensions
+_ENV_VARIABLES = ('CC', 'CXX', 'CFLAGS', 'CPPFLAGS', 'LDFLAGS')
+
+
+def is_enabled():
+    """
+    Returns whether the cache was enabled with the environment variable.
+    """
+
+    return os.environ.get(ENV_VARIABLE, '').lower() in ('1', 'true', 'yes',
+                                                        'on')
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _scan_inputs(srcdir):
+    """
+    Returns the signatures of the files in ``srcdir`` which can change the
+    results, looking in the same directories as `setuptools.find_packages`.
+    """
+
+    inputs = []
+
+    for filename in _ROOT_FILES:
+        inputs.append((filename, _stat(os.path.join(srcdir, filename))))
+
+    def scan(path, relpath, is_package):
+        try:
+            entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            name = relpath + '/' + entry.name if relpath else entry.name
+            if entry.is_dir():
+                if ('.' not in entry.name and
+                        os.path.isfile(os.path.join(entry.path,
+                                                    '__init__.py'))):
+                    scan(entry.path, name, True)
+            elif is_package and (entry.name in _PACKAGE_FILES or
+                                 entry.name.endswith(_PACKAGE_EXTENSIONS)):
+                inputs.append((name, _stat(entry.path)))
+
+    scan(srcdir, '', False)
+
+    return inputs
+
+
+def get_cache_key(srcdir, exclude_packages=()):
+    """
+    Returns the key under which the results of ``get_package_info(srcdir)``
+    are cached.
+    """
+
+    from . import __version__ as helpers_version
+
+    inputs = {
+        'version': _CACHE_VERSION,
+        'astropy_helpers': helpers_version,
+        'python': [sys.executable, sys.version],
+        'srcdir': os.path.abspath(srcdir),
+        'argv': sys.argv[1:],
+        'environ': sorted((name, value) for name, value in os.environ.items()
+                          if (name.startswith('ASTROPY_') and
+                              name != ENV_VARIABLE) or
+                          name in _ENV_VARIABLES),
+        'exclude_packages': sorted(exclude_packages),
+        'files': _scan_inputs(srcdir),
+    }
+
+    serialized = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def get_extension_inputs(extensions):
+    """
+    Returns the signatures of the sources and dependencies of
+    ``extensions``, and of the directories containing them (which change
+    when files are added to or removed from them).
+    """
+
+    paths = set()
+    for ext in extensions:
+        for path in list(ext.sources) + list(ext.depends or []):
+            paths.add(path)
+            paths.add(os.path.dirname(path) or '.')
+
+    return [(path, _stat(path)) for path in sorted(paths)]
+
+
+def extension_inputs_unchanged(inputs):
+    """
+    Returns whether the signatures returned by `get_extension_inputs` are
+    still those of the files.
+    """
+
+    return all(_stat(path) == signature for path, signature in inputs)
+
+
+class PackageInfoCache(object):
+    """
+    The results of ``get_package_info`` cached in the build directory of
+    ``srcdir``.
+    """
+
+    def __init__(self, srcdir):
+        self.srcdir = srcdir
+        self.filename = os.path.join(srcdir, 'build', CACHE_FILENAME)
+
+    def _read(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                results = pickle.load(f)
+        except Exception:
+            # A missing, truncated or incompatible cache is not an error
+            return {}
+        if not isinstance(results, dict):
+            return {}
+        return results
+
+    def store(self, key, result):
+        """
+        Store ``result`` under ``key``, removing the oldest results.
+        """
+
+        try:
+            serialized = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            log.info('the package information could not be cached: '
+                     '{0}'.format(exc))
+            return
+
+        results = self._read()
+        results.pop(key, None)
+        results[key] = serialized
+        while len(results) > MAX_CACHED_RESULTS:
+            del results[next(iter(results))]
+
+        tmp_filename = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, self.filename)
+        except OSError as exc:
+            log.warn('could not write {0}: {1}'.format(self.filename, exc))
+
+    def load(self, key):
+        """
+        Returns the result stored under ``key``, unpickled, or `None`.
+        """
+
+        serialized = self._read().get(key)
+        if serialized is None:
+            return None
+
+        try:
+            return pickle.loads(serialized)
+        except Exception:
+            # E.g. if an extension class can no longer be imported
+            return None
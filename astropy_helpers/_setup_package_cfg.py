@@ -0,0 +1,184 @@
+"""
+Declarative ``setup_package.cfg`` files, which describe the extensions and
+package data of a package without executing any Python code.
+
+A ``setup_package.cfg`` file is placed next to (or instead of) the
+``setup_package.py`` file of a package, and contains one
+``[extension:<name>]`` section per extension, and optionally a
+``[package_data]`` section::
+
+    [extension:mypackage._fast]
+    sources = src/fast.c
+              src/utils/*.c
+    include_dirs = numpy
+                   src
+    define_macros = NDEBUG
+                    HAVE_FAST=1
+    libraries = m
+    extra_compile_args = -O3
+
+    [package_data]
+    mypackage.tests = data/*.fits data/*.txt
+
+Names starting with a dot are relative to the package, e.g.
+``[extension:._fast]``, and ``.`` in ``[package_data]`` is the package
+itself. The options of an extension are those of
+`distutils.core.Extension`, with whitespace-separated values for the list
+options. ``define_macros`` are given as ``NAME`` or ``NAME=VALUE``, and
+``optional`` is a boolean. Paths (which may be glob patterns for
+``sources``, ``depends`` and ``extra_objects``) are relative to the
+directory of the package, except for the ``numpy`` include directory.
+
+The file is parsed into a `SetupPackageConfig`, which provides the same
+``get_extensions()`` and ``get_package_data()`` functions as a
+``setup_package.py`` module, so that the two are used in the same way by
+`~astropy_helpers.setup_helpers.get_package_info`.
+"""
+
+import glob
+import os
+
+from configparser import ConfigParser, Error as ConfigParserError
+
+from distutils.core import Extension
+from distutils.errors import DistutilsSetupError
+
+SETUP_PACKAGE_CFG = 'setup_package.cfg'
+
+# The options of extensions which are lists, those of them which are paths
+# (or glob patterns of paths), and the other options
+_LIST_OPTIONS = ('sources', 'include_dirs', 'define_macros', 'undef_macros',
+                 'library_dirs', 'libraries', 'runtime_library_dirs',
+                 'extra_objects', 'extra_compile_args', 'extra_link_args',
+                 'export_symbols', 'swig_opts', 'depends')
+_PATH_OPTIONS = ('include_dirs', 'library_dirs', 'runtime_library_dirs')
+_GLOB_OPTIONS = ('sources', 'depends', 'extra_objects')
+_OTHER_OPTIONS = ('language', 'optional')
+
+
+class SetupPackageConfig(object):
+    """
+    The extensions and package data declared by a ``setup_package.cfg``
+    file.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the ``setup_package.cfg`` file.
+    package : str
+        The name of the package in which the file is.
+    """
+
+    def __init__(self, filename, package):
+
+        self.__file__ = filename
+        self.__name__ = package + '.setup_package'
+        self.package = package
+
+        self._package_dir = os.path.dirname(filename)
+        self._extensions = []
+        self._package_data = {}
+
+        conf = ConfigParser(interpolation=None)
+        # Package names are case-sensitive
+        conf.optionxform = str
+
+        try:
+            with open(filename, encoding='utf-8') as f:
+                conf.read_file(f)
+        except (OSError, ConfigParserError) as exc:
+            raise DistutilsSetupError('could not read {0}: {1}'.format(
+                filename, exc))
+
+        for section in conf.sections():
+            if section.startswith('extension:'):
+                name = self._resolve(section.split(':', 1)[1].strip())
+                self._extensions.append(
+                    (name, self._parse_extension(conf, section, name)))
+            elif section == 'package_data':
+                for package, patterns in conf.items(section):
+                    self._package_data[self._resolve(package)] = (
+                        patterns.split())
+            else:
+                raise DistutilsSetupError(
+                    'unknown section [{0}] in {1}'.format(section, filename))
+
+    def __repr__(self):
+        return '<SetupPackageConfig {0!r}>'.format(self.__file__)
+
+    def _resolve(self, name):
+        if name == '.':
+            return self.package
+        elif name.startswith('.'):
+            return self.package + name
+        return name
+
+    def _path(self, path):
+        return os.path.relpath(os.path.join(self._package_dir, path))
+
+    def _parse_extension(self, conf, section, name):
+
+        kwargs = {}
+
+        for option, value in conf.items(section):
+            if option in _LIST_OPTIONS:
+                values = value.split()
+            elif option in _OTHER_OPTIONS:
+                values = value.strip()
+            else:
+                raise DistutilsSetupError(
+                    'unknown option {0!r} for the {1} extension in '
+                    '{2}'.format(option, name, self.__file__))
+
+            if option == 'define_macros':
+                values = [tuple(macro.split('=', 1)) if '=' in macro
+                          else (macro, None) for macro in values]
+            elif option == 'optional':
+                try:
+                    values = conf.getboolean(section, option)
+                except ValueError:
+                    raise DistutilsSetupError(
+                        'the optional option of the {0} extension in {1} '
+                        'should be a boolean'.format(name, self.__file__))
+            elif option in _PATH_OPTIONS:
+                values = [path if path == 'numpy' or os.path.isabs(path)
+                          else self._path(path) for path in values]
+            elif option in _GLOB_OPTIONS:
+                values = [filename for pattern in values
+                          for filename in self._glob(pattern)]
+
+            kwargs[option] = values
+
+        if not kwargs.get('sources'):
+            raise DistutilsSetupError(
+                'the {0} extension in {1} has no sources'.format(
+                    name, self.__file__))
+
+        return kwargs
+
+    def _glob(self, pattern):
+        path = self._path(pattern) if not os.path.isabs(pattern) else pattern
+        if not glob.has_magic(path):
+            return [path]
+        return sorted(glob.glob(path))
+
+    def get_extensions(self):
+        """
+        Returns new `~distutils.core.Extension` instances for the declared
+        extensions.
+        """
+
+        extensions = []
+        for name, kwargs in self._extensions:
+            kwargs = dict((option, list(value) if isinstance(value, list)
+                           else value) for option, value in kwargs.items())
+            extensions.append(Extension(name, **kwargs))
+        return extensions
+
+    def get_package_data(self):
+        """
+        Returns the declared package data.
+        """
+
+        return dict((package, list(patterns))
+                    for package, patterns in self._package_data.items())
@@ -0,0 +1,276 @@
+"""
+Aggregation of the annotations produced by Cython (as with ``cython -a``) for
+the 'cython_annotate' command.
+
+Cython gives each line of a .pyx file a score which reflects how much the C
+code generated for it interacts with the Python C API (calls to the Python C
+API weigh more than calls to Cython's own helpers, which weigh more than
+macros). The scores are read from the HTML files written by Cython, and summed
+over each function and each loop (including any nested functions and loops),
+so that the functions and loops with the most Python interaction across the
+package can be ranked in a single report. The report is written both as text
+and as JSON, without any timestamps or absolute paths, so that reports from
+two runs can be compared directly.
+"""
+
+import json
+import os
+import re
+
+from distutils import log
+from distutils.errors import DistutilsError
+
+from ._cythonize import _cythonize_one, _get_pool
+
+_SCORE_RE = re.compile(r'<pre class=["\']cython line score-(\d+)["\'][^>]*>'
+                       r'.*?<span class="">(\d+)</span>:')
+
+_CLASS_RE = re.compile(r'^(\s*)(?:cdef\s+(?:public\s+|api\s+)*)?class\s+(\w+)')
+_FUNCTION_RE = re.compile(r'^(\s*)(?:async\s+)?(?:cpdef|cdef|def)\b'
+                          r'[^=(#]*?(\w+)\s*\(')
+_LOOP_RE = re.compile(r'^(\s*)(for|while)\b')
+
+
+def annotate_sources(tasks, jobs=1):
+    """
+    Translate the .pyx files in ``tasks``, a list of ``(source, target,
+    options)`` tuples (see `~astropy_helpers.commands._cythonize`), with
+    annotations enabled, on up to ``jobs`` processes. The HTML files are
+    written next to the targets.
+    """
+
+    tasks = [(source, target, dict(options, annotate=True))
+             for source, target, options in tasks]
+
+    for source, target, options in tasks:
+        log.info('annotating {0}'.format(source))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    pool = _get_pool(jobs, len(tasks))
+
+    if pool is None:
+        results = [_cythonize_one(*task) for task in tasks]
+    else:
+        with pool:
+            futures = [pool.submit(_cythonize_one, *task) for task in tasks]
+        results = [future.result() for future in futures]
+
+    for (source, target, options), (nerrors, _, _) in zip(tasks, results):
+        if nerrors:
+            raise DistutilsError('{0} errors while compiling {1!r} with '
+                                 'Cython'.format(nerrors, source))
+
+
+def parse_annotation_html(filename):
+    """
+    Returns a dictionary mapping line numbers to the scores of the lines in
+    the HTML annotation file ``filename``.
+    """
+
+    with open(filename, encoding='utf-8') as f:
+        html = f.read()
+
+    return dict((int(lineno), int(score))
+                for score, lineno in _SCORE_RE.findall(html))
+
+
+def _logical_lines(lines):
+    """
+    Yields ``(index, text)`` for each logical line in ``lines`` (joining
+    lines until parentheses and brackets are balanced), without comments.
+    """
+
+    idx = 0
+    while idx < len(lines):
+        start = idx
+        text = lines[idx].split('#')[0]
+        depth = text.count('(') + text.count('[') - text.count(')') - \
+            text.count(']')
+        while depth > 0 and idx + 1 < len(lines):
+            idx += 1
+            extra = lines[idx].split('#')[0]
+            text += ' ' + extra.strip()
+            depth += extra.count('(') + extra.count('[') - \
+                extra.count(')') - extra.count(']')
+        yield start, text.rstrip()
+        idx += 1
+
+
+def find_blocks(lines):
+    """
+    Returns a list of ``(kind, name, first, last)`` tuples for the functions
+    (``kind`` is ``'function'``) and loops (``'loop'``) in the Cython source
+    ``lines``, where ``first`` and ``last`` are the line numbers (starting at
+    1) of the first and last line of the block. The name of a function is
+    qualified by the classes and functions it is defined in, and the name of a
+    loop is that of the function it is in, followed by its header.
+    """
+
+    blocks = []
+    # The open blocks, as (indentation, kind, name, first) tuples
+    stack = []
+
+    def close(indent, last):
+        while stack and stack[-1][0] >= indent:
+            block_indent, kind, name, first = stack.pop()
+            if kind != 'class':
+                blocks.append((kind, name, first, last))
+
+    last_code = 0
+
+    for idx, text in _logical_lines(lines):
+
+        if not text.strip():
+            continue
+
+        indent = len(text) - len(text.lstrip())
+        close(indent, last_code)
+        last_code = idx + 1
+
+        parents = [name for _, kind, name, _ in stack if kind != 'loop']
+        qualname = '.'.join(parents[-1:] + [''])
+
+        # Only definitions (ending with a colon) start blocks, not e.g.
+        # declarations of external functions
+        if not text.endswith(':'):
+            continue
+
+        match = _CLASS_RE.match(text)
+        if match:
+            stack.append((indent, 'class', qualname + match.group(2),
+                          idx + 1))
+            continue
+
+        match = _FUNCTION_RE.match(text)
+        if match:
+            stack.append((indent, 'function', qualname + match.group(2),
+                          idx + 1))
+            continue
+
+        match = _LOOP_RE.match(text)
+        if match:
+            function = parents[-1] if parents else '<module>'
+            stack.append((indent, 'loop', '{0}: {1}'.format(
+                function, ' '.join(text.split())), idx + 1))
+
+    close(0, last_code)
+
+    return sorted(blocks, key=lambda block: block[2])
+
+
+def build_report(sources):
+    """
+    Returns the report (as a dictionary which can be serialized to JSON) for
+    ``sources``, a list of ``(filename, lines, scores)`` tuples giving the
+    path of each .pyx file, its lines, and the scores of its lines.
+    """
+
+    files = {}
+    blocks = {'function': [], 'loop': []}
+
+    for filename, lines, scores in sources:
+        # Paths use forward slashes so that reports can be compared across
+        # platforms
+        name = filename.replace(os.sep, '/')
+        files[name] = sum(scores.values())
+        for kind, block, first, last in find_blocks(lines):
+            score = sum(scores.get(lineno, 0)
+                        for lineno in range(first, last + 1))
+            blocks[kind].append({'file': name, 'name': block, 'line': first,
+                                 'score': score})
+
+    def ranked(items):
+        return sorted(items, key=lambda item: (-item['score'], item['file'],
+                                               item['line']))
+
+    return {'total': sum(files.values()),
+            'files': files,
+            'functions': ranked(blocks['function']),
+            'loops': ranked(blocks['loop'])}
+
+
+def _key(item):
+    return item['file'], item['name']
+
+
+def compare_reports(report, previous):
+    """
+    Returns a list of ``(kind, item, change)`` tuples for the functions and
+    loops whose score changed between the ``previous`` report and
+    ``report``, from the largest increase to the largest decrease. ``change``
+    is `None` for items that were removed.
+    """
+
+    changes = []
+    for kind in ('functions', 'loops'):
+        old = dict((_key(item), item) for item in previous.get(kind, []))
+        new = dict((_key(item), item) for item in report[kind])
+        for key, item in new.items():
+            change = item['score'] - old.get(key, {'score': 0})['score']
+            if change or key not in old:
+                changes.append((kind[:-1], item, change))
+        for key, item in old.items():
+            if key not in new:
+                changes.append((kind[:-1], item, None))
+
+    return sorted(changes, key=lambda change: (
+        change[2] is None, -(change[2] or 0), change[1]['file'],
+        change[1]['name']))
+
+
+def format_report(report, limit=20, previous=None):
+    """
+    Returns the text version of ``report``, including the changes since the
+    ``previous`` report if given.
+    """
+
+    out = ['Cython annotation scores (higher scores mean more interaction '
+           'with the Python C API)', '',
+           'Total score: {0}'.format(report['total'])]
+
+    for kind in ('functions', 'loops'):
+        out.extend(['', 'Worst {0}:'.format(kind), '',
+                    '{0:>4}  {1:>7}  {2}'.format('rank', 'score', kind[:-1])])
+        items = [item for item in report[kind] if item['score']][:limit]
+        for rank, item in enumerate(items, 1):
+            out.append('{0:>4}  {1:>7}  {2}:{3}  {4}'.format(
+                rank, item['score'], item['file'], item['line'],
+                item['name']))
+        if not items:
+            out.append('(none)')
+
+    out.extend(['', 'Score by file:', ''])
+    for filename, score in sorted(report['files'].items(),
+                                  key=lambda item: (-item[1], item[0])):
+        out.append('{0:>7}  {1}'.format(score, filename))
+
+    if previous is not None:
+        out.extend(['', 'Changes since the previous report (total {0:+d}):'
+                    .format(report['total'] - previous.get('total', 0)), ''])
+        changes = compare_reports(report, previous)
+        for kind, item, change in changes:
+            out.append('{0:>7}  {1:<8}  {2}:{3}  {4}'.format(
+                'removed' if change is None else '{0:+d}'.format(change),
+                kind, item['file'], item['line'], item['name']))
+        if not changes:
+            out.append('(no changes)')
+
+    return '\n'.join(out) + '\n'
+
+
+def write_report(report, output, limit=20, previous=None):
+    """
+    Write ``report`` to ``output`` + ``.txt`` and ``output`` + ``.json``, and
+    return the text version.
+    """
+
+    text = format_report(report, limit=limit, previous=previous)
+
+    with open(output + '.txt', 'w') as f:
+        f.write(text)
+
+    with open(output + '.json', 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+    return text
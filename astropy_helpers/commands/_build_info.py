@@ -0,0 +1,286 @@
+"""
+Generation of the ``build_info`` module of packages with extensions, which
+records how the extensions were built: the identity, version and flags of the
+compiler, the versions of Cython and Numpy, and whether OpenMP and CPU-specific
+optimizations were used.
+
+This replaces the ``compiler_version`` extension module that was previously
+compiled for every package, so that recording this information does not cost
+an extra compile and link step in every build. The generated module is pure
+Python, and the information is only evaluated when one of its attributes is
+first accessed. A ``compiler_version`` module which imports ``compiler`` from
+``build_info`` is still generated for backward compatibility.
+"""
+
+import os
+import platform
+import pprint
+import re
+import subprocess
+import sys
+
+from importlib.machinery import EXTENSION_SUFFIXES
+
+from distutils.ccompiler import CCompiler, new_compiler
+from distutils.sysconfig import customize_compiler
+
+from ..utils import write_if_different
+from ._isa import get_isa_variants
+from ._objcache import LAUNCHERS
+from ._pgo import get_compiler_family
+
+BUILD_INFO_FILENAME = 'build_info.py'
+
+COMPILER_VERSION_FILENAME = 'compiler_version.py'
+
+_OPENMP_FLAGS = ('-fopenmp', '-openmp', '/openmp', '-qopenmp')
+
+_BUILD_INFO_SRC = '''
+# Autogenerated by the build_ext command of astropy-helpers; do not modify
+
+"""
+Information about how the compiled extensions of this package were built.
+
+The attributes listed in ``__all__`` are only evaluated when first accessed.
+"""
+
+import sys
+
+__all__ = {names}
+
+_info = None
+
+
+def _get_build_info():
+    return {info}
+
+
+def __getattr__(name):
+    global _info
+    if name not in __all__:
+        raise AttributeError('module {{0!r}} has no attribute '
+                             '{{1!r}}'.format(__name__, name))
+    if _info is None:
+        _info = _get_build_info()
+    return _info[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Module-level __getattr__ is only supported from Python 3.7
+if sys.version_info < (3, 7):
+    import types
+
+    class _BuildInfoModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+        def __dir__(self):
+            return __dir__()
+
+    sys.modules[__name__].__class__ = _BuildInfoModule
+'''[1:]
+
+_COMPILER_VERSION_SRC = '''
+# Autogenerated by the build_ext command of astropy-helpers; do not modify
+# This module is kept for backward compatibility, see build_info.py instead
+from .build_info import compiler  # noqa
+'''[1:]
+
+
+def _get_executable(compiler):
+    """
+    Returns the compiler executable of ``compiler``, skipping any compiler
+    launcher such as ccache.
+    """
+
+    executable = [arg for arg in getattr(compiler, 'compiler_so', None) or []
+                  if os.path.basename(arg).split('.')[0] not in LAUNCHERS]
+    return executable[0] if executable else None
+
+
+def get_compiler_version(compiler):
+    """
+    Returns a ``(description, version)`` tuple for the
+    `distutils.ccompiler.CCompiler` instance ``compiler``, where
+    ``description`` is e.g. ``'GCC version 9.3.0'`` (as previously reported by
+    the ``compiler_version`` extension), or ``('Unknown compiler', None)`` if
+    this could not be determined.
+    """
+
+    if compiler.compiler_type == 'msvc':
+        try:
+            proc = subprocess.Popen([getattr(compiler, 'cc', 'cl.exe')],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+        except OSError:
+            output = ''
+        match = re.search(r'Version ([\d.]+)', output)
+        if match:
+            return ('Microsoft Visual C++ version ' + match.group(1),
+                    match.group(1))
+        return 'Unknown compiler', None
+
+    executable = _get_executable(compiler)
+    if executable is None:
+        return 'Unknown compiler', None
+
+    # The predefined macros are those that the compiler_version extension
+    # used to report
+    try:
+        output = subprocess.check_output([executable, '-dM', '-E', '-'],
+                                         stdin=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'Unknown compiler', None
+
+    macros = dict(re.findall(r'^#define (\w+) (.*)$',
+                             output.decode('utf-8', 'replace'), re.MULTILINE))
+
+    if '__clang_version__' in macros:
+        version = macros['__clang_version__'].strip('"').strip()
+        return 'Clang version ' + version, version.split()[0]
+    elif '__INTEL_COMPILER' in macros:
+        version = macros['__INTEL_COMPILER']
+        return 'Intel C compiler version ' + version, version
+    elif '__GNUC__' in macros and '__VERSION__' in macros:
+        version = macros['__VERSION__'].strip('"').strip()
+        return 'GCC version ' + version, version.split()[0]
+
+    return 'Unknown compiler', None
+
+
+def _get_numpy_version():
+    """
+    Returns the version of Numpy, from the installed distribution metadata if
+    Numpy was not imported, or `None` if Numpy is not installed.
+    """
+
+    numpy = sys.modules.get('numpy')
+    if getattr(numpy, '__version__', None):
+        return numpy.__version__
+
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:  # Python < 3.8
+        return None
+
+    try:
+        return version('numpy')
+    except PackageNotFoundError:
+        return None
+
+
+def get_build_info(cmd):
+    """
+    Returns the information about the build of the extensions of the
+    build_ext command ``cmd`` that is recorded in the ``build_info`` module.
+    """
+
+    # Imported here to avoid a circular import
+    from ..cpu_helpers import _cpu_optimization
+
+    compiler = cmd.compiler
+    if not isinstance(compiler, CCompiler):
+        compiler = new_compiler(compiler=compiler, dry_run=True)
+        customize_compiler(compiler)
+    if (compiler.compiler_type == 'msvc' and
+            not getattr(compiler, 'initialized', True)):
+        try:
+            compiler.initialize()
+        except Exception:
+            pass
+
+    description, version = get_compiler_version(compiler)
+
+    extensions = {}
+    for ext in cmd.extensions:
+        extensions[ext.name] = {
+            'define_macros': [list(macro) for macro in ext.define_macros],
+            'extra_compile_args': list(ext.extra_compile_args),
+            'extra_link_args': list(ext.extra_link_args),
+            'language': ext.language or 'c',
+        }
+
+    cython_version = cmd._uses_cython
+    if not cython_version and cmd.previous_cython_version != 'unknown':
+        cython_version = cmd.previous_cython_version
+
+    # The main package directory is a path, but the extensions are matched on
+    # their dotted names
+    prefix = cmd.package_dir.replace(os.sep, '.') + '.'
+
+    return {
+        'compiler': description,
+        'compiler_type': compiler.compiler_type,
+        'compiler_family': get_compiler_family(compiler),
+        'compiler_version': version,
+        'compiler_command': list(getattr(compiler, 'compiler_so', None) or []),
+        'linker_command': list(getattr(compiler, 'linker_so', None) or []),
+        'extensions': extensions,
+        'cython_version': cython_version or None,
+        'numpy_version': _get_numpy_version(),
+        'openmp_enabled': any(flag in _OPENMP_FLAGS for ext in cmd.extensions
+                              for flag in ext.extra_compile_args),
+        'cpu_optimization': dict(
+            (name, info) for name, info in _cpu_optimization.items()
+            if info['flags'] and name.startswith(prefix)),
+        'variant': cmd.variant,
+        'debug': bool(cmd.debug),
+        'pgo': bool(cmd.pgo),
+        'lto': bool(cmd.lto),
+        'linker': cmd._linker,
+        'optimize_output': bool(cmd.optimize_output),
+        'cython_profile': bool(cmd.cython_profile),
+        'cython_directives_profile': cmd.cython_directives_profile,
+        'isa_variants': get_isa_variants(cmd.extensions),
+        'bundled_libraries': sorted(library.name for library in
+                                    getattr(cmd, '_bundled_libraries', [])),
+        'python_version': platform.python_version(),
+        'platform': cmd.plat_name,
+    }
+
+
+def remove_compiler_extension(package_dir):
+    """
+    Remove the ``compiler_version`` extension module (and its source) built by
+    earlier versions of astropy-helpers from ``package_dir``, since it would
+    take precedence over the generated ``compiler_version.py``.
+    """
+
+    filenames = [os.path.join(package_dir, '_compiler.c')]
+    filenames.extend(os.path.join(package_dir, 'compiler_version' + suffix)
+                     for suffix in EXTENSION_SUFFIXES)
+
+    for filename in filenames:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def generate_build_info_py(cmd, package_dir):
+    """
+    Write the ``build_info.py`` and ``compiler_version.py`` modules for the
+    build_ext command ``cmd`` to ``package_dir``, and return their paths.
+    Files are only written if their content changed.
+    """
+
+    info = get_build_info(cmd)
+
+    src = _BUILD_INFO_SRC.format(
+        names=pprint.pformat(sorted(info), width=69,
+                             compact=True).replace('\n', '\n' + ' ' * 10),
+        info=pprint.pformat(info).replace('\n', '\n' + ' ' * 11))
+
+    build_info_py = os.path.join(package_dir, BUILD_INFO_FILENAME)
+    write_if_different(build_info_py, src.encode('utf-8'))
+
+    compiler_version_py = os.path.join(package_dir, COMPILER_VERSION_FILENAME)
+    write_if_different(compiler_version_py,
+                       _COMPILER_VERSION_SRC.encode('utf-8'))
+
+    remove_compiler_extension(package_dir)
+
+    return [build_info_py, compiler_version_py]
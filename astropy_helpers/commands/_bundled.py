@@ -0,0 +1,350 @@
+"""
+Support for bundled C libraries, and for sources shared between extensions,
+in the custom 'build_ext' command.
+
+Bundled libraries are declared by the ``get_bundled_libraries()`` function of
+``setup_package.py`` files, which returns a list of ``(name, build_info)``
+tuples in the same format as the ``libraries`` argument to ``setup()``::
+
+    def get_bundled_libraries():
+        return [('cfitsio', {'sources': glob('cextern/cfitsio/lib/*.c'),
+                             'include_dirs': ['cextern/cfitsio/lib'],
+                             'macros': [('HAVE_UNISTD_H', None)]})]
+
+Each bundled library is compiled once (with the same compiler, flags and
+build variant as the extensions, so as position-independent code where
+relevant) into a static archive in the temporary build directory, which is
+then linked into each extension that lists the library in its
+``libraries``, in place of a system library of the same name. The include
+directories of the library are also added to these extensions. A library for
+which the system version was requested (see
+`~astropy_helpers.setup_helpers.use_system_library`) is not built.
+
+The archives can also be kept in a cache in the user cache directory
+(with the --library-cache option of 'build_ext'), so that they are restored
+rather than built again in other checkouts, virtual environments or projects
+bundling the same library. Archives are stored under a digest of the contents
+of the sources of the library and of the headers they include (with paths
+relative to the directory containing the sources, so that the location of the
+source tree does not matter), of the macros and flags used, and of the
+compiler.
+
+Independently, sources that are compiled by several extensions with
+identical arguments (and so into the same object file) are only compiled
+once per build.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import types
+
+from distutils import log
+from distutils.errors import DistutilsSetupError
+
+BUNDLED_DIRNAME = 'bundled'
+
+# The number of archives kept in the library cache for each library
+MAX_CACHED_ARCHIVES = 4
+
+# The keys of the build information of a bundled library, in addition to
+# those of the libraries argument to setup()
+_BUILD_INFO_KEYS = ('sources', 'include_dirs', 'macros', 'cflags',
+                    'extra_compile_args', 'depends')
+
+
+class BundledLibrary(object):
+    """
+    A C library bundled with a package, built into a static archive.
+    """
+
+    def __init__(self, name, build_info, package=None):
+
+        if not isinstance(build_info, dict) or not build_info.get('sources'):
+            raise DistutilsSetupError(
+                "the build information of the bundled library {0!r} should "
+                "be a dictionary with at least a 'sources' key".format(name))
+
+        unknown = set(build_info) - set(_BUILD_INFO_KEYS)
+        if unknown:
+            raise DistutilsSetupError(
+                'unknown keys in the build information of the bundled '
+                'library {0!r}: {1}'.format(name, ', '.join(sorted(unknown))))
+
+        self.name = name
+        self.package = package
+        self.sources = list(build_info['sources'])
+        self.include_dirs = list(build_info.get('include_dirs') or [])
+        self.define_macros = list(build_info.get('macros') or [])
+        self.extra_compile_args = (list(build_info.get('cflags') or []) +
+                                   list(build_info.get('extra_compile_args') or
+                                        []))
+        self.depends = list(build_info.get('depends') or [])
+
+        # The attributes needed to compute a digest of the inputs of the
+        # library in the same way as for extensions
+        self.undef_macros = []
+        self.extra_objects = []
+        self.extra_link_args = []
+        self.libraries = []
+        self.library_dirs = []
+        self.runtime_library_dirs = []
+        self.export_symbols = []
+        self.language = None
+
+    def __repr__(self):
+        return '<BundledLibrary {0!r}>'.format(self.name)
+
+
+def find_bundled_libraries(srcdir, packages):
+    """
+    Returns the list of `BundledLibrary` returned by the
+    ``get_bundled_libraries()`` functions of ``setup_package.py`` modules,
+    except those for which the system library should be used.
+    """
+
+    # Imported here to avoid a circular import
+    from ..setup_helpers import iter_setup_packages, use_system_library
+
+    libraries = []
+    names = set()
+
+    for setuppkg in iter_setup_packages(srcdir, packages):
+        if not hasattr(setuppkg, 'get_bundled_libraries'):
+            continue
+        package = setuppkg.__name__.rsplit('.', 1)[0]
+        for name, build_info in setuppkg.get_bundled_libraries():
+            if name in names:
+                raise DistutilsSetupError(
+                    'the bundled library {0!r} is defined more than '
+                    'once'.format(name))
+            names.add(name)
+            if use_system_library(name):
+                log.info('using the system {0} library instead of the '
+                         'bundled one'.format(name))
+                continue
+            libraries.append(BundledLibrary(name, build_info,
+                                            package=package))
+
+    return libraries
+
+
+def link_bundled_library(ext, library, archive):
+    """
+    Link the ``archive`` of the bundled ``library`` into the extension
+    ``ext`` if it lists the library in its ``libraries``. Returns `True` if
+    the extension depends on the library.
+    """
+
+    if library.name not in ext.libraries and archive not in ext.extra_objects:
+        return False
+
+    ext.libraries = [name for name in ext.libraries if name != library.name]
+    if archive not in ext.extra_objects:
+        ext.extra_objects = list(ext.extra_objects or []) + [archive]
+    for include_dir in library.include_dirs:
+        if include_dir not in ext.include_dirs:
+            ext.include_dirs.append(include_dir)
+
+    return True
+
+
+class LibraryCache(object):
+    """
+    A directory of archives of bundled libraries, shared between builds.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory in which the archives are stored.
+    manifest : `~astropy_helpers.commands._manifest.BuildManifest`
+        The manifest of the build, used to compute the digests of files and
+        the identity of the compiler.
+    """
+
+    def __init__(self, cache_dir, manifest):
+        self.cache_dir = cache_dir
+        self.manifest = manifest
+
+    def key(self, library, compiler, debug=False):
+        """
+        Returns the key under which the archive of ``library`` built with
+        ``compiler`` is cached.
+        """
+
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(source))
+                                   for source in library.sources])
+
+        def relative(path):
+            path = os.path.abspath(path)
+            if os.path.commonpath([root, path]) == root:
+                return os.path.relpath(path, root).replace(os.sep, '/')
+            return None
+
+        search_dirs = (list(library.include_dirs) +
+                       list(compiler.include_dirs))
+
+        files = []
+        for filename in library.sources + library.depends:
+            if filename not in files:
+                files.append(filename)
+            for dependency in self.manifest.graph.dependencies(filename,
+                                                               search_dirs):
+                if dependency not in files:
+                    files.append(dependency)
+
+        # Files outside of the directory of the library (such as the Python
+        # headers) are only identified by their name and contents
+        inputs = {
+            'name': library.name,
+            'files': sorted((relative(filename) or
+                             os.path.basename(filename),
+                             self.manifest.file_digest(filename))
+                            for filename in files),
+            'include_dirs': [relative(path) or path
+                             for path in library.include_dirs],
+            'define_macros': library.define_macros,
+            'extra_compile_args': library.extra_compile_args,
+            'compiler_macros': compiler.macros,
+            'debug': bool(debug),
+            'compiler': self.manifest.compiler_identity(compiler),
+        }
+
+        serialized = json.dumps(inputs, sort_keys=True, default=repr)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _path(self, name, key, archive):
+        return os.path.join(self.cache_dir, '{0}-{1}{2}'.format(
+            name, key, os.path.splitext(archive)[1]))
+
+    def fetch(self, name, key, archive):
+        """
+        Copy the cached archive of the library ``name`` stored under ``key``
+        to ``archive``, and return `False` if there is no such archive.
+        """
+
+        path = self._path(name, key, archive)
+
+        try:
+            os.makedirs(os.path.dirname(archive) or '.', exist_ok=True)
+            shutil.copyfile(path, archive)
+        except OSError:
+            return False
+
+        # The modification time is used to find the least recently used
+        # archives
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return True
+
+    def store(self, name, key, archive):
+        """
+        Store the ``archive`` of the library ``name`` under ``key``, removing
+        the least recently used archives of the same library.
+        """
+
+        path = self._path(name, key, archive)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            shutil.copyfile(archive, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            log.warn('could not store {0} in the library cache: '
+                     '{1}'.format(archive, exc))
+            return
+
+        pattern = os.path.join(self.cache_dir, glob.escape(name) + '-' +
+                               '?' * 64 + '.*')
+        archives = sorted(glob.glob(pattern), key=os.path.getmtime)
+        for filename in archives[:-MAX_CACHED_ARCHIVES]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+class SharedObjects(object):
+    """
+    The object files compiled during a build, so that sources compiled with
+    the same arguments into the same object file by several extensions are
+    only compiled once.
+    """
+
+    def __init__(self):
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._compiles = {}
+
+    def compile(self, compile, obj, src, ext, cc_args, extra_postargs,
+                pp_opts):
+        """
+        Compile ``src`` into ``obj`` with the ``compile`` function (the
+        ``_compile`` method of the compiler) unless it was already compiled
+        with the same arguments in this build, waiting for it to finish if
+        it is being compiled by another thread.
+        """
+
+        key = (os.path.abspath(obj), os.path.abspath(src), ext,
+               tuple(cc_args), tuple(extra_postargs), tuple(pp_opts))
+
+        with self._lock:
+            done = self._compiles.get(key)
+            if done is None:
+                self._compiles[key] = done = threading.Event()
+                done.error = None
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            done.wait()
+            if done.error is not None:
+                raise done.error
+            with self._lock:
+                self.reused += 1
+            return
+
+        try:
+            compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+        except BaseException as exc:
+            done.error = exc
+            raise
+        finally:
+            done.set()
+
+    def summary(self):
+        return ('reused {0} object file(s) compiled for other extensions in '
+                'this build'.format(self.reused))
+
+
+def _shared_compile(self, obj, src, ext, cc_args, extra_postargs, pp_opts):
+    return self._shared_objects.compile(self._compile_unshared, obj, src, ext,
+                                        cc_args, extra_postargs, pp_opts)
+
+
+def setup_shared_objects(compiler, shared_objects):
+    """
+    Set up a `distutils.ccompiler.CCompiler` instance to compile each object
+    file only once per build with the same arguments. Compilers that do not
+    have a ``_compile`` method (such as MSVC) are left unchanged, and `False`
+    is returned.
+    """
+
+    if not hasattr(compiler, '_compile'):
+        return False
+
+    if getattr(compiler, '_shared_objects', None) is None:
+        compiler._compile_unshared = compiler._compile
+        compiler._compile = types.MethodType(_shared_compile, compiler)
+
+    compiler._shared_objects = shared_objects
+
+    return True
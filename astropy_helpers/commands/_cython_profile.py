@@ -0,0 +1,217 @@
+"""
+Support for profiling Cython extensions, for the --cython-profile option of
+the custom 'build_ext' command and for the 'cython_profile' command.
+
+With --cython-profile, the .pyx files of all the extensions are translated
+with the ``profile`` and ``linetrace`` directives, and compiled with the
+``CYTHON_TRACE`` and ``CYTHON_TRACE_NOGIL`` macros, so that the Cython
+functions show up in cProfile and Python-level line tracers. Since tracing
+makes the extensions much slower, they are built in their own temporary build
+directory, and the generated C files are kept there rather than in the source
+tree.
+
+The 'cython_profile' command builds the package (with --cython-profile) into
+its own build directory rather than in place, then runs a workload with that
+build under cProfile and a line tracer, in a separate Python process, and writes a
+report of the Cython functions and lines in which most time was spent.
+"""
+
+import json
+import linecache
+import os
+import pstats
+import subprocess
+import sys
+
+from distutils import log
+from distutils.errors import DistutilsExecError
+
+CYTHON_PROFILE_DIRECTIVES = {'profile': True, 'linetrace': True,
+                             'binding': True}
+
+CYTHON_PROFILE_MACROS = [('CYTHON_TRACE', '1'), ('CYTHON_TRACE_NOGIL', '1')]
+
+CYTHON_SOURCE_EXTENSIONS = ('.pyx', '.pxd', '.pxi')
+
+# Script used to run the workload. The line tracer only traces the frames of
+# Cython functions, and attributes the time until the next line event in the
+# same frame (which includes the time spent in any functions called) to the
+# current line.
+_PROFILE_SCRIPT = """\
+import cProfile
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+output, lib_dir, helpers_dir, specs = sys.argv[1:]
+
+sys.path[:0] = [lib_dir, os.getcwd(), helpers_dir]
+
+hits = defaultdict(int)
+times = defaultdict(float)
+current = {}
+clock = time.perf_counter
+
+
+def trace_lines(frame, event, arg):
+    now = clock()
+    previous = current.get(frame)
+    if previous is not None:
+        times[previous[0]] += now - previous[1]
+    if event == 'line':
+        key = (frame.f_code.co_filename, frame.f_lineno)
+        hits[key] += 1
+        current[frame] = (key, now)
+    elif event == 'return':
+        current.pop(frame, None)
+    return trace_lines
+
+
+def trace_calls(frame, event, arg):
+    if frame.f_code.co_filename.endswith(('.pyx', '.pxd', '.pxi')):
+        return trace_lines
+    return None
+
+
+workloads = []
+for kind, target in json.loads(specs):
+    if kind == 'script':
+        import runpy
+        workloads.append(
+            lambda target=target: runpy.run_path(target, run_name='__main__'))
+    elif kind == 'training':
+        from astropy_helpers.utils import import_file
+        module = import_file(target[0], name=target[1])
+        training = module.get_pgo_training()
+        workloads.extend([training] if callable(training) else training)
+    else:
+        import importlib
+        module_name, function = target.split(':')
+        workloads.append(getattr(importlib.import_module(module_name),
+                                 function))
+
+profiler = cProfile.Profile()
+sys.settrace(trace_calls)
+profiler.enable()
+try:
+    for workload in workloads:
+        workload()
+finally:
+    profiler.disable()
+    sys.settrace(None)
+    profiler.dump_stats(output + '.pstats')
+    with open(output + '.lines.json', 'w') as f:
+        json.dump([[filename, lineno, hits[filename, lineno],
+                    times[filename, lineno]]
+                   for filename, lineno in hits], f)
+"""
+
+
+def apply_cython_profile(extension):
+    """
+    Add the Cython directives and the macros needed to profile and trace the
+    lines of ``extension``, if it has Cython sources. Returns `True` if the
+    extension has Cython sources.
+    """
+
+    if not any(src.endswith('.pyx') for src in extension.sources):
+        return False
+
+    directives = dict(getattr(extension, 'cython_directives', None) or {})
+    directives.update(CYTHON_PROFILE_DIRECTIVES)
+    extension.cython_directives = directives
+
+    for macro in CYTHON_PROFILE_MACROS:
+        if macro not in extension.define_macros:
+            extension.define_macros.append(macro)
+
+    return True
+
+
+def parse_workload(workload):
+    """
+    Returns a ``(kind, target)`` tuple for the ``workload`` given to the
+    'cython_profile' command: either a Python script (``'script'``) or a
+    ``module:function`` callable (``'callable'``).
+    """
+
+    if os.path.isfile(workload) or workload.endswith('.py'):
+        return 'script', os.path.abspath(workload)
+
+    return 'callable', workload
+
+
+def run_workloads(workloads, lib_dir, output):
+    """
+    Run ``workloads``, a list of ``(kind, target)`` tuples as returned by
+    `parse_workload` (or ``('training', (filename, module_name))`` for the
+    PGO training workloads of a ``setup_package.py`` file), under cProfile
+    and the line tracer, with the profiling build in ``lib_dir``. The raw
+    profiles are written next to ``output``.
+    """
+
+    # The directory containing the astropy_helpers package
+    helpers_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+    cmd = [sys.executable, '-c', _PROFILE_SCRIPT, os.path.abspath(output),
+           os.path.abspath(lib_dir), helpers_dir, json.dumps(workloads)]
+    if subprocess.call(cmd) != 0:
+        raise DistutilsExecError('the workload being profiled failed')
+
+
+def _is_cython(filename):
+    return filename.endswith(CYTHON_SOURCE_EXTENSIONS)
+
+
+def write_report(output, limit=20):
+    """
+    Write the report of the hottest Cython functions and lines from the
+    profiles collected by `run_workloads` to ``output``, and return the
+    report.
+    """
+
+    stats = pstats.Stats(output + '.pstats').stats
+    functions = sorted(
+        ((tottime, cumtime, ncalls, '{0}:{1}({2})'.format(*func))
+         for func, (ccalls, ncalls, tottime, cumtime, callers)
+         in stats.items() if _is_cython(func[0])),
+        reverse=True)[:limit]
+
+    with open(output + '.lines.json') as f:
+        lines = sorted(((time, hits, filename, lineno)
+                        for filename, lineno, hits, time in json.load(f)
+                        if _is_cython(filename)),
+                       reverse=True)[:limit]
+
+    report = ['Hottest Cython functions (by own time, in seconds)', '',
+              '{0:>4}  {1:>10}  {2:>10}  {3:>10}  {4}'.format(
+                  'rank', 'own time', 'cum. time', 'calls', 'function')]
+    for rank, (tottime, cumtime, ncalls, name) in enumerate(functions, 1):
+        report.append('{0:>4}  {1:>10.6f}  {2:>10.6f}  {3:>10}  {4}'.format(
+            rank, tottime, cumtime, ncalls, name))
+    if not functions:
+        report.append('(no Cython functions were profiled)')
+
+    report.extend(['', 'Hottest Cython lines (by time including calls, in '
+                   'seconds)', '',
+                   '{0:>4}  {1:>10}  {2:>10}  {3}'.format(
+                       'rank', 'time', 'hits', 'line')])
+    for rank, (time, hits, filename, lineno) in enumerate(lines, 1):
+        source = linecache.getline(filename, lineno).strip()
+        report.append('{0:>4}  {1:>10.6f}  {2:>10}  {3}:{4}  {5}'.format(
+            rank, time, hits, filename, lineno, source).rstrip())
+    if not lines:
+        report.append('(no Cython lines were traced)')
+
+    report = '\n'.join(report) + '\n'
+
+    with open(output, 'w') as f:
+        f.write(report)
+
+    log.info('wrote the Cython profile report to {0} (raw cProfile data in '
+             '{0}.pstats)'.format(output))
+
+    return report
@@ -0,0 +1,298 @@
+"""
+Translation of Cython sources to C/C++ for the custom 'build_ext' command.
+
+Rather than letting Cython's build_ext translate each .pyx file when the
+extension it belongs to is built (one file at a time), all the .pyx files are
+translated up front on a pool of processes. The generated files are also kept
+in a cache in the build directory, keyed by the contents of the .pyx file and
+of the .pxd/.pxi files it depends on, the version of Cython and the options
+and directives passed to Cython, so that files are only translated again if
+one of these changes, and switching back to e.g. a previous version of Cython
+or of a source file does not require translating it again.
+"""
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from distutils import log
+from distutils.errors import DistutilsError
+
+from ._isa import get_module_name
+
+CACHE_DIRNAME = 'cython_cache'
+
+# The number of generated files kept in the cache for each module
+MAX_CACHED_VERSIONS = 4
+
+
+def get_cython_options(cmd, ext):
+    """
+    Returns the options used to translate the .pyx sources of the extension
+    ``ext`` with the build_ext command ``cmd``, following the same rules as
+    Cython's own build_ext command.
+    """
+
+    def option(name, default=None):
+        return getattr(cmd, name, None) or getattr(ext, name, None) or default
+
+    include_path = list(getattr(cmd, 'cython_include_dirs', None) or [])
+    for directory in (list(getattr(ext, 'cython_include_dirs', None) or []) +
+                      list(ext.include_dirs)):
+        if directory not in include_path:
+            include_path.append(directory)
+
+    # The directives from the profile selected in setup.cfg (see
+    # _directives.py) have the lowest precedence
+    directives = dict((getattr(cmd, '_profile_directives', None) or {}).get(
+        ext.name, {}))
+    directives.update(getattr(cmd, 'cython_directives', None) or {})
+    directives.update(getattr(ext, 'cython_directives', None) or {})
+
+    cplus = bool(option('cython_cplus') or
+                 (ext.language and ext.language.lower() == 'c++'))
+
+    if getattr(cmd, 'inplace', False):
+        output_dir = os.curdir
+    else:
+        output_dir = cmd.build_lib
+
+    return {
+        'full_module_name': get_module_name(ext),
+        'include_path': include_path,
+        'compiler_directives': directives,
+        'cplus': cplus,
+        'emit_linenums': bool(option('cython_line_directives')),
+        'c_line_in_traceback': not option('no_c_in_traceback'),
+        'gdb_debug': bool(option('cython_gdb')),
+        'compile_time_env': option('cython_compile_time_env'),
+        'output_dir': output_dir,
+    }
+
+
+def _cythonize_one(source, target, options):
+    """
+    Translate ``source`` to ``target``, and return the number of errors along
+    with the wall and CPU time taken. This is run in the worker processes.
+    """
+
+    start, start_cpu = time.perf_counter(), time.process_time()
+
+    from Cython.Compiler.Main import (CompilationOptions, compile,
+                                      default_options)
+
+    options = dict(options)
+    full_module_name = options.pop('full_module_name')
+    compilation_options = CompilationOptions(default_options,
+                                             output_file=target, **options)
+    result = compile(source, options=compilation_options,
+                     full_module_name=full_module_name)
+    return (result.num_errors, time.perf_counter() - start,
+            time.process_time() - start_cpu)
+
+
+def _get_pool(jobs, ntasks):
+    """
+    Returns a process pool to translate ``ntasks`` files using up to ``jobs``
+    processes, or `None` if they should be translated in this process.
+
+    Only forked processes are used, since a freshly spawned interpreter would
+    run setup.py again when unpickling the task.
+    """
+
+    if jobs <= 1 or ntasks <= 1:
+        return None
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+
+    if sys.version_info < (3, 7):
+        # The start method can't be specified for a ProcessPoolExecutor
+        if multiprocessing.get_start_method() != 'fork':
+            return None
+        return ProcessPoolExecutor(max_workers=min(jobs, ntasks))
+
+    return ProcessPoolExecutor(max_workers=min(jobs, ntasks),
+                               mp_context=multiprocessing.get_context('fork'))
+
+
+class CythonCache(object):
+    """
+    The cache of files generated by Cython, stored in ``cache_dir``.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory in which the generated files are kept.
+    graph : `~astropy_helpers.commands._depends.DependencyGraph`
+        The graph used to find the .pxd/.pxi files each .pyx file depends on.
+    file_digest : callable
+        A function returning the digest of the contents of a file.
+    """
+
+    def __init__(self, cache_dir, graph, file_digest):
+        self.cache_dir = cache_dir
+        self.graph = graph
+        self.file_digest = file_digest
+
+    def key(self, source, options):
+        """
+        Returns the key under which the file generated from ``source`` with
+        ``options`` is cached.
+        """
+
+        from Cython import __version__ as cython_version
+
+        dependencies = self.graph.dependencies(source, options['include_path'])
+
+        inputs = {
+            'source': self.file_digest(source),
+            'dependencies': [(filename, self.file_digest(filename))
+                             for filename in dependencies],
+            'cython_version': cython_version,
+            # The output directory is only used for cython_debug files
+            'options': dict(options, output_dir=None),
+        }
+
+        serialized = json.dumps(inputs, sort_keys=True, default=repr)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def filename(self, module_name, key, target):
+        return os.path.join(self.cache_dir, '{0}-{1}{2}'.format(
+            module_name, key, os.path.splitext(target)[1]))
+
+    def fetch(self, cached, target):
+        """
+        Make sure ``target`` has the same contents as the ``cached`` file, and
+        return `False` if the file is not in the cache.
+        """
+
+        if not os.path.isfile(cached):
+            return False
+
+        with open(cached, 'rb') as f:
+            content = f.read()
+
+        try:
+            with open(target, 'rb') as f:
+                up_to_date = f.read() == content
+        except OSError:
+            up_to_date = False
+
+        if up_to_date:
+            log.info("skipping '{0}' Cython extension "
+                     "(up-to-date)".format(target))
+        else:
+            log.info("copying cached Cython output for {0} "
+                     "to {1}".format(os.path.basename(target), target))
+            shutil.copyfile(cached, target)
+
+        # Keep track of when each cached file was last used, so that the
+        # least recently used files are removed first
+        os.utime(cached, None)
+
+        return True
+
+    def store(self, target, cached, module_name):
+        """
+        Store the ``target`` file generated by Cython in the cache, removing
+        the least recently used versions for the same module.
+        """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        shutil.copyfile(target, cached + '.tmp')
+        os.replace(cached + '.tmp', cached)
+
+        pattern = os.path.join(self.cache_dir,
+                               glob.escape(module_name) + '-' + '?' * 64 + '.*')
+        versions = sorted(glob.glob(pattern), key=os.path.getmtime)
+        for filename in versions[:-MAX_CACHED_VERSIONS]:
+            os.remove(filename)
+
+
+def cythonize_extensions(cmd, extensions, cache, jobs=1, force=False,
+                         timings=None, target_dir=None):
+    """
+    Translate the .pyx sources of ``extensions`` to C/C++, on up to ``jobs``
+    processes, and replace them with the generated files in the list of
+    sources of each extension.
+
+    Unless ``force`` is set, files are taken from ``cache`` where possible.
+    The time taken to translate each file is recorded in ``timings`` if
+    given (see `~astropy_helpers.commands._timings.BuildTimings`).
+
+    The generated files are written next to the .pyx files, or under
+    ``target_dir`` if given (in which case the directory of each .pyx file is
+    added to the include directories of its extension, so that the headers
+    next to it are still found).
+    """
+
+    tasks = []
+    # The variants of multi-versioned extensions share their .pyx files
+    targets = set()
+
+    for ext in extensions:
+        if not any(src.endswith('.pyx') for src in ext.sources):
+            continue
+
+        options = get_cython_options(cmd, ext)
+        target_ext = '.cpp' if options['cplus'] else '.c'
+
+        sources = []
+        for source in ext.sources:
+            if source.endswith('.pyx'):
+                target = os.path.splitext(source)[0] + target_ext
+                if target_dir is not None:
+                    target = os.path.join(target_dir, target)
+                    if not cmd.dry_run:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                    source_dir = os.path.dirname(source) or os.curdir
+                    if source_dir not in ext.include_dirs:
+                        ext.include_dirs.append(source_dir)
+                module_name = options['full_module_name']
+                key = cache.key(source, options)
+                cached = cache.filename(module_name, key, target)
+                if target not in targets and (
+                        force or cmd.dry_run or
+                        not cache.fetch(cached, target)):
+                    tasks.append((source, target, options, cached,
+                                  module_name))
+                targets.add(target)
+                source = target
+            sources.append(source)
+
+        ext.sources = sources
+
+    for source, target, options, cached, module_name in tasks:
+        log.info('cythoning {0} to {1}'.format(source, target))
+
+    if cmd.dry_run or not tasks:
+        return
+
+    pool = _get_pool(jobs, len(tasks))
+
+    if pool is None:
+        results = [_cythonize_one(source, target, options)
+                   for source, target, options, cached, module_name in tasks]
+    else:
+        with pool:
+            futures = [pool.submit(_cythonize_one, source, target, options)
+                       for source, target, options, cached, module_name
+                       in tasks]
+        results = [future.result() for future in futures]
+
+    for task, result in zip(tasks, results):
+        source, target, options, cached, module_name = task
+        nerrors, wall_time, cpu_time = result
+        if timings is not None:
+            timings.record_cython(source, target, wall_time, cpu_time)
+        if nerrors:
+            raise DistutilsError('{0} errors while compiling {1!r} with '
+                                 'Cython'.format(nerrors, source))
+        cache.store(target, cached, module_name)
@@ -0,0 +1,247 @@
+"""
+A scanner for the dependencies of C/C++ and Cython source files.
+
+C and C++ files depend on the headers they ``#include``, while Cython files
+depend on the ``.pxd`` files they ``cimport`` (including the ``.pxd`` file
+with the same name as a ``.pyx`` file), and on the files they ``include``.
+
+The directives found in each file are stored in the build directory along with
+the modification time and size of the file, so that on subsequent builds only
+files that have changed need to be scanned again. Resolving the directives to
+actual files is cheap and is done on every build, so that newly added headers
+are picked up.
+"""
+
+import json
+import os
+import re
+import threading
+
+DEPENDS_FILENAME = 'astropy_helpers_depends.json'
+
+C_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.m', '.mm',
+                '.h', '.hh', '.hpp', '.hxx', '.h++', '.inc')
+
+CYTHON_EXTENSIONS = ('.pyx', '.pxd', '.pxi')
+
+_C_INCLUDE_RE = re.compile(
+    br'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]+)[>"]', re.MULTILINE)
+
+_CYTHON_CIMPORT_RE = re.compile(
+    br'^[ \t]*(?:from[ \t]+([\w.]+)[ \t]+cimport[ \t]+([^\n#]+)|'
+    br'cimport[ \t]+([^\n#]+))', re.MULTILINE)
+
+_CYTHON_INCLUDE_RE = re.compile(
+    br'^[ \t]*include[ \t]+[\'"]([^\'"\n]+)[\'"]', re.MULTILINE)
+
+
+def _split_names(names):
+    """
+    Split the list of names following ``cimport``, removing any aliases and
+    parentheses.
+    """
+
+    names = names.replace('(', ' ').replace(')', ' ').replace('\\', ' ')
+    result = []
+    for name in names.split(','):
+        name = name.split()
+        if name:
+            result.append(name[0])
+    return result
+
+
+def scan_directives(filename, content):
+    """
+    Returns the dependency directives found in ``content`` (the contents of
+    ``filename``), as a list of ``[kind, name]`` pairs, where ``kind`` is one
+    of:
+
+    - ``'include'``: a C ``#include "name"`` directive
+    - ``'sysinclude'``: a C ``#include <name>`` directive
+    - ``'cimport'``: a Cython ``cimport`` of the module ``name``
+    - ``'pxi'``: a Cython ``include "name"`` statement
+    """
+
+    directives = []
+
+    if filename.endswith(C_EXTENSIONS):
+        for delimiter, name in _C_INCLUDE_RE.findall(content):
+            kind = 'include' if delimiter == b'"' else 'sysinclude'
+            directives.append([kind, name.decode('utf-8', 'replace').strip()])
+
+    elif filename.endswith(CYTHON_EXTENSIONS):
+        for module, names, plain in _CYTHON_CIMPORT_RE.findall(content):
+            module = module.decode('utf-8', 'replace')
+            if plain:
+                for name in _split_names(plain.decode('utf-8', 'replace')):
+                    directives.append(['cimport', name])
+            else:
+                directives.append(['cimport', module])
+                # The imported names may themselves be modules, e.g.
+                # ``from package cimport module``
+                for name in _split_names(names.decode('utf-8', 'replace')):
+                    if name != '*':
+                        separator = '' if module.endswith('.') else '.'
+                        directives.append(['cimport',
+                                           module + separator + name])
+        for name in _CYTHON_INCLUDE_RE.findall(content):
+            directives.append(['pxi', name.decode('utf-8', 'replace')])
+
+    return directives
+
+
+def _find_file(name, search_dirs):
+    for directory in search_dirs:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate):
+            return os.path.normpath(candidate)
+    return None
+
+
+def _find_pxd(module, filename, search_dirs):
+    """
+    Find the ``.pxd`` file for a cimported module, which may be relative
+    (starting with one or more dots) to the file doing the cimport.
+    """
+
+    if module.startswith('.'):
+        level = len(module) - len(module.lstrip('.'))
+        directory = os.path.dirname(filename) or os.curdir
+        for _ in range(level - 1):
+            directory = os.path.dirname(os.path.abspath(directory))
+        search_dirs = [directory]
+        module = module[level:]
+        if not module:
+            return None
+
+    path = os.path.join(*module.split('.'))
+    return (_find_file(path + '.pxd', search_dirs) or
+            _find_file(os.path.join(path, '__init__.pxd'), search_dirs))
+
+
+class DependencyGraph(object):
+    """
+    The graph of dependencies between source files, persisted in
+    ``filename`` between builds.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def save(self):
+        """
+        Write out the graph, replacing any previous version atomically.
+        """
+
+        with self._lock:
+            # Forget about files that no longer exist
+            entries = dict((key, value) for key, value in self.entries.items()
+                           if os.path.exists(key))
+            data = json.dumps(entries, sort_keys=True)
+
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+        os.replace(tmp_filename, self.filename)
+
+    def directives(self, filename):
+        """
+        Returns the dependency directives in ``filename`` (see
+        `scan_directives`), only re-scanning the file if it changed since it
+        was last scanned.
+        """
+
+        key = os.path.abspath(filename)
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return []
+
+        entry = self.entries.get(key)
+        if (isinstance(entry, dict) and entry.get('mtime') == stat.st_mtime and
+                entry.get('size') == stat.st_size):
+            return entry['directives']
+
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        except OSError:
+            return []
+
+        directives = scan_directives(filename, content)
+
+        with self._lock:
+            self.entries[key] = {'mtime': stat.st_mtime,
+                                 'size': stat.st_size,
+                                 'directives': directives}
+
+        return directives
+
+    def direct_dependencies(self, filename, include_dirs=()):
+        """
+        Returns the files that ``filename`` directly depends on. Only
+        dependencies that can be found relative to ``filename``, to the
+        current directory (for cimports) or in ``include_dirs`` are returned,
+        so that system headers and third-party ``.pxd`` files are ignored.
+        """
+
+        include_dirs = list(include_dirs)
+        directory = os.path.dirname(filename) or os.curdir
+        dependencies = []
+
+        if filename.endswith('.pyx'):
+            pxd = os.path.splitext(filename)[0] + '.pxd'
+            if os.path.isfile(pxd):
+                dependencies.append(os.path.normpath(pxd))
+
+        for kind, name in self.directives(filename):
+            if kind == 'sysinclude':
+                found = _find_file(name, include_dirs)
+            elif kind in ('include', 'pxi'):
+                found = _find_file(name, [directory] + include_dirs)
+            elif kind == 'cimport':
+                found = _find_pxd(name, filename,
+                                  [directory, os.curdir] + include_dirs)
+            else:
+                found = None
+            if found is not None:
+                dependencies.append(found)
+
+        return dependencies
+
+    def dependencies(self, filename, include_dirs=()):
+        """
+        Returns all the files that ``filename`` depends on, directly or
+        indirectly, in sorted order.
+        """
+
+        found = []
+        seen = set([os.path.abspath(filename)])
+        pending = [filename]
+
+        while pending:
+            current = pending.pop()
+            for dependency in self.direct_dependencies(current, include_dirs):
+                key = os.path.abspath(dependency)
+                if key not in seen:
+                    seen.add(key)
+                    found.append(dependency)
+                    pending.append(dependency)
+
+        return sorted(found)
@@ -0,0 +1,139 @@
+"""
+Named profiles of Cython compiler directives, defined in ``setup.cfg`` and
+applied by the custom 'build_ext' command when translating .pyx files.
+
+Each profile is defined in a ``[cython_directives:<profile>]`` section, and
+the directives of a profile can be overridden for the extensions of a given
+package (or sub-package, or extension module) in a
+``[cython_directives:<profile>:<package>]`` section, e.g.::
+
+    [cython_directives:release]
+    boundscheck = False
+    wraparound = False
+    cdivision = True
+    initializedcheck = False
+
+    [cython_directives:debug]
+    boundscheck = True
+    wraparound = True
+    initializedcheck = True
+
+    [cython_directives:release:mypackage.io]
+    wraparound = True
+
+The ``debug`` profile is used for debug builds, and otherwise the ``dev``
+profile (if defined) for developer versions and the ``release`` profile for
+releases and developer versions with no ``dev`` profile. Directives set on an
+extension itself, or in the header comments of a .pyx file, take precedence
+over those of the profile.
+"""
+
+from configparser import ConfigParser
+
+from distutils.errors import DistutilsOptionError
+
+SECTION_PREFIX = 'cython_directives:'
+
+
+def read_directive_profiles(setup_cfg='setup.cfg'):
+    """
+    Returns the profiles of Cython directives defined in ``setup_cfg``, as a
+    dictionary mapping the name of each profile to a dictionary mapping
+    package names (``''`` for the directives of the profile itself) to
+    dictionaries of directives (as strings).
+    """
+
+    conf = ConfigParser()
+    # Directive names are case-sensitive
+    conf.optionxform = str
+    conf.read(setup_cfg)
+
+    profiles = {}
+    for section in conf.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        name, _, package = section[len(SECTION_PREFIX):].partition(':')
+        profiles.setdefault(name.strip(), {})[package.strip()] = dict(
+            conf.items(section))
+
+    return profiles
+
+
+def select_directive_profile(profiles, requested=None, debug=False,
+                             is_release=False):
+    """
+    Returns the name of the profile of Cython directives to use, or `None` if
+    no profile applies. ``requested`` is the name of a profile explicitly
+    requested, which must be defined in ``profiles``.
+    """
+
+    if requested:
+        if requested not in profiles:
+            raise DistutilsOptionError(
+                'Cython directives profile {0!r} is not defined in setup.cfg '
+                '(a [{1}{0}] section is needed)'.format(requested,
+                                                       SECTION_PREFIX))
+        return requested
+
+    if debug:
+        candidates = ['debug']
+    elif is_release:
+        candidates = ['release']
+    else:
+        candidates = ['dev', 'release']
+
+    for name in candidates:
+        if name in profiles:
+            return name
+
+    return None
+
+
+def _parse_directives(directives, section):
+    """
+    Convert the values of ``directives`` read from ``section`` to the types
+    expected by Cython.
+    """
+
+    from Cython.Compiler.Options import parse_directive_value
+
+    parsed = {}
+    for name, value in directives.items():
+        try:
+            parsed_value = parse_directive_value(name, value,
+                                                 relaxed_bool=True)
+        except ValueError as exc:
+            raise DistutilsOptionError(
+                'invalid value for Cython directive {0!r} in [{1}] in '
+                'setup.cfg: {2}'.format(name, section, exc))
+        if parsed_value is None:
+            raise DistutilsOptionError(
+                'unknown Cython directive {0!r} in [{1}] in '
+                'setup.cfg'.format(name, section))
+        parsed[name] = parsed_value
+
+    return parsed
+
+
+def get_profile_directives(profiles, profile, module_name):
+    """
+    Returns the Cython directives of ``profile`` for the extension
+    ``module_name``, including the overrides for the packages it is part of
+    (from the least to the most specific).
+    """
+
+    if profile is None:
+        return {}
+
+    sections = profiles[profile]
+    parts = module_name.split('.')
+
+    directives = {}
+    for package in [''] + ['.'.join(parts[:idx])
+                           for idx in range(1, len(parts) + 1)]:
+        if package in sections:
+            section = SECTION_PREFIX + profile + (':' + package
+                                                  if package else '')
+            directives.update(_parse_directives(sections[package], section))
+
+    return directives
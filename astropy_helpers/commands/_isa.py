@@ -0,0 +1,304 @@
+"""
+Extensions built for several instruction set architecture (ISA) levels, with
+a generated module which imports the best variant for the CPU at import time.
+
+An extension is marked as multi-versioned in a ``setup_package.py`` file with
+`~astropy_helpers.cpu_helpers.add_isa_variants`. The custom 'build_ext'
+command then replaces it with one extension per ISA level (for example
+``mypackage._kernels__avx2`` and ``mypackage._kernels__baseline`` for
+``mypackage._kernels``), each compiled with the flags for that level. Since
+the object files are named after the sources, the sources of each variant are
+small wrappers (in the temporary build directory) which include the original
+sources, so that each variant has its own object files.
+
+All the variants define the initialization function of the original module,
+and are loaded under its name by a dispatcher module generated in its place
+(``mypackage/_kernels.py``). The dispatcher reads the features of the CPU
+(from ``/proc/cpuinfo`` on Linux, ``sysctl`` on macOS and
+``IsProcessorFeaturePresent`` on Windows), loads the first variant whose
+required features are all present, and replaces itself with it in
+``sys.modules``. The ``ASTROPY_HELPERS_ISA`` environment variable can be set
+to the name of a level to load that variant instead, e.g. for benchmarks and
+tests.
+
+Variants are only built for x86 platforms. On other platforms, multi-versioned
+extensions are built as usual.
+"""
+
+import copy
+import os
+import pprint
+
+from importlib.machinery import EXTENSION_SUFFIXES
+
+from distutils import log
+
+from ..cpu_helpers import ISA_LEVELS
+from ..utils import write_if_different
+
+ISA_DIRNAME = 'isa'
+
+ISA_ENV_VARIABLE = 'ASTROPY_HELPERS_ISA'
+
+# The compiler flags for each level, for MSVC and for compilers that accept
+# GCC-style flags, and the CPU features (as named in /proc/cpuinfo) that the
+# code built with these flags requires
+_ISA_FLAGS = {
+    'avx512': {'unix': ['-mavx512f', '-mavx512cd', '-mavx512bw', '-mavx512dq',
+                        '-mavx512vl', '-mavx2', '-mfma'],
+               'msvc': ['/arch:AVX512']},
+    'avx2': {'unix': ['-mavx2', '-mfma'],
+             'msvc': ['/arch:AVX2']},
+    'baseline': {'unix': [],
+                 'msvc': []},
+}
+
+_ISA_FEATURES = {
+    'avx512': ['avx512f', 'avx512cd', 'avx512bw', 'avx512dq', 'avx512vl',
+               'avx2', 'fma'],
+    'avx2': ['avx2', 'fma'],
+    'baseline': [],
+}
+
+# The machine part of the platform names of x86 platforms (as given by
+# distutils.util.get_platform)
+_X86_MACHINES = ('x86_64', 'amd64', 'i386', 'i586', 'i686', 'win32', 'intel')
+
+_DISPATCHER_SRC = '''
+# Autogenerated by the build_ext command of astropy-helpers; do not modify
+
+"""
+Import the variant of the {name} extension built for the best
+instruction set supported by the CPU.
+
+The {env} environment variable can be set to the name of a variant
+({levels}) to import that variant instead.
+"""
+
+import os
+import sys
+
+from importlib.machinery import EXTENSION_SUFFIXES, ExtensionFileLoader
+from importlib.util import module_from_spec, spec_from_file_location
+
+# The variants, from the best to the most compatible, and the CPU features
+# they require
+_VARIANTS = {variants}
+
+
+def _get_cpu_features():
+    features = set()
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/cpuinfo') as f:
+                for line in f:
+                    if line.startswith('flags'):
+                        features.update(line.split(':', 1)[1].split())
+                        break
+        except OSError:
+            pass
+    elif sys.platform == 'darwin':
+        import subprocess
+        try:
+            output = subprocess.check_output(
+                ['sysctl', '-n', 'machdep.cpu.features',
+                 'machdep.cpu.leaf7_features'], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        else:
+            features.update(output.decode('ascii', 'replace').lower().split())
+    elif sys.platform == 'win32':
+        import ctypes
+        is_present = ctypes.windll.kernel32.IsProcessorFeaturePresent
+        # PF_AVX2_INSTRUCTIONS_AVAILABLE and PF_AVX512F_INSTRUCTIONS_AVAILABLE
+        if is_present(40):
+            features.update(['avx2', 'fma'])
+        if is_present(41):
+            features.update(['avx512f', 'avx512cd', 'avx512bw', 'avx512dq',
+                             'avx512vl'])
+    return features
+
+
+def _select_variant():
+    requested = os.environ.get({env!r})
+    if requested:
+        if requested not in dict(_VARIANTS):
+            raise ImportError('{{0}}={{1}} was requested, but the {name} '
+                              'extension was only built for {levels}'.format(
+                                  {env!r}, requested))
+        return requested
+    features = _get_cpu_features()
+    for level, required in _VARIANTS:
+        if all(feature in features for feature in required):
+            return level
+    return _VARIANTS[-1][0]
+
+
+def _load_variant(level):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for suffix in EXTENSION_SUFFIXES:
+        path = os.path.join(directory, {module!r} + '__' + level + suffix)
+        if os.path.exists(path):
+            loader = ExtensionFileLoader(__name__, path)
+            spec = spec_from_file_location(__name__, path, loader=loader)
+            module = module_from_spec(spec)
+            loader.exec_module(module)
+            module.__isa_level__ = level
+            return module
+    raise ImportError('the {{0}} variant of the {name} extension was not '
+                      'found'.format(level))
+
+
+sys.modules[__name__] = _load_variant(_select_variant())
+'''[1:]
+
+
+def is_x86_platform(plat_name):
+    """
+    Returns whether ``plat_name`` (as given by
+    `distutils.util.get_platform`) is an x86 platform.
+    """
+
+    return plat_name.rsplit('-', 1)[-1].lower() in _X86_MACHINES
+
+
+def get_isa_flags(level, compiler_type):
+    """
+    Returns the compiler flags for the ISA ``level`` with a compiler of the
+    given type.
+    """
+
+    return list(_ISA_FLAGS[level]['msvc' if compiler_type == 'msvc'
+                                  else 'unix'])
+
+
+def get_module_name(ext):
+    """
+    Returns the name of the module built by the extension ``ext``, which for
+    an ISA variant is the name of the extension it was built from.
+    """
+
+    return getattr(ext, '_isa_base', None) or ext.name
+
+
+def expand_isa_variants(extensions, plat_name, compiler_type):
+    """
+    Returns ``extensions``, with each multi-versioned extension replaced by
+    its variants for each ISA level on x86 platforms.
+    """
+
+    expanded = []
+
+    for ext in extensions:
+        levels = getattr(ext, 'isa_levels', None)
+        if not levels:
+            expanded.append(ext)
+            continue
+
+        if not is_x86_platform(plat_name):
+            log.info('building {0} for the baseline instruction set only, '
+                     'since {1} is not an x86 platform'.format(ext.name,
+                                                              plat_name))
+            ext.isa_levels = None
+            expanded.append(ext)
+            continue
+
+        for level in levels:
+            variant = copy.copy(ext)
+            # Lists are copied since they are modified in place by the build
+            for attr, value in vars(ext).items():
+                if isinstance(value, list):
+                    setattr(variant, attr, list(value))
+            variant.name = '{0}__{1}'.format(ext.name, level)
+            variant.isa_levels = None
+            variant._isa_base = ext.name
+            variant._isa_level = level
+            flags = get_isa_flags(level, compiler_type)
+            variant.extra_compile_args.extend(flags)
+            # The flags are also needed when linking with LTO, but the MSVC
+            # linker does not accept them
+            if compiler_type != 'msvc':
+                variant.extra_link_args.extend(flags)
+            expanded.append(variant)
+
+    return expanded
+
+
+def get_isa_variants(extensions):
+    """
+    Returns a dictionary mapping the name of each multi-versioned extension
+    to the list of the ISA levels of its variants in ``extensions``.
+    """
+
+    variants = {}
+    for ext in extensions:
+        if getattr(ext, '_isa_base', None):
+            variants.setdefault(ext._isa_base, []).append(ext._isa_level)
+    return variants
+
+
+def write_isa_sources(ext, build_temp, dry_run=False):
+    """
+    Replace the sources of the ISA variant ``ext`` with wrappers in
+    ``build_temp`` which include them, so that they are compiled to object
+    files specific to the variant.
+    """
+
+    isa_dir = os.path.join(build_temp, ISA_DIRNAME, ext._isa_level)
+
+    sources = []
+    for source in ext.sources:
+        if os.path.abspath(source).startswith(os.path.abspath(isa_dir) +
+                                              os.sep):
+            sources.append(source)
+            continue
+        wrapper = os.path.join(isa_dir, os.path.relpath(source)
+                               if not os.path.isabs(source)
+                               else os.path.splitdrive(source)[1].lstrip(
+                                   '\\/'))
+        if not dry_run:
+            os.makedirs(os.path.dirname(wrapper), exist_ok=True)
+            include = os.path.abspath(source).replace(os.sep, '/')
+            write_if_different(wrapper, '#include "{0}"\n'.format(
+                include).encode('utf-8'))
+        sources.append(wrapper)
+
+    ext.sources = sources
+
+
+def generate_isa_dispatcher(name, levels, package_dir):
+    """
+    Write the dispatcher module for the multi-versioned extension ``name``,
+    built for ``levels``, to ``package_dir`` (the directory of its package),
+    and return its path. Any extension module of the same name (e.g. from a
+    previous build) is removed, since it would take precedence over the
+    dispatcher.
+    """
+
+    module = name.rsplit('.', 1)[-1]
+    levels = [level for level in ISA_LEVELS if level in levels]
+
+    src = _DISPATCHER_SRC.format(
+        name=name, module=module, env=ISA_ENV_VARIABLE,
+        levels=', '.join(levels),
+        variants=pprint.pformat([(level, _ISA_FEATURES[level])
+                                 for level in levels]).replace(
+                                     '\n', '\n' + ' ' * 12))
+
+    dispatcher_py = os.path.join(package_dir, module + '.py')
+    write_if_different(dispatcher_py, src.encode('utf-8'))
+
+    remove_extension_module(package_dir, module)
+
+    return dispatcher_py
+
+
+def remove_extension_module(package_dir, module):
+    """
+    Remove the extension modules called ``module`` in ``package_dir``.
+    """
+
+    for suffix in EXTENSION_SUFFIXES:
+        filename = os.path.join(package_dir, module + suffix)
+        if os.path.isfile(filename):
+            os.remove(filename)
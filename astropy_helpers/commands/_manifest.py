@@ -0,0 +1,194 @@
+"""
+A persistent record of the inputs used to build each extension module.
+
+The custom 'build_ext' command stores, for each extension, a digest of the
+contents of its sources and of the files they depend on (see `._depends`),
+along with the macros, compiler/linker arguments and the identity of the
+compiler. Extensions whose digest is unchanged since the last build are
+skipped, regardless of any file modification times (which change for example
+when switching branches or when a checkout restores timestamps).
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+from ._depends import DEPENDS_FILENAME, DependencyGraph
+
+MANIFEST_FILENAME = 'astropy_helpers_manifest.json'
+
+
+def get_compiler_identity(compiler):
+    """
+    Returns a list that identifies a `distutils.ccompiler.CCompiler` instance,
+    including the commands it runs and, where possible, the version reported
+    by the compiler executable.
+    """
+
+    identity = [compiler.compiler_type]
+
+    for attr in ('compiler_so', 'compiler_cxx', 'linker_so'):
+        identity.append(getattr(compiler, attr, None))
+
+    executable = getattr(compiler, 'compiler_so', None)
+    if executable:
+        try:
+            version = subprocess.check_output(executable[:1] + ['--version'],
+                                              stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        else:
+            identity.append(version.decode('utf-8', 'replace'))
+
+    return identity
+
+
+class BuildManifest(object):
+    """
+    The manifest of extension digests stored in the build directory.
+
+    Parameters
+    ----------
+    build_temp : str
+        The temporary build directory in which the manifest is stored.
+    graph : `~astropy_helpers.commands._depends.DependencyGraph`, optional
+        The graph used to find the dependencies of each source file. By
+        default, the graph stored alongside the manifest is used.
+    """
+
+    def __init__(self, build_temp, graph=None):
+        self.filename = os.path.join(build_temp, MANIFEST_FILENAME)
+        self.entries = self._load()
+        if graph is None:
+            graph = DependencyGraph(os.path.join(build_temp, DEPENDS_FILENAME))
+        self.graph = graph
+        self._lock = threading.Lock()
+        self._file_digests = {}
+        self._compiler_identities = {}
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+
+        return entries
+
+    def save(self):
+        """
+        Write out the manifest, replacing any previous version atomically.
+        """
+
+        with self._lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+        os.replace(tmp_filename, self.filename)
+
+    def is_up_to_date(self, name, digest, output):
+        """
+        Returns `True` if the extension called ``name`` was last built with
+        inputs matching ``digest``, and its ``output`` file still exists.
+        """
+
+        entry = self.entries.get(name)
+        return (isinstance(entry, dict) and entry.get('digest') == digest and
+                os.path.exists(output))
+
+    def record(self, name, digest):
+        """
+        Record that the extension called ``name`` was built from inputs
+        matching ``digest``.
+        """
+
+        with self._lock:
+            self.entries[name] = {'digest': digest}
+
+    def file_digest(self, filename):
+        """
+        Returns the SHA-256 digest of the contents of ``filename``, or `None`
+        if the file does not exist.
+        """
+
+        key = os.path.abspath(filename)
+        if key not in self._file_digests:
+            try:
+                with open(filename, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                digest = None
+            self._file_digests[key] = digest
+
+        return self._file_digests[key]
+
+    def invalidate(self, filename):
+        """
+        Forget the digest of ``filename``, e.g. after it was written.
+        """
+
+        self._file_digests.pop(os.path.abspath(filename), None)
+
+    def compiler_identity(self, compiler):
+        """
+        Returns the (cached) identity of ``compiler``, as given by
+        `get_compiler_identity`.
+        """
+
+        if id(compiler) not in self._compiler_identities:
+            self._compiler_identities[id(compiler)] = \
+                get_compiler_identity(compiler)
+        return self._compiler_identities[id(compiler)]
+
+    def extension_digest(self, ext, compiler, debug=False):
+        """
+        Returns a digest of all the inputs used to build the extension
+        ``ext`` with ``compiler``.
+        """
+
+        include_dirs = list(ext.include_dirs or []) + list(compiler.include_dirs)
+        search_dirs = include_dirs + list(getattr(ext, 'cython_include_dirs',
+                                                  None) or [])
+
+        files = []
+        for filename in list(ext.sources) + list(ext.depends or []):
+            if filename not in files:
+                files.append(filename)
+            for dependency in self.graph.dependencies(filename, search_dirs):
+                if dependency not in files:
+                    files.append(dependency)
+
+        inputs = {
+            'name': ext.name,
+            'files': [(filename, self.file_digest(filename))
+                      for filename in files],
+            'extra_objects': [(filename, self.file_digest(filename))
+                              for filename in ext.extra_objects or []],
+            'include_dirs': include_dirs,
+            'define_macros': ext.define_macros,
+            'undef_macros': ext.undef_macros,
+            'compiler_macros': compiler.macros,
+            'compiler_libraries': compiler.libraries,
+            'compiler_library_dirs': compiler.library_dirs,
+            'compiler_objects': compiler.objects,
+            'extra_compile_args': ext.extra_compile_args,
+            'extra_link_args': ext.extra_link_args,
+            'libraries': ext.libraries,
+            'library_dirs': ext.library_dirs,
+            'runtime_library_dirs': ext.runtime_library_dirs,
+            'export_symbols': ext.export_symbols,
+            'language': ext.language,
+            'debug': bool(debug),
+            'compiler': self.compiler_identity(compiler),
+        }
+
+        serialized = json.dumps(inputs, sort_keys=True, default=repr)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
@@ -0,0 +1,389 @@
+"""
+A cache of compiled object files shared between builds, in the spirit of
+ccache.
+
+When enabled, each source file is first run through the preprocessor, and the
+object file is looked up in the cache under a key made of the preprocessed
+source, the identity of the compiler and the compiler arguments. On a hit, the
+object file is copied from the cache instead of compiling the source again; on
+a miss, the source is compiled as usual and the object file is added to the
+cache. The least recently used object files are removed once the cache grows
+beyond a maximum size.
+
+The cache lives in a directory of the user (see
+`~astropy_helpers.utils.get_user_cache_dir`), so that it can be shared between
+build directories, checkouts and virtual environments. Absolute paths to the
+current directory and to the Python installation are removed from the line
+markers of the preprocessed source before it is hashed, so that e.g. the same
+checkout built in two virtual environments can share object files (debug
+information in the object files then refers to the build that populated the
+cache, as with the ``base_dir`` setting of ccache).
+
+Alternatively, an external compiler launcher (ccache or sccache) can be used
+instead of the builtin cache.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import types
+
+from distutils import log
+from distutils.errors import DistutilsOptionError
+
+from ._manifest import get_compiler_identity
+from ._parallel import acquire_job
+
+OBJECT_CACHE_MODES = ('none', 'builtin', 'ccache', 'sccache', 'auto')
+
+# External compiler launchers, in order of preference for 'auto'
+LAUNCHERS = ('sccache', 'ccache')
+
+DEFAULT_MAX_SIZE = '5G'
+
+STATS_FILENAME = 'stats.json'
+
+# Compilers for which the builtin cache can be used, since they accept the
+# same -E option to preprocess sources
+_SUPPORTED_COMPILERS = ('unix', 'cygwin', 'mingw32')
+
+_LINE_MARKER_RE = re.compile(br'^(#(?: line)? \d+ ")([^"\n]*)(")', re.MULTILINE)
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+_local = threading.local()
+
+
+def parse_size(size):
+    """
+    Parse a size such as ``'500M'`` or ``'5G'`` (or a plain number of bytes)
+    into a number of bytes.
+    """
+
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size),
+                     re.IGNORECASE)
+    if match is None:
+        raise DistutilsOptionError('invalid size: {0!r}'.format(size))
+
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def find_launcher(mode):
+    """
+    Returns the path to the external compiler launcher to use for the object
+    cache ``mode``, or `None` if the builtin cache should be used.
+    """
+
+    if mode == 'builtin':
+        return None
+
+    names = LAUNCHERS if mode == 'auto' else (mode,)
+    for name in names:
+        path = shutil.which(name)
+        if path is not None:
+            return path
+
+    if mode != 'auto':
+        raise DistutilsOptionError(
+            "--object-cache={0} was requested but {0} could not be "
+            "found".format(mode))
+
+    return None
+
+
+def setup_launcher(compiler, launcher):
+    """
+    Run the compilation commands of ``compiler`` through the compiler
+    ``launcher`` (ccache or sccache), unless they already are.
+    """
+
+    for attr in ('compiler_so', 'compiler_so_cxx'):
+        command = getattr(compiler, attr, None)
+        if not command:
+            continue
+        if os.path.basename(command[0]).split('.')[0] in LAUNCHERS:
+            continue
+        setattr(compiler, attr, [launcher] + list(command))
+
+
+class ObjectCache(object):
+    """
+    A directory of object files, indexed by the key computed in
+    `_cached_compile`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory in which object files are stored.
+    max_size : int
+        The maximum total size of the object files in bytes.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key[2:] + '.o')
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def fetch(self, key, obj):
+        """
+        Copy the object file stored under ``key`` to ``obj``, and return
+        `False` if there is no such object file.
+        """
+
+        path = self._path(key)
+
+        try:
+            shutil.copyfile(path, obj)
+        except OSError:
+            self.count('misses')
+            return False
+
+        # The modification time is used to find the least recently used
+        # files, since access times are often not recorded
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.count('hits')
+        return True
+
+    def store(self, key, obj):
+        """
+        Store the object file ``obj`` under ``key``.
+        """
+
+        path = self._path(key)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                            threading.get_ident())
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(obj, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            log.warn('could not store {0} in the object cache: '
+                     '{1}'.format(obj, exc))
+
+    def cleanup(self):
+        """
+        Remove the least recently used object files until the size of the
+        cache is below the maximum size.
+        """
+
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.o'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total <= self.max_size:
+            return total
+
+        # Leave some room so that the cache isn't cleaned up on every build
+        target = 0.9 * self.max_size
+        for mtime, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        return total
+
+    def finish(self):
+        """
+        Clean up the cache, add the statistics for this build to the overall
+        statistics stored in the cache directory, and return a summary.
+        """
+
+        size = self.cleanup()
+
+        stats_file = os.path.join(self.cache_dir, STATS_FILENAME)
+        try:
+            with open(stats_file) as f:
+                totals = json.load(f)
+        except (OSError, ValueError):
+            totals = {}
+
+        for stat, value in self.stats.items():
+            totals[stat] = totals.get(stat, 0) + value
+
+        try:
+            tmp_file = '{0}.{1}.tmp'.format(stats_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(totals, f, sort_keys=True)
+            os.replace(tmp_file, stats_file)
+        except OSError:
+            pass
+
+        return ('object cache: {hits} hits, {misses} misses, {uncacheable} '
+                'uncacheable ({total_hits} hits and {total_misses} misses '
+                'overall, {size:.1f}/{max_size:.1f} MiB used in '
+                '{cache_dir})'.format(
+                    total_hits=totals['hits'], total_misses=totals['misses'],
+                    size=size / 1024 ** 2, max_size=self.max_size / 1024 ** 2,
+                    cache_dir=self.cache_dir, **self.stats))
+
+
+def _preprocess(compiler, src, cc_args, extra_postargs):
+    """
+    Returns the output of the preprocessor for ``src``, or `None` if the
+    source could not be preprocessed.
+    """
+
+    compiler_so = compiler.compiler_so
+    if sys.platform == 'darwin':
+        from distutils._osx_support import compiler_fixup
+        compiler_so = compiler_fixup(compiler_so, cc_args + extra_postargs)
+
+    cmd = (compiler_so + [arg for arg in cc_args if arg != '-c'] +
+           ['-E', src] + extra_postargs)
+
+    with acquire_job(getattr(compiler, '_jobserver', None)):
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        output = proc.communicate()[0]
+
+    if proc.returncode:
+        return None
+
+    return output
+
+
+@contextlib.contextmanager
+def collect_preprocessed_sizes(sizes):
+    """
+    Context manager that stores the size of each source preprocessed by the
+    object cache in the current thread in the ``sizes`` dictionary, keyed by
+    the source filename.
+    """
+
+    previous = getattr(_local, 'sizes', None)
+    _local.sizes = sizes
+    try:
+        yield sizes
+    finally:
+        _local.sizes = previous
+
+
+def _normalize_line_markers(preprocessed):
+    """
+    Make absolute paths in the line markers of ``preprocessed`` relative to
+    the current directory or to the Python installation.
+    """
+
+    prefixes = []
+    for name, path in (('.', os.getcwd()), ('<prefix>', sys.prefix),
+                       ('<base_prefix>', getattr(sys, 'base_prefix',
+                                                 sys.prefix))):
+        path = os.fsencode(os.path.join(path, ''))
+        if path not in [prefix for prefix, _ in prefixes]:
+            prefixes.append((path, os.fsencode(name + os.sep)))
+
+    # Try the longest paths first, e.g. for a virtualenv inside the checkout
+    prefixes.sort(key=lambda prefix: -len(prefix[0]))
+
+    def replace(match):
+        path = match.group(2)
+        for prefix, name in prefixes:
+            if path.startswith(prefix):
+                path = name + path[len(prefix):]
+                break
+        return match.group(1) + path + match.group(3)
+
+    return _LINE_MARKER_RE.sub(replace, preprocessed)
+
+
+def _cached_compile(self, obj, src, ext, cc_args, extra_postargs, pp_opts):
+    """
+    Replacement for the ``_compile`` method of a
+    `distutils.ccompiler.CCompiler` that uses the object cache.
+    """
+
+    cache = self._object_cache
+
+    if self.dry_run:
+        return self._uncached_compile(obj, src, ext, cc_args, extra_postargs,
+                                      pp_opts)
+
+    preprocessed = _preprocess(self, src, cc_args, extra_postargs)
+    if preprocessed is None:
+        cache.count('uncacheable')
+        return self._uncached_compile(obj, src, ext, cc_args, extra_postargs,
+                                      pp_opts)
+
+    sizes = getattr(_local, 'sizes', None)
+    if sizes is not None:
+        sizes[src] = len(preprocessed)
+
+    if getattr(self, '_object_cache_identity', None) is None:
+        self._object_cache_identity = get_compiler_identity(self)
+
+    # The include directories and macros are left out since their effect is
+    # already in the preprocessed source
+    inputs = {
+        'compiler': self._object_cache_identity,
+        'args': [arg for arg in cc_args if arg not in pp_opts],
+        'extra_postargs': extra_postargs,
+        'language': ext,
+        'preprocessed': hashlib.sha256(
+            _normalize_line_markers(preprocessed)).hexdigest(),
+    }
+    serialized = json.dumps(inputs, sort_keys=True, default=repr)
+    key = hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    if cache.fetch(key, obj):
+        log.info('using cached object file for {0}'.format(src))
+        return
+
+    self._uncached_compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+    cache.store(key, obj)
+
+
+def setup_object_cache(compiler, cache):
+    """
+    Set up a `distutils.ccompiler.CCompiler` instance to use the builtin
+    object ``cache``. Returns `False` if the compiler is not supported (as is
+    the case of MSVC).
+    """
+
+    if (compiler.compiler_type not in _SUPPORTED_COMPILERS or
+            not hasattr(compiler, '_compile')):
+        return False
+
+    if getattr(compiler, '_object_cache', None) is None:
+        compiler._uncached_compile = compiler._compile
+        compiler._compile = types.MethodType(_cached_compile, compiler)
+
+    compiler._object_cache = cache
+
+    return True
@@ -0,0 +1,209 @@
+"""
+Size- and load-time-optimized output for the --optimize-output option of the
+custom 'build_ext' command.
+
+With this option, extensions are compiled with hidden symbol visibility by
+default (so that only the module initialization function, which Python marks
+as exported, is in the dynamic symbol table), and with each function and
+variable in its own section so that the linker can discard unused code and
+data. Once an extension is linked, its debug information is moved to a
+separate file (with ``objcopy`` for ELF shared objects, or ``dsymutil`` on
+macOS) and the extension is stripped. The size of each extension before and
+after stripping is reported at the end of the build.
+
+Debuggers only look for the file named by the ``.gnu_debuglink`` section of an
+ELF extension next to the extension, in a ``.debug`` directory next to it, or
+under a global debug directory in a directory named after the absolute path of
+the extension, none of which is the debug information directory. The debug
+files are therefore also indexed by the build ID of the extensions, as
+``.build-id/xx/yyyy.debug`` links in the debug information directory, which
+``gdb`` finds after ``set debug-file-directory <directory>`` wherever the
+extension is installed.
+
+With MSVC, symbols are hidden by default and debug information is already
+kept in separate files, so only the equivalent of section garbage collection
+(``/Gy``, ``/Gw`` and ``/OPT:REF``) is used.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from distutils import log
+
+DEBUG_INFO_DIRNAME = 'debug-info'
+
+
+def get_output_flags(compiler_type):
+    """
+    Returns the ``(compile_args, link_args)`` to add to each extension for
+    --optimize-output with a compiler of the given type.
+    """
+
+    if compiler_type == 'msvc':
+        return ['/Gy', '/Gw'], ['/OPT:REF', '/OPT:ICF']
+
+    compile_args = ['-ffunction-sections', '-fdata-sections']
+
+    # Before Python 3.9, PyMODINIT_FUNC does not set the visibility of the
+    # initialization function, which would then be hidden as well
+    if sys.version_info >= (3, 9):
+        compile_args.insert(0, '-fvisibility=hidden')
+
+    if sys.platform == 'darwin':
+        link_args = ['-Wl,-dead_strip']
+    else:
+        # The build ID is used to find the debug information
+        link_args = ['-Wl,--gc-sections', '-Wl,--build-id']
+
+    return compile_args, link_args
+
+
+def _run(args):
+    subprocess.check_output(args, stderr=subprocess.STDOUT)
+
+
+def split_debug_info(filename, debug_file):
+    """
+    Move the debug information of the shared object ``filename`` to
+    ``debug_file`` and strip ``filename``. Returns `False` if this is not
+    supported on this platform, or failed.
+    """
+
+    if sys.platform.startswith('win'):
+        return False
+
+    os.makedirs(os.path.dirname(debug_file) or '.', exist_ok=True)
+
+    try:
+        if sys.platform == 'darwin':
+            _run(['dsymutil', filename, '-o', debug_file])
+            _run(['strip', '-x', filename])
+        else:
+            objcopy = os.environ.get('OBJCOPY', 'objcopy')
+            _run([objcopy, '--only-keep-debug', filename, debug_file])
+            _run([objcopy, '--strip-debug', '--strip-unneeded',
+                  '--add-gnu-debuglink=' + debug_file, filename])
+    except (OSError, subprocess.CalledProcessError) as exc:
+        output = getattr(exc, 'output', None)
+        log.warn('could not split the debug information of {0}: {1}'.format(
+            filename, output.decode('utf-8', 'replace').strip() if output
+            else exc))
+        return False
+
+    return True
+
+
+def get_build_id(filename):
+    """
+    Returns the build ID of the ELF file ``filename`` as a hexadecimal string,
+    or `None` if it has none or it could not be read.
+    """
+
+    readelf = os.environ.get('READELF', 'readelf')
+    try:
+        output = subprocess.check_output([readelf, '-n', filename],
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    match = re.search(br'Build ID:\s*([0-9a-fA-F]{4,})', output)
+    if match is None:
+        return None
+
+    return match.group(1).decode('ascii').lower()
+
+
+def link_build_id(debug_file, debug_info_dir, build_id):
+    """
+    Add a link to ``debug_file`` in the ``.build-id`` directory of
+    ``debug_info_dir``, under which debuggers look it up from the
+    ``build_id`` of the extension.
+    """
+
+    link = os.path.join(debug_info_dir, '.build-id', build_id[:2],
+                        build_id[2:] + '.debug')
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+
+    if os.path.lexists(link):
+        os.remove(link)
+
+    try:
+        os.symlink(os.path.relpath(debug_file, os.path.dirname(link)), link)
+    except OSError as exc:
+        log.warn('could not link {0} to {1}: {2}'.format(link, debug_file,
+                                                           exc))
+
+
+class OutputSizes(object):
+    """
+    The sizes of the extensions built with --optimize-output, before and
+    after their debug information was split off.
+    """
+
+    def __init__(self, debug_info_dir):
+        self.debug_info_dir = debug_info_dir
+        self.sizes = {}
+        self._lock = threading.Lock()
+
+    def debug_file(self, ext_name, filename):
+        """
+        Returns the path of the file to which the debug information of the
+        extension ``ext_name``, built to ``filename``, is written.
+        """
+
+        suffix = '.dSYM' if sys.platform == 'darwin' else '.debug'
+        return os.path.join(self.debug_info_dir,
+                            *ext_name.split('.')[:-1] +
+                            [os.path.basename(filename) + suffix])
+
+    def process(self, ext_name, filename):
+        """
+        Split the debug information of the extension ``ext_name``, built to
+        ``filename``, and record its size before and after.
+        """
+
+        before = os.path.getsize(filename)
+        debug_file = self.debug_file(ext_name, filename)
+        if split_debug_info(filename, debug_file) and sys.platform != 'darwin':
+            build_id = get_build_id(filename)
+            if build_id is not None:
+                link_build_id(debug_file, self.debug_info_dir, build_id)
+        with self._lock:
+            self.sizes[ext_name] = (before, os.path.getsize(filename))
+
+    def summary(self):
+        """
+        Returns a table of the sizes of the extensions, from the largest to
+        the smallest.
+        """
+
+        def fmt(size):
+            return '{0:.1f}'.format(size / 1024)
+
+        rows = [('extension', 'before [KiB]', 'after [KiB]', 'saved')]
+        for name, (before, after) in sorted(
+                self.sizes.items(), key=lambda item: (-item[1][1], item[0])):
+            rows.append((name, fmt(before), fmt(after),
+                         '{0:.0%}'.format(1 - after / before if before else 0)))
+
+        total_before = sum(before for before, _ in self.sizes.values())
+        total_after = sum(after for _, after in self.sizes.values())
+        rows.append(('total', fmt(total_before), fmt(total_after),
+                     '{0:.0%}'.format(1 - total_after / total_before
+                                      if total_before else 0)))
+
+        widths = [max(len(row[idx]) for row in rows)
+                  for idx in range(len(rows[0]))]
+        lines = ['  '.join([row[0].ljust(widths[0])] +
+                           [cell.rjust(width) for cell, width
+                            in zip(row[1:], widths[1:])])
+                 for row in rows]
+        lines.insert(1, '-' * len(lines[0]))
+        lines.insert(-1, '-' * len(lines[0]))
+        lines.append('debug information written to {0}'.format(
+            self.debug_info_dir))
+
+        return '\n'.join(lines)
@@ -0,0 +1,310 @@
+"""
+Utilities used by the custom 'build_ext' command to compile extension modules,
+and the sources inside each extension, concurrently.
+
+Extensions are built on a pool of threads, and the sources of each extension
+are compiled on a further pool of threads. The number of compiler and linker
+processes running at any one time is limited by a semaphore shared between
+all of these threads (in the same way as the make jobserver), so that the
+total never exceeds the number of jobs requested.
+
+Since output from several extensions would otherwise be interleaved, log
+messages and compiler output are captured per thread and replayed in the order
+in which the extensions (and their sources) were declared.
+"""
+
+import collections
+import contextlib
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from distutils import log
+from distutils.ccompiler import CCompiler
+from distutils.errors import DistutilsExecError
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def grouped_log():
+    """
+    Context manager that patches the distutils logger so that messages from
+    threads inside a `capture_log` block are stored instead of printed.
+    """
+
+    logger = log._global_log
+    original_log = logger._log
+
+    def _log(level, msg, args, *extra_args, **kwargs):
+        records = getattr(_local, 'records', None)
+        if records is None:
+            return original_log(level, msg, args, *extra_args, **kwargs)
+        records.append((level, msg, args))
+
+    logger._log = _log
+    try:
+        yield
+    finally:
+        del logger._log
+
+
+@contextlib.contextmanager
+def capture_log(records):
+    """
+    Context manager that stores any log messages emitted by the current
+    thread in the ``records`` list. This only has an effect inside a
+    `grouped_log` block.
+    """
+
+    previous = getattr(_local, 'records', None)
+    _local.records = records
+    try:
+        yield records
+    finally:
+        _local.records = previous
+
+
+def replay_log(records):
+    """
+    Emit log messages previously stored by `capture_log`. If called from a
+    thread that is itself capturing messages, the messages are passed on to
+    that thread's records.
+    """
+
+    parent = getattr(_local, 'records', None)
+    if parent is not None:
+        parent.extend(records)
+    else:
+        for level, msg, args in records:
+            log.log(level, msg, *args)
+
+
+def call_captured(func, *args, **kwargs):
+    """
+    Call ``func`` while capturing log messages, and return a ``(records,
+    exception)`` tuple, where ``exception`` is `None` if the call succeeded.
+    """
+
+    records = []
+    try:
+        with capture_log(records):
+            func(*args, **kwargs)
+    except Exception as exc:
+        return records, exc
+    return records, None
+
+
+@contextlib.contextmanager
+def collect_usage(usages):
+    """
+    Context manager that appends the resource usage of every command run by
+    `run_command` in the current thread to the ``usages`` list, as well as
+    the time spent waiting for the jobserver in `acquire_job` (as
+    dictionaries with only a ``wait_time``).
+    """
+
+    previous = getattr(_local, 'usages', None)
+    _local.usages = usages
+    try:
+        yield usages
+    finally:
+        _local.usages = previous
+
+
+@contextlib.contextmanager
+def acquire_job(jobserver):
+    """
+    Context manager that waits for a free slot of ``jobserver`` (unless it is
+    `None`), and passes the time spent waiting to `collect_usage` blocks.
+    """
+
+    if jobserver is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    with jobserver:
+        usages = getattr(_local, 'usages', None)
+        if usages is not None:
+            usages.append({'wait_time': time.perf_counter() - start})
+        yield
+
+
+def run_command(cmd, env=None):
+    """
+    Run ``cmd``, and return a ``(output, returncode)`` tuple, where ``output``
+    is the combined stdout and stderr of the command.
+
+    The resources used by the command are passed to `collect_usage` blocks,
+    as a dictionary with the ``wall_time`` and ``cpu_time`` (in seconds) of
+    the command and its peak memory usage (``max_rss``, in bytes). The latter
+    two are `None` on platforms without ``os.wait4`` (e.g. Windows).
+    """
+
+    start = time.perf_counter()
+
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+
+    cpu_time = max_rss = None
+    if hasattr(os, 'wait4'):
+        # Unlike getrusage(RUSAGE_CHILDREN), this gives the resources used by
+        # this particular process, even if others run at the same time
+        output = proc.stdout.read()
+        proc.stdout.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        cpu_time = rusage.ru_utime + rusage.ru_stime
+        # ru_maxrss is in kilobytes, except on MacOS X
+        max_rss = rusage.ru_maxrss
+        if sys.platform != 'darwin':
+            max_rss *= 1024
+    else:
+        output = proc.communicate()[0]
+
+    usages = getattr(_local, 'usages', None)
+    if usages is not None:
+        usages.append({'wall_time': time.perf_counter() - start,
+                       'cpu_time': cpu_time, 'max_rss': max_rss})
+
+    return output, proc.returncode
+
+
+def group_extensions(extensions):
+    """
+    Split a list of extensions into groups that can safely be built
+    concurrently.
+
+    Extensions that share a source file (and so would write to the same
+    object file in the build directory) are put in the same group, in the
+    order in which they appear in ``extensions``.
+    """
+
+    # Union-find over the extension indices, always keeping the lowest
+    # index as the root so that groups come out in the original order
+    parents = list(range(len(extensions)))
+
+    def find(index):
+        while parents[index] != index:
+            index = parents[index] = parents[parents[index]]
+        return index
+
+    owners = {}
+    for index, ext in enumerate(extensions):
+        for src in ext.sources:
+            key = os.path.normcase(os.path.abspath(os.path.splitext(src)[0]))
+            if key in owners:
+                root1, root2 = find(owners[key]), find(index)
+                parents[max(root1, root2)] = min(root1, root2)
+            else:
+                owners[key] = index
+
+    groups = collections.OrderedDict()
+    for index, ext in enumerate(extensions):
+        groups.setdefault(find(index), []).append(ext)
+
+    return list(groups.values())
+
+
+def _jobserver_spawn(self, cmd, **kwargs):
+    """
+    Replacement for `distutils.ccompiler.CCompiler.spawn` that waits for a
+    free job slot, and captures the output of the command so that it can be
+    logged together with the rest of the output for the current extension.
+    """
+
+    log.info(' '.join(cmd))
+
+    if self.dry_run:
+        return
+
+    env = kwargs.get('env')
+
+    # Mirror what distutils.spawn does for the deployment target on MacOS X
+    if (sys.platform == 'darwin' and env is None and
+            'MACOSX_DEPLOYMENT_TARGET' not in os.environ):
+        from distutils.sysconfig import get_config_var
+        target = get_config_var('MACOSX_DEPLOYMENT_TARGET')
+        if target:
+            env = dict(os.environ, MACOSX_DEPLOYMENT_TARGET=str(target))
+
+    with acquire_job(self._jobserver):
+        try:
+            output, returncode = run_command(cmd, env=env)
+        except OSError as exc:
+            raise DistutilsExecError(
+                'command {0!r} failed: {1}'.format(cmd[0], exc.args[-1]))
+
+    if output:
+        log.warn(output.decode(sys.stdout.encoding or 'utf-8',
+                               'replace').rstrip())
+
+    if returncode:
+        raise DistutilsExecError(
+            'command {0!r} failed with exit code {1}'.format(cmd[0],
+                                                           returncode))
+
+
+def _parallel_compile(self, sources, output_dir=None, macros=None,
+                      include_dirs=None, debug=0, extra_preargs=None,
+                      extra_postargs=None, depends=None):
+    """
+    Replacement for `distutils.ccompiler.CCompiler.compile` that compiles
+    the sources on a thread pool.
+    """
+
+    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+        output_dir, macros, include_dirs, sources, depends, extra_postargs)
+    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+
+    jobs = [(obj,) + build[obj] for obj in objects if obj in build]
+    workers = max(1, min(self._jobs, len(jobs)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(call_captured, self._compile, obj, src,
+                                   ext, cc_args, extra_postargs, pp_opts)
+                   for obj, src, ext in jobs]
+
+    # Report the output of all sources in order, and then the first error
+    # encountered, if any, so that the result does not depend on timing.
+    error = None
+    for future in futures:
+        records, exc = future.result()
+        replay_log(records)
+        if error is None:
+            error = exc
+
+    if error is not None:
+        raise error
+
+    # Return *all* object filenames, not just the ones we just built.
+    return objects
+
+
+def setup_parallel_compiler(compiler, jobs, jobserver):
+    """
+    Set up a `distutils.ccompiler.CCompiler` instance so that it compiles the
+    sources passed to ``compile()`` using up to ``jobs`` threads, and so that
+    every compiler or linker process it runs acquires ``jobserver`` first.
+
+    Compilers that override ``compile()`` or ``spawn()`` (such as MSVC) are
+    left unchanged, and so compile their sources one at a time.
+    """
+
+    compiler_cls = type(compiler)
+    if (compiler_cls.compile is not CCompiler.compile or
+            compiler_cls.spawn is not CCompiler.spawn):
+        return
+
+    compiler._jobs = jobs
+    compiler._jobserver = jobserver
+    compiler.spawn = types.MethodType(_jobserver_spawn, compiler)
+    compiler.compile = types.MethodType(_parallel_compile, compiler)
@@ -0,0 +1,240 @@
+"""
+Precompiled headers for the Python and Numpy C API headers, for the
+--precompiled-headers option of the custom 'build_ext' command.
+
+Parsing ``Python.h`` (and, for extensions using the Numpy C API, the Numpy
+headers) can take most of the time needed to compile small source files. When
+enabled, these headers are compiled once into a precompiled header for each
+unique configuration (compiler command, compiler arguments including include
+directories and macros, language, and the macros defined by the source before
+it includes ``Python.h``), which is then used to compile all the matching
+sources, through the ``-include`` option of GCC and Clang.
+
+Only sources whose first ``#include`` is ``Python.h`` are compiled with a
+precompiled header, since the header is included before anything else in the
+source. The ``#define`` directives that come before that include (such as
+``PY_SSIZE_T_CLEAN``, or ``Py_LIMITED_API``) are repeated in the precompiled
+header. The Numpy header defining the types of the C API
+(``numpy/ndarraytypes.h``) is also precompiled for sources that include Numpy
+headers, unless they define ``NPY_*`` macros after including ``Python.h``.
+Headers whose content depends on macros such as ``NO_IMPORT_ARRAY`` are left
+out.
+
+Precompiled headers are built again (once) in each build in which they are
+needed, so that they are never out of date with respect to the headers. If a
+precompiled header cannot be built, for example because the compiler does not
+support them, the sources are compiled as usual.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import types
+
+from distutils import log
+from distutils.errors import CompileError, DistutilsExecError
+
+from ._pgo import get_compiler_family
+
+PCH_DIRNAME = 'pch'
+
+PCH_HEADER = 'astropy_helpers_pch.h'
+
+# Compilers for which precompiled headers can be used, since they accept the
+# -x <language>-header and -include options of GCC
+_SUPPORTED_COMPILERS = ('unix', 'cygwin', 'mingw32')
+
+_CPP_EXTENSIONS = ('.cpp', '.cxx', '.cc', '.c++', '.C')
+
+_INCLUDE_RE = re.compile(r'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"]+)[>"]',
+                         re.MULTILINE)
+_DEFINE_RE = re.compile(r'^[ \t]*#[ \t]*define[ \t]+(\w+)(?:[ \t]+(.*?))?[ \t]*$',
+                        re.MULTILINE)
+
+
+def scan_source(src):
+    """
+    Returns a ``(defines, uses_numpy)`` tuple for the source file ``src``,
+    where ``defines`` is the list of ``(name, value)`` macros defined before
+    its first ``#include``, or `None` if the first ``#include`` is not
+    ``Python.h`` (in which case a precompiled header cannot be used).
+    """
+
+    try:
+        with open(src, encoding='utf-8', errors='replace') as f:
+            content = f.read()
+    except OSError:
+        return None
+
+    includes = list(_INCLUDE_RE.finditer(content))
+    if not includes or includes[0].group(2) != 'Python.h':
+        return None
+
+    python_h = includes[0].start()
+    defines = [(match.group(1), match.group(2) or '')
+               for match in _DEFINE_RE.finditer(content, 0, python_h)]
+
+    # The types of the Numpy C API are only precompiled if no NPY_* macros
+    # that may affect them are defined after Python.h
+    numpy_includes = [match for match in includes
+                      if match.group(2).startswith('numpy/')]
+    uses_numpy = bool(numpy_includes) and not any(
+        match.group(1).startswith('NPY_') for match in
+        _DEFINE_RE.finditer(content, python_h, numpy_includes[0].start()))
+
+    return defines, uses_numpy
+
+
+class PrecompiledHeaders(object):
+    """
+    The precompiled headers built during a build, in ``pch_dir``.
+    """
+
+    def __init__(self, pch_dir):
+        self.pch_dir = pch_dir
+        self.stats = {'built': 0, 'used': 0, 'failed': 0, 'ineligible': 0}
+        self._headers = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._compiler_families = {}
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def compiler_family(self, compiler):
+        """
+        Returns the family of ``compiler``, as given by `get_compiler_family`
+        (which runs the compiler) the first time it is needed.
+        """
+
+        if id(compiler) not in self._compiler_families:
+            self._compiler_families[id(compiler)] = \
+                get_compiler_family(compiler)
+        return self._compiler_families[id(compiler)]
+
+    def get_header(self, compiler, src, cc_args, extra_postargs):
+        """
+        Returns the path to the header to include (with ``-include``) to
+        compile ``src`` with a precompiled header, building the precompiled
+        header if needed, or `None` if a precompiled header cannot be used.
+        """
+
+        scanned = scan_source(src)
+        if scanned is None:
+            self.count('ineligible')
+            return None
+
+        defines, uses_numpy = scanned
+        language = ('c++' if os.path.splitext(src)[1] in _CPP_EXTENSIONS
+                    else 'c')
+        compiler_so = compiler.compiler_so
+        if sys.platform == 'darwin':
+            from distutils._osx_support import compiler_fixup
+            compiler_so = compiler_fixup(compiler_so,
+                                         cc_args + extra_postargs)
+
+        inputs = {'compiler': compiler_so, 'args': cc_args,
+                  'extra_postargs': extra_postargs, 'language': language,
+                  'defines': defines, 'numpy': uses_numpy}
+        key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode(
+            'utf-8')).hexdigest()[:16]
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Other threads needing the same header wait for it to be built
+        with key_lock:
+            if key not in self._headers:
+                self._headers[key] = self._build(
+                    compiler, compiler_so, key, cc_args, extra_postargs,
+                    language, defines, uses_numpy)
+
+        header = self._headers[key]
+        self.count('used' if header else 'failed')
+        return header
+
+    def _build(self, compiler, compiler_so, key, cc_args, extra_postargs,
+               language, defines, uses_numpy):
+
+        header_dir = os.path.abspath(os.path.join(self.pch_dir, key))
+        header = os.path.join(header_dir, PCH_HEADER)
+        family = self.compiler_family(compiler)
+        # GCC and Clang both look for the precompiled header next to the
+        # header given to -include
+        pch = header + ('.pch' if family == 'clang' else '.gch')
+
+        lines = ['/* Generated by astropy-helpers; do not modify */']
+        lines.extend('#define {0} {1}'.format(name, value).rstrip()
+                     for name, value in defines)
+        lines.append('#include <Python.h>')
+        if uses_numpy:
+            lines.append('#include <numpy/ndarraytypes.h>')
+
+        os.makedirs(header_dir, exist_ok=True)
+        with open(header, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        if os.path.exists(pch):
+            os.remove(pch)
+
+        try:
+            compiler.spawn(compiler_so + cc_args +
+                           ['-x', language + '-header', header, '-o', pch] +
+                           extra_postargs)
+        except (DistutilsExecError, CompileError) as exc:
+            log.warn('could not build a precompiled header, compiling '
+                     'without it: {0}'.format(exc))
+            return None
+
+        self.count('built')
+        return header
+
+    def summary(self):
+        """
+        Returns a summary of the use of precompiled headers in this build.
+        """
+
+        return ('precompiled headers: {built} built, used for {used} '
+                'source(s), {failed} source(s) compiled without them after a '
+                'failure, {ineligible} source(s) not eligible '
+                '(see {0})'.format(self.pch_dir, **self.stats))
+
+
+def _pch_compile(self, obj, src, ext, cc_args, extra_postargs, pp_opts):
+    """
+    Replacement for the ``_compile`` method of a
+    `distutils.ccompiler.CCompiler` that uses precompiled headers.
+    """
+
+    if not self.dry_run:
+        header = self._precompiled_headers.get_header(self, src, cc_args,
+                                                      extra_postargs)
+        if header is not None:
+            extra_postargs = list(extra_postargs) + ['-include', header]
+
+    return self._compile_without_pch(obj, src, ext, cc_args, extra_postargs,
+                                     pp_opts)
+
+
+def setup_precompiled_headers(compiler, headers):
+    """
+    Set up a `distutils.ccompiler.CCompiler` instance to use the precompiled
+    ``headers``. Returns `False` if the compiler is not supported (as is the
+    case of MSVC).
+    """
+
+    if (compiler.compiler_type not in _SUPPORTED_COMPILERS or
+            not hasattr(compiler, '_compile')):
+        return False
+
+    if getattr(compiler, '_precompiled_headers', None) is None:
+        compiler._compile_without_pch = compiler._compile
+        compiler._compile = types.MethodType(_pch_compile, compiler)
+
+    compiler._precompiled_headers = headers
+
+    return True
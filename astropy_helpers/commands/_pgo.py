@@ -0,0 +1,236 @@
+"""
+Support for building extensions with profile-guided optimization (PGO) and
+link-time optimization (LTO), for the --pgo and --lto options of the custom
+'build_ext' command.
+
+A PGO build happens in three stages:
+
+1. The extensions are built with instrumentation into a separate directory,
+   along with the pure-Python modules of the packages.
+2. The training workloads returned by the ``get_pgo_training()`` function of
+   each ``setup_package.py`` module are run in a separate Python process, in
+   which the instrumented extensions are imported. The instrumented code
+   writes out the collected profiles when the process exits.
+3. The extensions are built again, using the collected profiles.
+
+This is supported with GCC and Clang (and so Apple Clang) only.
+"""
+
+import glob
+import os
+import shutil
+import subprocess
+import sys
+
+from distutils import log
+from distutils.errors import DistutilsExecError, DistutilsOptionError
+
+# Script used to run the training workloads. The directory containing the
+# instrumented build comes first on sys.path, followed by astropy_helpers
+# (which setup_package.py files commonly import), and the current directory
+# is removed so that the packages in the source tree are not imported instead
+_TRAINING_SCRIPT = """\
+import os
+import sys
+lib_dir, helpers_dir, setup_package, module_name = sys.argv[1:]
+sys.path[:] = [lib_dir, helpers_dir] + [
+    path for path in sys.path
+    if path not in ('', '.', os.getcwd())]
+from astropy_helpers.utils import import_file
+module = import_file(setup_package, name=module_name)
+workloads = module.get_pgo_training()
+if callable(workloads):
+    workloads = [workloads]
+for workload in workloads:
+    workload()
+"""
+
+
+def get_compiler_family(compiler):
+    """
+    Returns ``'gcc'``, ``'clang'`` or ``'msvc'`` depending on the family of
+    the `distutils.ccompiler.CCompiler` instance ``compiler``, or `None` if
+    this could not be determined.
+    """
+
+    if compiler.compiler_type == 'msvc':
+        return 'msvc'
+
+    executable = getattr(compiler, 'compiler_so', None)
+    if not executable:
+        return None
+
+    # Skip any compiler launcher such as ccache
+    executable = [arg for arg in executable
+                  if os.path.basename(arg).split('.')[0]
+                  not in ('ccache', 'sccache')][:1]
+
+    try:
+        output = subprocess.check_output(executable + ['--version'],
+                                         stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    output = output.decode('utf-8', 'replace').lower()
+
+    if 'clang' in output:
+        return 'clang'
+    elif 'gcc' in output or 'free software foundation' in output:
+        return 'gcc'
+
+    return None
+
+
+def get_optimization_flags(family, pgo_stage=None, profile_dir=None,
+                           lto=False):
+    """
+    Returns the flags to pass to the compiler and linker of the given
+    ``family`` for the given PGO stage (``'generate'``, ``'use'`` or `None`)
+    and, if ``lto`` is set, for link-time optimization.
+    """
+
+    if family not in ('gcc', 'clang'):
+        raise DistutilsOptionError(
+            '--pgo and --lto are only supported with GCC and Clang')
+
+    flags = []
+
+    if pgo_stage == 'generate':
+        flags.append('-fprofile-generate={0}'.format(profile_dir))
+    elif pgo_stage == 'use':
+        if family == 'gcc':
+            # Functions that were not run during the training, and
+            # mismatches due to e.g. threads, should not be errors
+            flags.extend(['-fprofile-use={0}'.format(profile_dir),
+                          '-fprofile-correction', '-Wno-missing-profile'])
+        else:
+            flags.extend(['-fprofile-use={0}'.format(
+                os.path.join(profile_dir, 'default.profdata')),
+                '-Wno-profile-instr-unprofiled',
+                '-Wno-profile-instr-out-of-date'])
+
+    if lto:
+        flags.append('-flto')
+
+    return flags
+
+
+def find_pgo_training(srcdir, packages):
+    """
+    Returns a list of ``(module_name, filename)`` tuples for the
+    ``setup_package.py`` modules that define a ``get_pgo_training()``
+    function.
+    """
+
+    # Imported here to avoid a circular import
+    from ..setup_helpers import iter_setup_packages
+
+    training = []
+    for setuppkg in iter_setup_packages(srcdir, packages):
+        if hasattr(setuppkg, 'get_pgo_training'):
+            training.append((setuppkg.__name__, setuppkg.__file__))
+
+    return training
+
+
+def run_training(lib_dir, training):
+    """
+    Run the training workloads of the ``setup_package.py`` modules in
+    ``training`` (as returned by `find_pgo_training`), with the instrumented
+    build in ``lib_dir``.
+    """
+
+    # The directory containing the astropy_helpers package
+    helpers_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+    for module_name, filename in training:
+        log.info('running the PGO training workload from '
+                 '{0}'.format(module_name))
+        cmd = [sys.executable, '-c', _TRAINING_SCRIPT,
+               os.path.abspath(lib_dir), helpers_dir,
+               os.path.abspath(filename), module_name]
+        if subprocess.call(cmd) != 0:
+            raise DistutilsExecError(
+                'the PGO training workload from {0} failed'.format(
+                    module_name))
+
+
+def _llvm_version(path):
+    """
+    Returns the version of a versioned LLVM executable, e.g. 14 for
+    ``llvm-profdata-14``, as a tuple of integers (empty if not a version).
+    """
+
+    suffix = os.path.basename(path).rpartition('-')[2]
+    try:
+        return tuple(int(part) for part in suffix.split('.'))
+    except ValueError:
+        return ()
+
+
+def find_llvm_profdata(clang_version=None):
+    """
+    Returns the path to the llvm-profdata tool, used to merge the raw
+    profiles collected by Clang, or `None` if it could not be found.
+
+    The format of the raw profiles changes between versions of LLVM, so if
+    the version of Clang (e.g. ``'14.0.0'``) is given, the llvm-profdata of
+    the same major version is preferred.
+    """
+
+    if clang_version:
+        path = shutil.which('llvm-profdata-' + clang_version.split('.')[0])
+        if path is not None:
+            return path
+
+    path = shutil.which('llvm-profdata')
+    if path is not None:
+        return path
+
+    if sys.platform == 'darwin':
+        try:
+            return subprocess.check_output(
+                ['xcrun', '-f', 'llvm-profdata'],
+                stderr=subprocess.DEVNULL).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    # Otherwise, the most recent of the versioned executables, as installed
+    # e.g. by Debian/Ubuntu
+    candidates = []
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidates.extend(
+            path for path in glob.glob(os.path.join(directory,
+                                                    'llvm-profdata-*'))
+            if _llvm_version(path))
+    if candidates:
+        return max(candidates, key=_llvm_version)
+
+    return None
+
+
+def merge_clang_profiles(profile_dir, clang_version=None):
+    """
+    Merge the raw profiles collected by Clang (of version ``clang_version``,
+    if known) in ``profile_dir`` into the ``default.profdata`` file used by
+    ``-fprofile-use``.
+    """
+
+    llvm_profdata = find_llvm_profdata(clang_version)
+    if llvm_profdata is None:
+        raise DistutilsExecError(
+            'llvm-profdata is needed to use profiles collected with Clang, '
+            'but could not be found')
+
+    raw_profiles = glob.glob(os.path.join(profile_dir, '*.profraw'))
+    if not raw_profiles:
+        raise DistutilsExecError(
+            'no profiles were collected by the PGO training workloads')
+
+    cmd = [llvm_profdata, 'merge',
+           '-output={0}'.format(os.path.join(profile_dir,
+                                             'default.profdata'))]
+    log.info(' '.join(cmd + ['...']))
+    if subprocess.call(cmd + raw_profiles) != 0:
+        raise DistutilsExecError('could not merge the PGO profiles')
@@ -0,0 +1,225 @@
+"""
+Recording of the time and resources used to build each extension, for the
+--timings option of the custom 'build_ext' command.
+
+For each extension, the report includes the wall time, the CPU time and the
+peak memory usage (RSS) of each compile and link step (as measured for the
+compiler and linker processes themselves, and leaving out the time spent
+waiting for a free job), the time taken to translate its .pyx sources with
+Cython, and, when the builtin object cache is used, the size of each source
+after preprocessing (as the sources are not preprocessed otherwise).
+The report is written as JSON, and summarized as a table of the extensions
+sorted by the CPU time spent building them.
+"""
+
+import json
+import os
+import threading
+import time
+import types
+
+from ._objcache import collect_preprocessed_sizes
+from ._parallel import collect_usage
+
+TIMINGS_FILENAME = 'astropy_helpers_timings.json'
+
+
+def _key(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+
+def _sum(values):
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def _max(values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+class BuildTimings(object):
+    """
+    The time and resources used by each step of a build.
+    """
+
+    def __init__(self):
+        self.compiles = {}
+        self.links = {}
+        self.cython = {}
+        self.extensions = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+
+    def _measure(self, func, *args, **kwargs):
+        """
+        Call ``func``, and return a record of the wall time taken (except
+        while waiting for the jobserver) and of the resources used by the
+        processes it ran.
+        """
+
+        usages = []
+        start = time.perf_counter()
+        with collect_usage(usages):
+            func(*args, **kwargs)
+
+        wait_time = _sum(usage.get('wait_time') for usage in usages) or 0
+
+        return {'wall_time': time.perf_counter() - start - wait_time,
+                'cpu_time': _sum(usage.get('cpu_time') for usage in usages),
+                'max_rss': _max(usage.get('max_rss') for usage in usages)}
+
+    def setup_compiler(self, compiler):
+        """
+        Set up a `distutils.ccompiler.CCompiler` instance so that its compile
+        and link steps are recorded. Note that the CPU time and memory usage
+        are only recorded if the compiler processes are run through
+        `~astropy_helpers.commands._parallel.run_command`.
+        """
+
+        timings = self
+
+        if hasattr(compiler, '_compile'):
+            original_compile = compiler._compile
+
+            def _compile(self, obj, src, ext, cc_args, extra_postargs,
+                         pp_opts):
+                # The preprocessed size is only known if the object cache
+                # preprocessed the source
+                sizes = {}
+                with collect_preprocessed_sizes(sizes):
+                    record = timings._measure(original_compile, obj, src, ext,
+                                              cc_args, extra_postargs, pp_opts)
+                record.update(source=src, object=obj,
+                              preprocessed_size=sizes.get(src))
+                with timings._lock:
+                    timings.compiles[_key(src)] = record
+
+            compiler._compile = types.MethodType(_compile, compiler)
+
+        original_link = compiler.link
+
+        def link(self, target_desc, objects, output_filename, output_dir=None,
+                 *args, **kwargs):
+            record = timings._measure(original_link, target_desc, objects,
+                                      output_filename, output_dir, *args,
+                                      **kwargs)
+            if output_dir is not None:
+                output_filename = os.path.join(output_dir, output_filename)
+            record['output'] = output_filename
+            # Extensions are linked in the thread that builds them
+            extension = getattr(timings._local, 'extension', None)
+            with timings._lock:
+                timings.links[extension or _key(output_filename)] = record
+
+        compiler.link = types.MethodType(link, compiler)
+
+    def record_cython(self, source, target, wall_time, cpu_time):
+        """
+        Record the time taken by Cython to translate ``source`` to ``target``.
+        """
+
+        with self._lock:
+            self.cython[_key(target)] = {'source': source, 'target': target,
+                                         'wall_time': wall_time,
+                                         'cpu_time': cpu_time}
+
+    def build_extension(self, name, func, *args, **kwargs):
+        """
+        Call ``func`` to build the extension ``name``, and record the total
+        wall time taken. ``func`` should return `False` if the extension was
+        skipped.
+        """
+
+        self._local.extension = name
+        start = time.perf_counter()
+        try:
+            built = func(*args, **kwargs)
+        finally:
+            self._local.extension = None
+
+        with self._lock:
+            self.extensions[name] = {'wall_time': time.perf_counter() - start,
+                                     'skipped': built is False}
+
+        return built
+
+    def report(self, cmd):
+        """
+        Returns the report for the extensions of the build_ext command
+        ``cmd``, as a JSON-serializable dictionary.
+        """
+
+        extensions = []
+
+        for ext in cmd.extensions:
+            compiles = [self.compiles[_key(src)] for src in ext.sources
+                        if _key(src) in self.compiles]
+            cython = [self.cython[_key(src)] for src in ext.sources
+                      if _key(src) in self.cython]
+            link = self.links.get(ext.name)
+            steps = compiles + ([link] if link else [])
+            info = self.extensions.get(ext.name, {})
+
+            extensions.append({
+                'name': ext.name,
+                'skipped': info.get('skipped', False),
+                'wall_time': info.get('wall_time'),
+                'cpu_time': _sum(step['cpu_time'] for step in steps),
+                'max_rss': _max(step['max_rss'] for step in steps),
+                'cython_time': _sum(step['wall_time'] for step in cython),
+                'preprocessed_size': _sum(step['preprocessed_size']
+                                          for step in compiles),
+                'compile': compiles,
+                'link': link,
+                'cython': cython,
+            })
+
+        return {'jobs': cmd.jobs,
+                'wall_time': time.perf_counter() - self._start,
+                'extensions': extensions}
+
+    def write(self, cmd, filename):
+        """
+        Write the report for the extensions of the build_ext command ``cmd``
+        to ``filename``, and return it as a table in which the extensions are
+        sorted by the CPU (or otherwise wall) time spent building them.
+        """
+
+        report = self.report(cmd)
+
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        def sort_key(ext):
+            return (ext['cpu_time'] or ext['wall_time'] or 0) + \
+                (ext['cython_time'] or 0)
+
+        def fmt(value, scale=1, precision=2):
+            if value is None:
+                return '-'
+            return '{0:.{1}f}'.format(value / scale, precision)
+
+        rows = [('extension', 'wall [s]', 'cpu [s]', 'max RSS [MiB]',
+                 'cython [s]', 'preprocessed [KiB]')]
+        for ext in sorted(report['extensions'], key=sort_key, reverse=True):
+            name = ext['name'] + (' (skipped)' if ext['skipped'] else '')
+            rows.append((name, fmt(ext['wall_time']), fmt(ext['cpu_time']),
+                         fmt(ext['max_rss'], 1024 ** 2, 1),
+                         fmt(ext['cython_time']),
+                         fmt(ext['preprocessed_size'], 1024, 1)))
+
+        widths = [max(len(row[idx]) for row in rows)
+                  for idx in range(len(rows[0]))]
+        lines = ['  '.join([row[0].ljust(widths[0])] +
+                           [cell.rjust(width) for cell, width
+                            in zip(row[1:], widths[1:])])
+                 for row in rows]
+        lines.insert(1, '-' * len(lines[0]))
+        lines.append('total wall time: {0:.2f} s with {1} job(s); full report '
+                     'written to {2}'.format(report['wall_time'],
+                                             report['jobs'], filename))
+
+        return '\n'.join(lines)
@@ -0,0 +1,113 @@
+"""
+Named build variants, for the --variant option of the custom 'build_ext'
+command.
+
+Each variant is built in its own temporary build directory, which holds its
+object files, its build manifest and dependency graph, its cache of generated
+Cython files, and its own copy of the built extensions. The extensions are
+then copied to their final location (the build directory or, with --inplace,
+the source tree) whenever they differ from the copy already there. Switching
+from one variant to another therefore only copies the extensions that were
+last built for that variant, instead of rebuilding them from scratch.
+"""
+
+import hashlib
+import os
+
+from distutils.errors import DistutilsOptionError
+
+BUILD_VARIANTS = ('release', 'debug', 'profile', 'asan')
+
+# The compiler and linker flags for each variant, for MSVC and for compilers
+# that accept GCC-style flags (GCC, Clang and compatible compilers). Note that
+# the 'debug' variant also sets the debug option of build_ext.
+_VARIANT_FLAGS = {
+    'release': {'unix': ([], []),
+                'msvc': ([], [])},
+    # Assertions are enabled by undefining NDEBUG, which Python defines
+    'debug': {'unix': (['-O0', '-g', '-UNDEBUG'], []),
+              'msvc': ([], [])},
+    # Optimized code with debug information and frame pointers, so that
+    # sampling profilers such as perf can attribute time to functions
+    'profile': {'unix': (['-O2', '-g', '-fno-omit-frame-pointer'], []),
+                'msvc': (['/Zi'], ['/DEBUG'])},
+    'asan': {'unix': (['-O1', '-g', '-fno-omit-frame-pointer',
+                       '-fsanitize=address'], ['-fsanitize=address']),
+             'msvc': (['/fsanitize=address', '/Zi'], ['/DEBUG'])},
+}
+
+
+def check_variant(variant):
+    """
+    Raise a `~distutils.errors.DistutilsOptionError` if ``variant`` is not
+    the name of a build variant.
+    """
+
+    if variant not in BUILD_VARIANTS:
+        raise DistutilsOptionError(
+            '--variant should be one of {0}'.format(', '.join(BUILD_VARIANTS)))
+
+
+def get_variant_build_temp(build_temp, variant, debug=False):
+    """
+    Returns the temporary build directory for ``variant``, given the default
+    temporary build directory. The release variant uses the default directory.
+    Builds with the debug option of build_ext (other than those of the debug
+    variant, which always sets it) have their own directory, with ``-g``
+    appended, e.g. ``release-g`` for ``--debug`` on its own.
+    """
+
+    if variant == 'release' and not debug:
+        return build_temp
+
+    suffix = variant
+    if debug and variant != 'debug':
+        suffix += '-g'
+
+    return '{0}-{1}'.format(build_temp.rstrip(os.sep), suffix)
+
+
+def get_variant_flags(variant, compiler_type):
+    """
+    Returns the ``(compile_args, link_args)`` to add to each extension for
+    ``variant`` with a compiler of the given type.
+    """
+
+    flags = _VARIANT_FLAGS[variant]
+    return flags['msvc' if compiler_type == 'msvc' else 'unix']
+
+
+def _digest(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def install_variant_outputs(outputs, copy_file):
+    """
+    Copy the built extensions in ``outputs``, a list of ``(source, target)``
+    tuples, from the build directory of the variant to their final location
+    using ``copy_file``, if they differ from the file already there. Returns
+    the list of targets that were updated.
+    """
+
+    updated = []
+
+    for source, target in outputs:
+        if not os.path.exists(source):
+            continue
+        if (os.path.exists(target) and
+                os.path.getsize(source) == os.path.getsize(target) and
+                _digest(source) == _digest(target)):
+            continue
+        # Remove the previous file rather than overwriting it, since it may
+        # be loaded by a running process
+        if os.path.exists(target):
+            os.remove(target)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        copy_file(source, target)
+        updated.append(target)
+
+    return updated
@@ -1,13 +1,48 @@
+import copy
 import errno
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from distutils.core import Extension
+from distutils import file_util, log
 from distutils.ccompiler import get_default_compiler
 from distutils.command.build_ext import build_ext as DistutilsBuildExt
+from distutils.errors import DistutilsOptionError
+from distutils.util import get_platform
 
 from ..distutils_helpers import get_main_package_directory
-from ..utils import get_numpy_include_path, import_file
+from ..linker_helpers import (ENV_VARIABLE as FAST_LINKER_ENV_VARIABLE,
+                              FAST_LINKER_MODES, find_fast_linker,
+                              get_linker_flags)
+from ..utils import (get_cpu_count, get_numpy_include_path,
+                     get_user_cache_dir, import_file)
+from ._build_info import (generate_build_info_py, get_compiler_version,
+                          remove_compiler_extension)
+from ._bundled import (BUNDLED_DIRNAME, LibraryCache, SharedObjects,
+                       find_bundled_libraries, link_bundled_library,
+                       setup_shared_objects)
+from ._cython_profile import apply_cython_profile
+from ._cythonize import CACHE_DIRNAME, CythonCache, cythonize_extensions
+from ._depends import DEPENDS_FILENAME, DependencyGraph
+from ._directives import (get_profile_directives, read_directive_profiles,
+                          select_directive_profile)
+from ._manifest import BuildManifest
+from ._isa import (expand_isa_variants, generate_isa_dispatcher,
+                   get_isa_variants, get_module_name, remove_extension_module,
+                   write_isa_sources)
+from ._output import DEBUG_INFO_DIRNAME, OutputSizes, get_output_flags
+from ._objcache import (DEFAULT_MAX_SIZE, OBJECT_CACHE_MODES, ObjectCache,
+                        find_launcher, parse_size, setup_launcher,
+                        setup_object_cache)
+from ._pch import PCH_DIRNAME, PrecompiledHeaders, setup_precompiled_headers
+from ._pgo import (find_pgo_training, get_compiler_family,
+                   get_optimization_flags, merge_clang_profiles, run_training)
+from ._timings import TIMINGS_FILENAME, BuildTimings
+from ._variants import (BUILD_VARIANTS, check_variant, get_variant_build_temp,
+                        get_variant_flags, install_variant_outputs)
+from ._parallel import (call_captured, grouped_log, group_extensions,
+                        replay_log, setup_parallel_compiler)
 
 __all__ = ['AstropyHelpersBuildExt']
 
@@ -43,8 +78,88 @@ class AstropyHelpersBuildExt(DistutilsBuildExt):
     extension options at build time.
     """
 
+    # The --parallel/-j option of the default build_ext command is replaced
+    # by --jobs/-j, although --parallel is still accepted as an alias
+    user_options = [option for option in DistutilsBuildExt.user_options
+                    if option[0] != 'parallel=']
+    user_options.extend([
+        ('parallel=', None, 'alias for --jobs'),
+        ('jobs=', 'j',
+         "number of parallel build jobs, or 'auto' to use all the CPUs "
+         "available (default: auto)"),
+        ('object-cache=', None,
+         "cache compiled object files using 'builtin' (a cache shared "
+         "between builds), 'ccache', 'sccache', 'auto' (ccache or sccache "
+         "if available, otherwise the builtin cache) or 'none' (default: "
+         "$ASTROPY_HELPERS_OBJECT_CACHE or 'none')"),
+        ('object-cache-dir=', None,
+         "directory for the builtin object cache (default: "
+         "$ASTROPY_HELPERS_OBJECT_CACHE_DIR or the 'objects' directory in "
+         "the astropy-helpers user cache directory)"),
+        ('object-cache-size=', None,
+         "maximum size of the builtin object cache, e.g. '500M' (default: "
+         "$ASTROPY_HELPERS_OBJECT_CACHE_SIZE or {0})".format(DEFAULT_MAX_SIZE)),
+        ('library-cache', None,
+         "restore the archives of bundled libraries from a cache shared "
+         "between builds, and store them there once built (default: "
+         "$ASTROPY_HELPERS_LIBRARY_CACHE)"),
+        ('library-cache-dir=', None,
+         "directory for the cache of bundled libraries (default: "
+         "$ASTROPY_HELPERS_LIBRARY_CACHE_DIR or the 'libraries' directory in "
+         "the astropy-helpers user cache directory)"),
+        ('fast-linker=', None,
+         "link the extensions with a faster linker than the default GNU "
+         "linker: 'mold', 'lld', 'gold', 'auto' (the fastest of these that "
+         "works) or 'none' (default: $ASTROPY_HELPERS_FAST_LINKER or "
+         "'none')"),
+        ('optimize-output', None,
+         "build smaller extensions that load faster: hide symbols by default, "
+         "remove unused code and data when linking, and move the debug "
+         "information to separate files (default: "
+         "$ASTROPY_HELPERS_OPTIMIZE_OUTPUT)"),
+        ('debug-info-dir=', None,
+         "directory for the debug information split off with "
+         "--optimize-output (default: {0} in the build directory)".format(
+             DEBUG_INFO_DIRNAME)),
+        ('timings', None,
+         "report the time, CPU time and memory used to build each extension"),
+        ('timings-file=', None,
+         "file to write the JSON report of --timings to (implies --timings; "
+         "default: {0} in the temporary build directory)".format(TIMINGS_FILENAME)),
+        ('pgo', None,
+         "build with profile-guided optimization, using the training "
+         "workloads returned by get_pgo_training() in setup_package.py files"),
+        ('lto', None,
+         "build with link-time optimization across the sources of each "
+         "extension"),
+        ('cython-directives-profile=', None,
+         "profile of Cython directives, defined in a [cython_directives:NAME] "
+         "section of setup.cfg, to translate .pyx files with (default: "
+         "$ASTROPY_HELPERS_CYTHON_DIRECTIVES_PROFILE, or 'debug' for debug "
+         "builds, 'release' for releases and 'dev' or 'release' for "
+         "developer versions, if defined)"),
+        ('cython-profile', None,
+         "translate and compile the Cython extensions with profiling and "
+         "line tracing enabled, in a separate temporary build directory"),
+        ('precompiled-headers', None,
+         "compile the Python and Numpy C API headers once for all the "
+         "sources that include them with the same options, if the compiler "
+         "supports precompiled headers (default: "
+         "$ASTROPY_HELPERS_PRECOMPILED_HEADERS)"),
+        ('variant=', None,
+         "build variant: {0}, each built in its own temporary directory "
+         "(default: $ASTROPY_HELPERS_BUILD_VARIANT, or 'release')".format(
+             ', '.join(BUILD_VARIANTS)))])
+
+    boolean_options = DistutilsBuildExt.boolean_options + [
+        'timings', 'pgo', 'lto', 'precompiled-headers', 'cython-profile',
+        'library-cache', 'optimize-output']
+
     _uses_cython = False
     _force_rebuild = False
+    _pgo_family = None
+    _linker = None
+    _output_sizes = None
 
     def __new__(cls, value, **kwargs):
 
@@ -71,6 +186,26 @@ class AstropyHelpersBuildExt(DistutilsBuildExt):
 
         return obj
 
+    def initialize_options(self):
+        super().initialize_options()
+        self.jobs = None
+        self.object_cache = None
+        self.object_cache_dir = None
+        self.object_cache_size = None
+        self.library_cache = None
+        self.library_cache_dir = None
+        self.fast_linker = None
+        self.optimize_output = None
+        self.debug_info_dir = None
+        self.timings = False
+        self.timings_file = None
+        self.pgo = False
+        self.lto = False
+        self.variant = None
+        self.precompiled_headers = None
+        self.cython_profile = False
+        self.cython_directives_profile = None
+
     def finalize_options(self):
 
         # First let's find the package folder, then we can check if the
@@ -90,38 +225,171 @@ class AstropyHelpersBuildExt(DistutilsBuildExt):
 
         self._uses_cython = should_build_with_cython(self.previous_cython_version, self.is_release)
 
-        # Add a copy of the _compiler.so module as well, but only if there
-        # are in fact C modules to compile (otherwise there's no reason to
-        # include a record of the compiler used). Note that self.extensions
-        # may not be set yet, but self.distribution.ext_modules is where any
-        # extension modules passed to setup() can be found
-        extensions = self.distribution.ext_modules
-        if extensions:
-            build_py = self.get_finalized_command('build_py')
-            package_dir = build_py.get_package_dir(self.package_dir)
-            src_path = os.path.relpath(
-                os.path.join(os.path.dirname(__file__), 'src'))
-            shutil.copy(os.path.join(src_path, 'compiler.c'),
-                        os.path.join(package_dir, '_compiler.c'))
-            ext = Extension(self.package_dir + '.compiler_version',
-                            [os.path.join(package_dir, '_compiler.c')])
-            extensions.insert(0, ext)
+        # Extensions marked with add_isa_variants are replaced by a variant
+        # for each instruction set level (see _isa.py)
+        if self.distribution.ext_modules:
+            self.distribution.ext_modules = expand_isa_variants(
+                self.distribution.ext_modules,
+                self.plat_name or get_platform(),
+                self.compiler or get_default_compiler())
 
         super().finalize_options()
 
-        # If we are using Cython, then make sure we re-build if the version
-        # of Cython that is installed is different from the version last
-        # used to generate the C files.
-        if self._uses_cython and self._uses_cython != self.previous_cython_version:
-            self._force_rebuild = True
+        # Each variant is built in its own temporary directory, so that
+        # switching between e.g. debug and release builds reuses the previous
+        # build of that variant rather than forcing a rebuild. --debug on its
+        # own does not select the debug variant, so that it still only adds
+        # debug information, without changing the optimization level or
+        # NDEBUG, but is built in its own directory too (e.g. release-g)
+        if self.variant is None:
+            self.variant = (os.environ.get('ASTROPY_HELPERS_BUILD_VARIANT') or
+                            'release')
+        self.variant = self.variant.lower()
+        check_variant(self.variant)
+        if self.variant == 'debug':
+            self.debug = True
+        self.build_temp = get_variant_build_temp(self.build_temp, self.variant,
+                                                 self.debug)
 
-        # Regardless of the value of the '--force' option, force a rebuild
-        # if the debug flag changed from the last build
+        # The profile of Cython directives depends on whether this is a debug
+        # build and/or a release
+        if self.cython_directives_profile is None:
+            self.cython_directives_profile = os.environ.get(
+                'ASTROPY_HELPERS_CYTHON_DIRECTIVES_PROFILE')
+        self._directive_profiles = read_directive_profiles()
+        self.cython_directives_profile = select_directive_profile(
+            self._directive_profiles, self.cython_directives_profile,
+            debug=self.debug, is_release=self.is_release)
+
+        # Profiling builds need Cython even for releases, since the C files
+        # included in source distributions are not generated with tracing
+        # enabled, and are kept in a separate temporary directory since they
+        # are much slower
+        if self.cython_profile:
+            try:
+                from Cython import __version__ as cython_version
+            except ImportError:
+                raise DistutilsOptionError(
+                    '--cython-profile requires Cython to be installed')
+            self._uses_cython = cython_version
+            self.build_temp = '{0}-cython-profile'.format(self.build_temp)
+
+        # Note that changing the version of Cython does not force a rebuild
+        # of all extensions: the version of Cython is part of the key under
+        # which generated files are cached (see _cythonize.py), so the .pyx
+        # files are translated again, and only the extensions whose generated
+        # C files change are rebuilt.
+
+        # Keep track of whether a rebuild was explicitly requested, since
+        # otherwise extensions whose inputs are unchanged are not rebuilt
+        # even if self.force is set below (see build_extension)
+        self._user_force = bool(self.force)
+
+        # Regardless of the value of the '--force' option, force a rebuild if
+        # this was requested by setting _force_rebuild on the class (which
+        # get_debug_option used to do when the debug flag changed)
         if self._force_rebuild:
             self.force = True
 
+        # The number of jobs defaults to the value of --parallel (which may
+        # have been set through the build command) and otherwise to 'auto'
+        if self.jobs is None:
+            self.jobs = self.parallel or 'auto'
+
+        if self.jobs == 'auto':
+            self.jobs = get_cpu_count()
+        else:
+            try:
+                self.jobs = int(self.jobs)
+            except ValueError:
+                raise DistutilsOptionError(
+                    "--jobs should be an integer or 'auto'")
+            if self.jobs < 1:
+                raise DistutilsOptionError("--jobs should be at least 1")
+
+        # Cython's build_ext uses this when cythonizing in parallel
+        self.parallel = self.jobs if self.jobs > 1 else None
+
+        if self.object_cache is None:
+            self.object_cache = os.environ.get('ASTROPY_HELPERS_OBJECT_CACHE',
+                                               'none')
+        self.object_cache = self.object_cache.lower()
+        if self.object_cache not in OBJECT_CACHE_MODES:
+            raise DistutilsOptionError(
+                '--object-cache should be one of {0}'.format(
+                    ', '.join(OBJECT_CACHE_MODES)))
+
+        if self.object_cache_size is None:
+            self.object_cache_size = os.environ.get(
+                'ASTROPY_HELPERS_OBJECT_CACHE_SIZE', DEFAULT_MAX_SIZE)
+        self.object_cache_size = parse_size(self.object_cache_size)
+
+        if self.precompiled_headers is None:
+            self.precompiled_headers = os.environ.get(
+                'ASTROPY_HELPERS_PRECOMPILED_HEADERS', '').lower() in (
+                    '1', 'true', 'yes', 'on')
+
+        if self.fast_linker is None:
+            self.fast_linker = os.environ.get(FAST_LINKER_ENV_VARIABLE,
+                                              'none')
+        self.fast_linker = self.fast_linker.lower()
+        if self.fast_linker not in FAST_LINKER_MODES:
+            raise DistutilsOptionError(
+                '--fast-linker should be one of {0}'.format(
+                    ', '.join(FAST_LINKER_MODES)))
+
+        if self.optimize_output is None:
+            self.optimize_output = os.environ.get(
+                'ASTROPY_HELPERS_OPTIMIZE_OUTPUT', '').lower() in (
+                    '1', 'true', 'yes', 'on')
+
+        if self.debug_info_dir is None:
+            build = self.get_finalized_command('build')
+            self.debug_info_dir = os.path.join(build.build_base,
+                                               DEBUG_INFO_DIRNAME)
+
+        if self.library_cache is None:
+            self.library_cache = os.environ.get(
+                'ASTROPY_HELPERS_LIBRARY_CACHE', '').lower() in (
+                    '1', 'true', 'yes', 'on')
+
+        if self.timings_file is not None:
+            self.timings = True
+        elif self.timings:
+            self.timings_file = os.path.join(self.build_temp, TIMINGS_FILENAME)
+
+        if self.pgo:
+            # Profiles change without the inputs of the extensions changing,
+            # so all extensions are always rebuilt (see build_extension), and
+            # the object cache can't be used since it doesn't know about the
+            # profiles either
+            if self.object_cache != 'none':
+                log.warn('the object cache is disabled when building with '
+                         '--pgo')
+                self.object_cache = 'none'
+
+        # The stage of the PGO build, if any (see _run_pgo)
+        self._pgo_stage = None
+
     def run(self):
 
+        # The graph of dependencies between source files is used both to
+        # decide whether .pyx files need to be cythonized again, and whether
+        # extensions need to be rebuilt
+        self._depends = DependencyGraph(os.path.join(self.build_temp,
+                                                     DEPENDS_FILENAME))
+        self._manifest = BuildManifest(self.build_temp, self._depends)
+        self._timings = BuildTimings() if self.timings else None
+
+        # The C libraries bundled with the package are built in
+        # build_extensions, once the compiler is set up
+        if self.extensions:
+            srcdir = (self.distribution.package_dir or {}).get('', '.')
+            self._bundled_libraries = find_bundled_libraries(
+                srcdir, self.distribution.packages or [])
+        else:
+            self._bundled_libraries = []
+
         # For extensions that require 'numpy' in their include dirs,
         # replace 'numpy' with the actual paths
         np_include = None
@@ -134,12 +402,59 @@ class AstropyHelpersBuildExt(DistutilsBuildExt):
                 extension.include_dirs.remove('numpy')
 
             self._check_cython_sources(extension)
+            self._add_cython_depends(extension)
+            if self.cython_profile:
+                apply_cython_profile(extension)
+
+        # Translate all the .pyx files up front, in parallel, rather than
+        # letting Cython's build_ext translate them one by one. This replaces
+        # the .pyx sources with the generated C/C++ files.
+        if self._uses_cython:
+            self._profile_directives = dict(
+                (ext.name, get_profile_directives(
+                    self._directive_profiles, self.cython_directives_profile,
+                    get_module_name(ext))) for ext in self.extensions)
+            cache = CythonCache(os.path.join(self.build_temp, CACHE_DIRNAME),
+                                self._depends, self._manifest.file_digest)
+            # The C files generated for profiling are kept out of the source
+            # tree, since they should not end up in source distributions
+            target_dir = (os.path.join(self.build_temp, 'src')
+                          if self.cython_profile else None)
+            cythonize_extensions(self, self.extensions, cache, jobs=self.jobs,
+                                 force=self._user_force, timings=self._timings,
+                                 target_dir=target_dir)
 
-        # Note that setuptools automatically uses Cython to discover and
-        # build extensions if available, so we don't have to explicitly call
-        # e.g. cythonize.
+        # The variants of multi-versioned extensions are compiled from
+        # wrappers of their sources, so that each has its own object files
+        for ext in self.extensions:
+            if getattr(ext, '_isa_level', None):
+                write_isa_sources(ext, self.build_temp, dry_run=self.dry_run)
 
-        super().run()
+        # The extensions are built into the temporary directory of the
+        # variant, and then copied to the build directory or, for in-place
+        # builds, to the source tree
+        outputs = [self.get_ext_fullpath(ext.name) for ext in self.extensions]
+        original = (self.build_lib, self.inplace)
+        self.build_lib = os.path.join(self.build_temp, 'lib')
+        self.inplace = False
+
+        try:
+            if self.pgo and self.extensions:
+                self._run_pgo()
+            else:
+                super().run()
+            outputs = list(zip([self.get_ext_fullpath(ext.name)
+                                for ext in self.extensions], outputs))
+        finally:
+            self.build_lib, self.inplace = original
+            if self.extensions and not self.dry_run:
+                self._manifest.save()
+                self._depends.save()
+            if self._timings is not None and self.extensions:
+                log.info(self._timings.write(self, self.timings_file))
+
+        if not self.dry_run:
+            install_variant_outputs(outputs, self._copy_output)
 
         # Update cython_version.py if building with Cython
 
@@ -159,6 +474,552 @@ class AstropyHelpersBuildExt(DistutilsBuildExt):
                                os.path.join(self.build_lib, cython_py),
                                preserve_mode=False)
 
+        # Record how the extensions were built, but only if there are in
+        # fact extensions (otherwise there is no reason to include a record
+        # of the compiler used)
+        if self.extensions and not self.dry_run:
+            build_py = self.get_finalized_command('build_py')
+            package_dir = build_py.get_package_dir(self.package_dir)
+            if self.cython_profile and not self.inplace:
+                # Profiling builds done outside of the source tree (by the
+                # cython_profile command) should not change the record of the
+                # extensions built in place
+                info_dir = os.path.join(self.build_lib, package_dir)
+                os.makedirs(info_dir, exist_ok=True)
+                generate_build_info_py(self, info_dir)
+            else:
+                for filename in generate_build_info_py(self, package_dir):
+                    if os.path.isdir(self.build_lib):
+                        self.copy_file(filename,
+                                       os.path.join(self.build_lib, filename),
+                                       preserve_mode=False)
+            if os.path.isdir(self.build_lib):
+                remove_compiler_extension(os.path.join(self.build_lib,
+                                                       package_dir))
+
+            # Multi-versioned extensions are imported through a dispatcher
+            # module which loads the best variant for the CPU. It is only
+            # written to (and extension modules it replaces only removed
+            # from) the source tree for in-place builds.
+            for name, levels in get_isa_variants(self.extensions).items():
+                package_dir = build_py.get_package_dir(name.rpartition('.')[0])
+                if self.inplace:
+                    filename = generate_isa_dispatcher(name, levels,
+                                                       package_dir)
+                    if not os.path.isdir(self.build_lib):
+                        continue
+                    self.copy_file(filename,
+                                   os.path.join(self.build_lib, filename),
+                                   preserve_mode=False)
+                    remove_extension_module(
+                        os.path.join(self.build_lib, package_dir),
+                        name.rpartition('.')[2])
+                else:
+                    lib_dir = os.path.join(self.build_lib, package_dir)
+                    os.makedirs(lib_dir, exist_ok=True)
+                    generate_isa_dispatcher(name, levels, lib_dir)
+
+    def get_export_symbols(self, ext):
+
+        # The variants of multi-versioned extensions define the
+        # initialization function of the extension they are built from
+        if getattr(ext, '_isa_base', None):
+            initfunc_name = 'PyInit_' + ext._isa_base.split('.')[-1]
+            if initfunc_name not in ext.export_symbols:
+                ext.export_symbols.append(initfunc_name)
+            return ext.export_symbols
+
+        return super().get_export_symbols(ext)
+
+    def _copy_output(self, source, target):
+        """
+        Copy a built extension to its final location, regardless of the
+        timestamps of the files.
+        """
+
+        file_util.copy_file(source, target, preserve_times=False,
+                            update=False, verbose=self.verbose)
+
+    def _run_pgo(self):
+        """
+        Build the extensions with profile-guided optimization: first with
+        instrumentation, then run the training workloads, and finally build
+        the extensions again using the collected profiles.
+        """
+
+        srcdir = (self.distribution.package_dir or {}).get('', '.')
+        training = find_pgo_training(srcdir, self.distribution.packages or [])
+        if not training:
+            raise DistutilsOptionError(
+                '--pgo requires a get_pgo_training() function in at least '
+                'one setup_package.py file')
+
+        # Both builds use the same temporary directory, since GCC names the
+        # profiles after the paths of the object files
+        pgo_dir = os.path.join(self.build_temp, 'pgo')
+        profile_dir = os.path.abspath(os.path.join(pgo_dir, 'profiles'))
+        instrumented_lib = os.path.join(pgo_dir, 'lib')
+
+        if os.path.isdir(profile_dir) and not self.dry_run:
+            shutil.rmtree(profile_dir)
+
+        original = (self.compiler, self.build_lib, self.build_temp,
+                    self.inplace)
+
+        try:
+            log.info('building instrumented extensions for profile-guided '
+                     'optimization')
+            self._pgo_stage = ('generate', profile_dir)
+            self.build_lib = instrumented_lib
+            self.build_temp = os.path.join(pgo_dir, 'temp')
+            self.inplace = False
+            super().run()
+
+            # The training workloads need the pure-Python modules too
+            build_py = self.reinitialize_command('build_py')
+            build_py.build_lib = instrumented_lib
+            build_py.ensure_finalized()
+            build_py.run()
+            self.reinitialize_command('build_py')
+
+            if not self.dry_run:
+                run_training(instrumented_lib, training)
+                if self._pgo_family == 'clang':
+                    merge_clang_profiles(
+                        profile_dir, get_compiler_version(self.compiler)[1])
+
+            log.info('building extensions using the collected profiles')
+            self._pgo_stage = ('use', profile_dir)
+            self.compiler = original[0]
+            self.build_lib = original[1]
+            self.inplace = original[3]
+            super().run()
+        finally:
+            self._pgo_stage = None
+            (self.compiler, self.build_lib, self.build_temp,
+             self.inplace) = original
+
+    def build_extensions(self):
+
+        # Precompiled headers are set up first, so that the object cache
+        # (which hashes the preprocessed sources) does not depend on them
+        precompiled_headers = self._setup_precompiled_headers()
+        object_cache = self._setup_object_cache()
+
+        # The jobserver is set up before anything is compiled, so that the
+        # sources of the bundled libraries share it with the extensions
+        if self.jobs > 1:
+            self._setup_parallel_compiler()
+
+        if self._timings is not None:
+            self._setup_timings()
+
+        shared_objects = self._setup_shared_objects()
+
+        # The debug information is only split off the final extensions, not
+        # those instrumented to collect PGO profiles
+        if (self.optimize_output and not self.dry_run and
+                self.compiler.compiler_type != 'msvc' and
+                (self._pgo_stage is None or self._pgo_stage[0] == 'use')):
+            self._output_sizes = OutputSizes(self.debug_info_dir)
+        else:
+            self._output_sizes = None
+
+        # Add the flags for the variant, and for --pgo and --lto, for the
+        # duration of this build only, since the flags differ between the
+        # stages of a PGO build
+        flags = self._get_optimization_flags()
+        compile_args, link_args = get_variant_flags(
+            self.variant, self.compiler.compiler_type)
+        link_args = link_args + self._get_linker_flags()
+        if self.optimize_output:
+            output_compile_args, output_link_args = get_output_flags(
+                self.compiler.compiler_type)
+            compile_args = compile_args + output_compile_args
+            link_args = link_args + output_link_args
+        original_args = [(ext.extra_compile_args, ext.extra_link_args)
+                         for ext in self.extensions]
+        for ext in self.extensions:
+            ext.extra_compile_args = (list(ext.extra_compile_args or []) +
+                                      compile_args + flags)
+            ext.extra_link_args = (list(ext.extra_link_args or []) +
+                                   link_args + flags)
+
+        try:
+            self._build_bundled_libraries(compile_args + flags)
+            if self.jobs <= 1:
+                super().build_extensions()
+            else:
+                self._build_extensions_parallel()
+        finally:
+            for ext, (compile_args, link_args) in zip(self.extensions,
+                                                      original_args):
+                ext.extra_compile_args = compile_args
+                ext.extra_link_args = link_args
+            if object_cache is not None:
+                log.info(object_cache.finish())
+            if precompiled_headers is not None:
+                log.info(precompiled_headers.summary())
+            if shared_objects is not None and shared_objects.reused:
+                log.info(shared_objects.summary())
+            if self._output_sizes is not None and self._output_sizes.sizes:
+                log.info(self._output_sizes.summary())
+
+    def _get_linker_flags(self):
+        """
+        Returns the linker flags needed for --fast-linker, and sets the linker
+        recorded in the build_info module.
+        """
+
+        self._linker = None
+
+        if self.fast_linker == 'none' or self.dry_run:
+            return []
+
+        if self.compiler.compiler_type == 'msvc':
+            log.warn("--fast-linker can't be used with the 'msvc' compiler")
+            return []
+
+        self._linker = find_fast_linker(self.fast_linker)
+        if self._linker is None:
+            if self.fast_linker == 'auto':
+                log.warn('none of the faster linkers could be used, using the '
+                         'default linker')
+            else:
+                log.warn('the {0} linker could not be used, using the default '
+                         'linker'.format(self.fast_linker))
+            return []
+
+        log.info('linking extensions with {0}'.format(self._linker))
+        return get_linker_flags(self._linker)
+
+    def _get_optimization_flags(self):
+        """
+        Returns the compiler and linker flags needed for --pgo and --lto.
+        """
+
+        if not self._pgo_stage and not self.lto:
+            return []
+
+        self._pgo_family = get_compiler_family(self.compiler)
+
+        pgo_stage, profile_dir = self._pgo_stage or (None, None)
+        return get_optimization_flags(self._pgo_family, pgo_stage=pgo_stage,
+                                      profile_dir=profile_dir, lto=self.lto)
+
+    def _setup_timings(self):
+        """
+        Set up the compiler(s) to record the resources used by each compile
+        and link step for the --timings option.
+        """
+
+        compilers = [self.compiler]
+        if getattr(self, 'shlib_compiler', None) is not None:
+            compilers.append(self.shlib_compiler)
+
+        for compiler in compilers:
+            # Make sure the compiler processes are run by run_command, which
+            # records their CPU time and memory usage, even when not building
+            # in parallel
+            if self.jobs <= 1:
+                setup_parallel_compiler(compiler, 1,
+                                        threading.BoundedSemaphore(1))
+            self._timings.setup_compiler(compiler)
+
+    def _setup_parallel_compiler(self):
+        """
+        Set up the compiler(s) to compile the sources of each extension or
+        bundled library on a thread pool, limiting the total number of
+        compiler/linker processes across all of them to the number of jobs.
+        """
+
+        compilers = [self.compiler]
+        if getattr(self, 'shlib_compiler', None) is not None:
+            compilers.append(self.shlib_compiler)
+
+        jobserver = threading.BoundedSemaphore(self.jobs)
+        for compiler in compilers:
+            setup_parallel_compiler(compiler, self.jobs, jobserver)
+
+    def _setup_shared_objects(self):
+        """
+        Set up the compiler(s) so that sources compiled with the same
+        arguments by several extensions are only compiled once.
+        """
+
+        if self.dry_run:
+            return None
+
+        compilers = [self.compiler]
+        if getattr(self, 'shlib_compiler', None) is not None:
+            compilers.append(self.shlib_compiler)
+
+        shared_objects = SharedObjects()
+        for compiler in compilers:
+            if not setup_shared_objects(compiler, shared_objects):
+                return None
+
+        return shared_objects
+
+    def _build_bundled_libraries(self, extra_args):
+        """
+        Build the static archive of each bundled library used by the
+        extensions (unless it is up to date), and link it into them.
+        """
+
+        lib_dir = os.path.join(self.build_temp, BUNDLED_DIRNAME)
+        library_cache = self._get_library_cache()
+
+        for library in self._bundled_libraries:
+            archive = os.path.join(
+                lib_dir, self.compiler.library_filename(library.name))
+            dependents = [ext.name for ext in self.extensions
+                          if link_bundled_library(ext, library, archive)]
+            if not dependents:
+                log.warn("the bundled library '{0}' is not used by any "
+                         "extension".format(library.name))
+                continue
+
+            # The library is built with the same flags as the extensions
+            library = copy.copy(library)
+            library.extra_compile_args = (library.extra_compile_args +
+                                          list(extra_args))
+
+            key = 'bundled:' + library.name
+            digest = self._manifest.extension_digest(library, self.compiler,
+                                                     debug=self.debug)
+            if (not self._user_force and not self.pgo and
+                    self._manifest.is_up_to_date(key, digest, archive)):
+                log.info("skipping bundled library '{0}' "
+                         "(unchanged)".format(library.name))
+                continue
+
+            if library_cache is not None:
+                cache_key = library_cache.key(library, self.compiler,
+                                              debug=self.debug)
+                if library_cache.fetch(library.name, cache_key, archive):
+                    log.info("restored bundled library '{0}' from the "
+                             "library cache".format(library.name))
+                    self._manifest.invalidate(archive)
+                    self._manifest.record(key, digest)
+                    continue
+
+            log.info("building bundled library '{0}' for {1}".format(
+                library.name, ', '.join(dependents)))
+
+            if self.dry_run:
+                continue
+
+            objects = self.compiler.compile(
+                library.sources, output_dir=self.build_temp,
+                macros=library.define_macros,
+                include_dirs=library.include_dirs, debug=self.debug,
+                extra_postargs=library.extra_compile_args,
+                depends=library.depends)
+
+            # Members of a previous archive would otherwise be kept
+            if os.path.exists(archive):
+                os.remove(archive)
+            self.compiler.create_static_lib(objects, library.name,
+                                            output_dir=lib_dir,
+                                            debug=self.debug)
+
+            self._manifest.invalidate(archive)
+            self._manifest.record(key, digest)
+
+            if library_cache is not None:
+                library_cache.store(library.name, cache_key, archive)
+
+    def _get_library_cache(self):
+        """
+        Returns the cache of bundled libraries if enabled with the
+        --library-cache option.
+        """
+
+        # Archives built for PGO depend on the profiles, which are not part
+        # of the key
+        if not self.library_cache or self.pgo or self.dry_run:
+            return None
+
+        cache_dir = (self.library_cache_dir or
+                     os.environ.get('ASTROPY_HELPERS_LIBRARY_CACHE_DIR'))
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        else:
+            cache_dir = get_user_cache_dir('libraries')
+
+        return LibraryCache(cache_dir, self._manifest)
+
+    def _setup_precompiled_headers(self):
+        """
+        Set up the compiler(s) to use precompiled headers if enabled with the
+        --precompiled-headers option, and return the precompiled headers.
+        """
+
+        if not self.precompiled_headers or self.dry_run:
+            return None
+
+        compilers = [self.compiler]
+        if getattr(self, 'shlib_compiler', None) is not None:
+            compilers.append(self.shlib_compiler)
+
+        precompiled_headers = PrecompiledHeaders(
+            os.path.join(self.build_temp, PCH_DIRNAME))
+        for compiler in compilers:
+            if not setup_precompiled_headers(compiler, precompiled_headers):
+                log.warn("precompiled headers can't be used with the "
+                         "'{0}' compiler".format(compiler.compiler_type))
+                return None
+
+        return precompiled_headers
+
+    def _setup_object_cache(self):
+        """
+        Set up the compiler(s) to use the object cache selected with the
+        --object-cache option, and return the builtin cache if it is used.
+        """
+
+        if self.object_cache == 'none' or self.dry_run:
+            return None
+
+        compilers = [self.compiler]
+        if getattr(self, 'shlib_compiler', None) is not None:
+            compilers.append(self.shlib_compiler)
+
+        launcher = find_launcher(self.object_cache)
+        if launcher is not None:
+            log.info('using {0} to cache object files'.format(launcher))
+            for compiler in compilers:
+                setup_launcher(compiler, launcher)
+            return None
+
+        cache_dir = (self.object_cache_dir or
+                     os.environ.get('ASTROPY_HELPERS_OBJECT_CACHE_DIR'))
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        else:
+            cache_dir = get_user_cache_dir('objects')
+
+        object_cache = ObjectCache(cache_dir, self.object_cache_size)
+        for compiler in compilers:
+            if not setup_object_cache(compiler, object_cache):
+                log.warn("the builtin object cache can't be used with the "
+                         "'{0}' compiler".format(compiler.compiler_type))
+                return None
+
+        return object_cache
+
+    def build_extension(self, ext):
+
+        if self._timings is None:
+            self._build_extension(ext)
+        else:
+            self._timings.build_extension(ext.name, self._build_extension, ext)
+
+    def _build_extension(self, ext):
+        """
+        Build the extension ``ext`` unless it is up to date, and return whether
+        it was built.
+        """
+
+        # Skip extensions whose sources, included headers, and build options
+        # have not changed since the last build, even if file timestamps say
+        # otherwise
+        ext_path = self.get_ext_fullpath(ext.name)
+        digest = self._manifest.extension_digest(ext, self.compiler,
+                                                 debug=self.debug)
+
+        if (not self._user_force and not self.pgo and
+                self._manifest.is_up_to_date(ext.name, digest, ext_path)):
+            log.info("skipping '{0}' extension (unchanged)".format(ext.name))
+            return False
+
+        # Conversely, make sure distutils doesn't consider the extension to be
+        # up to date based on the timestamps if e.g. only a header changed
+        if os.path.exists(ext_path) and not self.dry_run:
+            os.remove(ext_path)
+
+        super().build_extension(ext)
+
+        if self._output_sizes is not None and os.path.exists(ext_path):
+            self._output_sizes.process(ext.name, ext_path)
+
+        self._manifest.record(ext.name, digest)
+
+        return True
+
+    def _build_extensions_parallel(self):
+        """
+        Build the extensions on a thread pool. The output for each extension
+        is shown in the order in which the extensions are defined, and
+        failures are reported in that order too, regardless of which
+        extension finished first.
+        """
+
+        self.check_extensions_list(self.extensions)
+
+        # setuptools swaps self.compiler while building Library extensions,
+        # so these need to be built on their own
+        from setuptools.extension import Library
+
+        extensions = [ext for ext in self.extensions
+                      if not isinstance(ext, Library)]
+
+        for ext in self.extensions:
+            if isinstance(ext, Library):
+                with self._filter_build_errors(ext):
+                    self.build_extension(ext)
+
+        def build_group(group):
+            return [call_captured(self.build_extension, ext) for ext in group]
+
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+        with grouped_log(), executor:
+
+            # Extensions sharing source files are built one after the other
+            # since they would otherwise overwrite each other's object files
+            results = {}
+            for group in group_extensions(extensions):
+                future = executor.submit(build_group, group)
+                for index, ext in enumerate(group):
+                    results[id(ext)] = (future, index)
+
+            try:
+                for ext in extensions:
+                    future, index = results[id(ext)]
+                    records, exc = future.result()[index]
+                    replay_log(records)
+                    with self._filter_build_errors(ext):
+                        if exc is not None:
+                            raise exc
+            except BaseException:
+                # Don't start building any more extensions
+                for future, index in results.values():
+                    future.cancel()
+                raise
+
+    def _add_cython_depends(self, extension):
+        """
+        Add the .pxd and .pxi files that the .pyx sources of an extension
+        depend on (directly or through other .pxd files) to its ``depends``,
+        so that Cython regenerates the C files when any of these change.
+        """
+
+        search_dirs = (list(extension.include_dirs) +
+                       list(getattr(extension, 'cython_include_dirs', None) or []) +
+                       list(getattr(self, 'cython_include_dirs', None) or []))
+
+        depends = list(extension.depends or [])
+        for src in extension.sources:
+            if not src.endswith('.pyx'):
+                continue
+            for dependency in self._depends.dependencies(src, search_dirs):
+                if dependency not in depends:
+                    depends.append(dependency)
+
+        extension.depends = depends
+
     def _check_cython_sources(self, extension):
         """
         Where relevant, make sure that the .c files associated with .pyx
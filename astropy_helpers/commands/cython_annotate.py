@@ -0,0 +1,135 @@
+"""
+Provides the ``cython_annotate`` command, which annotates all the .pyx files
+of the package with Cython (as with ``cython -a``) in parallel, and writes a
+ranked report of the functions and loops with the most interaction with the
+Python C API.
+"""
+
+import json
+import os
+
+from setuptools import Command
+from distutils import log
+from distutils.errors import DistutilsModuleError, DistutilsOptionError
+
+from ..utils import get_cpu_count
+from ._annotate import (annotate_sources, build_report,
+                        parse_annotation_html, write_report)
+from ._cythonize import get_cython_options
+from ._directives import get_profile_directives
+from ._isa import get_module_name
+
+__all__ = ['AstropyCythonAnnotate']
+
+
+class AstropyCythonAnnotate(Command):
+    """
+    Annotate the Cython sources of the package and report the functions and
+    loops with the highest annotation scores.
+    """
+
+    description = ('annotate the Cython sources and report the functions and '
+                   'loops with the most interaction with the Python C API')
+
+    user_options = [
+        ('output=', 'o',
+         "base name of the text (.txt) and JSON (.json) reports (default: "
+         "cython_annotate in the build directory)"),
+        ('compare=', None,
+         "JSON report of a previous run to compare the scores with"),
+        ('limit=', None,
+         "number of functions and loops to include in the text report "
+         "(default: 20)"),
+        ('jobs=', 'j',
+         "number of parallel jobs (default: the number of CPUs available)")]
+
+    def initialize_options(self):
+        self.output = None
+        self.compare = None
+        self.limit = None
+        self.jobs = None
+
+    def finalize_options(self):
+
+        build = self.get_finalized_command('build')
+        self.build_dir = os.path.join(build.build_base, 'cython_annotate')
+
+        if self.output is None:
+            self.output = os.path.join(build.build_base, 'cython_annotate')
+
+        try:
+            self.limit = int(self.limit or 20)
+            self.jobs = int(self.jobs or get_cpu_count())
+        except ValueError:
+            raise DistutilsOptionError('--limit and --jobs should be integers')
+
+    def _get_tasks(self):
+        """
+        Returns the ``(source, target, options)`` tuples for the .pyx files
+        of all the extensions.
+        """
+
+        build_ext = self.get_finalized_command('build_ext')
+
+        tasks = []
+        seen = set()
+
+        for ext in build_ext.extensions:
+            options = get_cython_options(build_ext, ext)
+            # Use the same directives as a build would
+            directives = get_profile_directives(
+                build_ext._directive_profiles,
+                build_ext.cython_directives_profile, get_module_name(ext))
+            directives.update(options['compiler_directives'])
+            options['compiler_directives'] = directives
+            target_ext = '.cpp' if options['cplus'] else '.c'
+
+            for source in ext.sources:
+                # The sources may be given as the generated C/C++ files
+                source = os.path.splitext(source)[0] + '.pyx'
+                if source in seen or not os.path.isfile(source):
+                    continue
+                seen.add(source)
+                target = os.path.join(self.build_dir,
+                                      os.path.splitext(source)[0] + target_ext)
+                tasks.append((source, target, options))
+
+        return tasks
+
+    def run(self):
+
+        try:
+            import Cython  # noqa
+        except ImportError:
+            raise DistutilsModuleError(
+                'Cython needs to be installed to run cython_annotate')
+
+        previous = None
+        if self.compare is not None:
+            with open(self.compare) as f:
+                previous = json.load(f)
+
+        tasks = self._get_tasks()
+
+        if self.dry_run:
+            return
+
+        annotate_sources(tasks, jobs=self.jobs)
+
+        sources = []
+        for source, target, options in tasks:
+            with open(source, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            scores = parse_annotation_html(os.path.splitext(target)[0] +
+                                           '.html')
+            sources.append((source, lines, scores))
+
+        report = build_report(sources)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.output)),
+                    exist_ok=True)
+        log.info(write_report(report, self.output, limit=self.limit,
+                              previous=previous))
+        log.info('The reports were written to {0}.txt and {0}.json, and the '
+                 'annotated sources to {1}'.format(self.output,
+                                                   self.build_dir))
@@ -0,0 +1,100 @@
+"""
+Provides the ``cython_profile`` command, which builds the package into its own
+build directory with profiling and line tracing enabled for the Cython
+extensions (see the --cython-profile option of ``build_ext``), runs a workload
+with this build, and writes a ranked report of the Cython functions and lines
+in which most time was spent.
+"""
+
+import os
+
+from setuptools import Command
+from distutils import log
+from distutils.errors import DistutilsOptionError
+
+from ._cython_profile import parse_workload, run_workloads, write_report
+from ._pgo import find_pgo_training
+
+__all__ = ['AstropyCythonProfile']
+
+
+class AstropyCythonProfile(Command):
+    """
+    Profile the Cython extensions of the package with a workload.
+    """
+
+    description = ('build the Cython extensions with profiling enabled, run '
+                   'a workload and report the hottest Cython functions and '
+                   'lines')
+
+    user_options = [
+        ('workload=', None,
+         "Python script, or 'module:function' callable, to profile "
+         "(default: the get_pgo_training() workloads of setup_package.py "
+         "files)"),
+        ('output=', 'o',
+         "file to write the report to (default: cython_profile.txt in the "
+         "build directory)"),
+        ('limit=', None,
+         "number of functions and lines to include in the report "
+         "(default: 20)")]
+
+    def initialize_options(self):
+        self.workload = None
+        self.output = None
+        self.limit = None
+
+    def finalize_options(self):
+
+        if self.output is None:
+            build = self.get_finalized_command('build')
+            self.output = os.path.join(build.build_base, 'cython_profile.txt')
+
+        try:
+            self.limit = int(self.limit or 20)
+        except ValueError:
+            raise DistutilsOptionError('--limit should be an integer')
+
+        if self.workload is not None:
+            self.workloads = [parse_workload(self.workload)]
+        else:
+            srcdir = (self.distribution.package_dir or {}).get('', '.')
+            self.workloads = [
+                ('training', (os.path.abspath(filename), module_name))
+                for module_name, filename in find_pgo_training(
+                    srcdir, self.distribution.packages or [])]
+            if not self.workloads:
+                raise DistutilsOptionError(
+                    '--workload is required unless a setup_package.py file '
+                    'defines get_pgo_training()')
+
+    def run(self):
+
+        # The package is built into its own directory, so that the extensions
+        # built in place (or in the regular build directory) are left as they
+        # are
+        build = self.get_finalized_command('build')
+        lib_dir = '{0}-cython-profile'.format(build.build_lib)
+
+        build_py = self.reinitialize_command('build_py')
+        build_py.build_lib = lib_dir
+        self.run_command('build_py')
+
+        build_ext = self.reinitialize_command('build_ext')
+        build_ext.inplace = False
+        build_ext.build_lib = lib_dir
+        build_ext.cython_profile = True
+        self.run_command('build_ext')
+
+        # Other commands should not use the profiling build
+        self.reinitialize_command('build_py')
+        self.reinitialize_command('build_ext')
+
+        if self.dry_run:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.output)),
+                    exist_ok=True)
+
+        run_workloads(self.workloads, lib_dir, self.output)
+        log.info(write_report(self.output, limit=self.limit))
@@ -0,0 +1,361 @@
+# This module defines functions that can be used to check which CPU-specific
+# optimization flags (such as -march=native, or the flags enabling the AVX2,
+# FMA and AVX-512 instruction sets) are supported by the compiler and by the
+# CPU of the build machine. To use this, import the
+# add_cpu_optimization_flags_if_available function in a setup_package.py file
+# where you are defining your extensions:
+#
+#     from astropy_helpers.cpu_helpers import add_cpu_optimization_flags_if_available
+#
+# then call it with an extension as the first argument:
+#
+#     add_cpu_optimization_flags_if_available(extension)
+#
+# this will add the best supported set of flags, and record them in a
+# cpu_optimization.py module in the package of the extension.
+#
+# Note that the resulting extensions will usually not run on other (older)
+# CPUs, so this is meant for local or in-house builds rather than for binary
+# distributions. The ASTROPY_HELPERS_CPU_OPTIMIZATION environment variable can
+# be set to 'none' to disable these flags, e.g. when building wheels.
+#
+# For binary distributions, an extension can instead be built for several
+# instruction set levels, the best of which is selected when it is imported:
+#
+#     from astropy_helpers.cpu_helpers import add_isa_variants
+#
+#     add_isa_variants(extension)
+
+import os
+import sys
+import time
+import pprint
+import shutil
+import datetime
+import tempfile
+import subprocess
+
+from distutils import log
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
+from distutils.errors import CompileError, LinkError
+
+from .distutils_helpers import get_compiler_option
+
+__all__ = ['add_cpu_optimization_flags_if_available',
+           'check_cpu_optimization_support', 'get_cpu_optimization_flags',
+           'generate_cpu_optimization_py', 'add_isa_variants',
+           'CPU_OPTIMIZATION_LEVELS', 'ISA_LEVELS']
+
+# The optimization levels, from the most to the least specific
+CPU_OPTIMIZATION_LEVELS = ('native', 'avx512', 'avx2', 'none')
+
+# The instruction set levels that extensions can be built for with
+# add_isa_variants, from the most to the least specific
+ISA_LEVELS = ('avx512', 'avx2', 'baseline')
+
+# The candidate flags for each level, in order of preference, along with the
+# instruction set features that the test program must report for the flags to
+# be accepted (which catches flags that are silently ignored by a compiler for
+# another architecture). -march=native is not supported by all compilers for
+# all architectures (e.g. on POWER, or ARM with older versions of GCC), in
+# which case -mcpu=native is the equivalent.
+_AVX512_FEATURES = ['avx512f', 'avx2', 'fma']
+_AVX2_FEATURES = ['avx2', 'fma']
+
+_CPU_FLAGS = {
+    'unix': {
+        'native': [(['-march=native'], []),
+                   (['-mcpu=native'], [])],
+        'avx512': [(['-march=x86-64-v4'], _AVX512_FEATURES),
+                   (['-mavx512f', '-mavx512cd', '-mavx512bw', '-mavx512dq',
+                     '-mavx512vl', '-mavx2', '-mfma'], _AVX512_FEATURES)],
+        'avx2': [(['-march=x86-64-v3'], _AVX2_FEATURES),
+                 (['-mavx2', '-mfma'], _AVX2_FEATURES)],
+    },
+    # MSVC has no equivalent of -march=native, and does not define a macro
+    # for FMA (which /arch:AVX2 enables)
+    'msvc': {
+        'native': [],
+        'avx512': [(['/arch:AVX512'], ['avx512f', 'avx2'])],
+        'avx2': [(['/arch:AVX2'], ['avx2'])],
+    },
+}
+
+ENV_VARIABLE = 'ASTROPY_HELPERS_CPU_OPTIMIZATION'
+
+# The test program executes an instruction from each of the instruction sets
+# enabled by the flags, so that it crashes (rather than reporting the feature)
+# if the CPU of the build machine does not support it.
+CCODE = """
+#include <stdio.h>
+#if defined(__AVX__) || defined(__AVX2__) || defined(__AVX512F__)
+#include <immintrin.h>
+#endif
+float out[16];
+int main(int argc, char **argv) {
+  float x = (float)argc;
+#ifdef __AVX512F__
+  _mm512_storeu_ps(out, _mm512_add_ps(_mm512_set1_ps(x), _mm512_set1_ps(x)));
+  printf("avx512f\\n");
+#endif
+#ifdef __AVX2__
+  _mm256_storeu_si256((__m256i *)out,
+                      _mm256_add_epi32(_mm256_set1_epi32(argc),
+                                       _mm256_set1_epi32(argc)));
+  printf("avx2\\n");
+#endif
+#ifdef __FMA__
+  _mm256_storeu_ps(out, _mm256_fmadd_ps(_mm256_set1_ps(x), _mm256_set1_ps(x),
+                                        _mm256_set1_ps(x)));
+  printf("fma\\n");
+#endif
+#ifdef __AVX__
+  printf("avx\\n");
+#endif
+#ifdef __SSE4_2__
+  printf("sse4.2\\n");
+#endif
+#ifdef __ARM_NEON
+  printf("neon\\n");
+#endif
+#ifdef __ARM_FEATURE_SVE
+  printf("sve\\n");
+#endif
+#ifdef __VSX__
+  printf("vsx\\n");
+#endif
+  printf("ok=%d\\n", (int)out[0]);
+  return 0;
+}
+"""
+
+# The results of check_cpu_optimization_support, keyed by the flags
+_support_cache = {}
+
+# The flags added to each extension by add_cpu_optimization_flags_if_available
+_cpu_optimization = {}
+
+
+def check_cpu_optimization_support(flags):
+    """
+    Check whether test code can be compiled with the given CPU-specific
+    optimization flags, and run on the current machine.
+
+    Parameters
+    ----------
+    flags : list of str
+        The compiler flags to test.
+
+    Returns
+    -------
+    features : list of str or `None`
+        The instruction set features enabled by the flags (for example
+        ``['avx2', 'fma', 'avx']``) if the test passed, `None` otherwise.
+    """
+
+    key = tuple(flags)
+    if key in _support_cache:
+        return _support_cache[key]
+
+    ccompiler = new_compiler()
+    customize_compiler(ccompiler)
+
+    tmp_dir = tempfile.mkdtemp()
+
+    # Absolute paths are used rather than changing the working directory,
+    # which would affect other threads (see get_package_info)
+    try:
+        # Write test program
+        source = os.path.join(tmp_dir, 'test_cpu.c')
+        with open(source, 'w') as f:
+            f.write(CCODE)
+
+        # Compile test program
+        objects = ccompiler.compile([source],
+                                    output_dir=os.path.join(tmp_dir, 'objects'),
+                                    extra_postargs=flags)
+
+        # Link test program (the MSVC linker does not accept the flags)
+        link_flags = None if flags[0].startswith('/') else flags
+        ccompiler.link_executable(objects, 'test_cpu', output_dir=tmp_dir,
+                                  extra_postargs=link_flags)
+
+        # Run test program
+        executable = os.path.join(tmp_dir, 'test_cpu' +
+                                  (ccompiler.exe_extension or ''))
+        output = subprocess.check_output([executable],
+                                         stderr=subprocess.DEVNULL)
+        output = output.decode(sys.stdout.encoding or 'utf-8').splitlines()
+
+        if output and output[-1].startswith('ok='):
+            features = output[:-1]
+        else:
+            log.warn("Unexpected output from test CPU optimization "
+                     "program (output was {0})".format(output))
+            features = None
+    except (CompileError, LinkError, OSError, subprocess.CalledProcessError):
+        features = None
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _support_cache[key] = features
+
+    return features
+
+
+def get_cpu_optimization_flags(level='native'):
+    """
+    Returns the best supported set of CPU-specific optimization flags for the
+    given optimization ``level`` (or any lower level), as a ``(flags,
+    features)`` tuple. ``flags`` is empty if none of the candidate flags are
+    supported.
+
+    Parameters
+    ----------
+    level : str, optional
+        One of ``'native'`` (optimize for the CPU of the build machine),
+        ``'avx512'`` (use the AVX-512, AVX2 and FMA instruction sets),
+        ``'avx2'`` (use the AVX2 and FMA instruction sets) or ``'none'``.
+    """
+
+    if level not in CPU_OPTIMIZATION_LEVELS:
+        raise ValueError('CPU optimization level should be one of {0}, got '
+                         '{1!r}'.format(', '.join(CPU_OPTIMIZATION_LEVELS),
+                                        level))
+
+    candidates = _CPU_FLAGS['msvc' if get_compiler_option() == 'msvc'
+                            else 'unix']
+
+    # The probes are silenced since failures are expected for most candidates
+    log_threshold = log.set_threshold(log.FATAL)
+    try:
+        for lower_level in CPU_OPTIMIZATION_LEVELS[
+                CPU_OPTIMIZATION_LEVELS.index(level):-1]:
+            for flags, required in candidates[lower_level]:
+                features = check_cpu_optimization_support(flags)
+                if (features is not None and
+                        all(feature in features for feature in required)):
+                    return list(flags), features
+    finally:
+        log.set_threshold(log_threshold)
+
+    return [], []
+
+
+def add_cpu_optimization_flags_if_available(extension, level='native'):
+    """
+    Add the best supported CPU-specific optimization flags for the given
+    optimization ``level`` (see `get_cpu_optimization_flags`) to
+    ``extension``. If none of the flags are supported a warning will be
+    printed to the console and no flags will be added.
+
+    The optimization level can be overridden with the
+    ``ASTROPY_HELPERS_CPU_OPTIMIZATION`` environment variable, e.g. set to
+    ``none`` when building binary distributions. The flags are recorded in a
+    ``cpu_optimization.py`` module in the top-level package of the extension
+    (see `generate_cpu_optimization_py`).
+
+    Returns the list of flags that were added.
+    """
+
+    level = os.environ.get(ENV_VARIABLE) or level
+
+    if level == 'none':
+        log.info("CPU-specific optimizations have been disabled.")
+        flags, features = [], []
+    else:
+        flags, features = get_cpu_optimization_flags(level)
+        if flags:
+            log.info("Compiling extension {0} with CPU-specific optimization "
+                     "flags: {1}".format(extension.name, ' '.join(flags)))
+            extension.extra_compile_args.extend(flags)
+            # The flags are also needed when linking with LTO, but the MSVC
+            # linker does not accept them
+            if not flags[0].startswith('/'):
+                extension.extra_link_args.extend(flags)
+        else:
+            log.warn("Cannot compile extension {0} with CPU-specific "
+                     "optimizations for level {1!r}".format(extension.name,
+                                                            level))
+
+    _cpu_optimization[extension.name] = {'level': level, 'flags': flags,
+                                         'features': features}
+
+    packagename = extension.name.split('.')[0]
+    if os.path.isdir(packagename):
+        generate_cpu_optimization_py(packagename)
+
+    return flags
+
+
+def add_isa_variants(extension, levels=ISA_LEVELS):
+    """
+    Mark ``extension`` to be built once for each of the instruction set
+    ``levels`` (see `ISA_LEVELS`), on x86 platforms. The ``build_ext``
+    command then builds each variant as a separate extension module, and
+    generates a module in place of the extension which imports the variant
+    for the best instruction set supported by the CPU at import time. The
+    ``baseline`` level, which runs on any CPU, is always built.
+
+    The variant can be selected with the ``ASTROPY_HELPERS_ISA`` environment
+    variable (set to the name of a level), e.g. for benchmarks and tests.
+
+    Returns ``extension``.
+    """
+
+    unknown = [level for level in levels if level not in ISA_LEVELS]
+    if unknown:
+        raise ValueError('instruction set levels should be in {0}, got '
+                         '{1}'.format(', '.join(ISA_LEVELS),
+                                      ', '.join(map(repr, unknown))))
+
+    extension.isa_levels = [level for level in ISA_LEVELS
+                            if level in levels or level == 'baseline']
+
+    return extension
+
+
+_CPU_OPTIMIZATION_SRC = """
+# Autogenerated by {packagetitle}'s setup.py on {timestamp!s}
+
+def get_cpu_optimization():
+    \"\"\"
+    Return a dictionary giving, for each extension of this package that was
+    built with CPU-specific optimizations, the optimization level requested,
+    the compiler flags used and the instruction set features they enabled.
+    Extensions built with no such flags do not appear in the dictionary.
+    \"\"\"
+    return {record}
+"""[1:]
+
+
+def generate_cpu_optimization_py(packagename, srcdir='.'):
+    """
+    Generate ``package.cpu_optimization.get_cpu_optimization``, which can then
+    be used to determine, post build, which CPU-specific optimization flags
+    the extensions of the package were built with.
+    """
+
+    if packagename.lower() == 'astropy':
+        packagetitle = 'Astropy'
+    else:
+        packagetitle = packagename
+
+    epoch = int(os.environ.get('SOURCE_DATE_EPOCH', time.time()))
+    timestamp = datetime.datetime.utcfromtimestamp(epoch)
+
+    prefix = packagename + '.'
+    record = dict((name, info) for name, info in _cpu_optimization.items()
+                  if info['flags'] and (name.startswith(prefix) or
+                                        not packagename))
+
+    src = _CPU_OPTIMIZATION_SRC.format(
+        packagetitle=packagetitle, timestamp=timestamp,
+        record=pprint.pformat(record).replace('\n', '\n' + ' ' * 11))
+
+    package_srcdir = os.path.join(srcdir, *packagename.split('.'))
+    cpu_optimization_py = os.path.join(package_srcdir, 'cpu_optimization.py')
+    with open(cpu_optimization_py, 'w') as f:
+        f.write(src)
@@ -261,3 +261,48 @@ def is_distutils_display_option():
 
     display_options = get_distutils_display_options()
     return bool(set(sys.argv[1:]).intersection(display_options))
+
+
+# The commands which only write the metadata of the package (e.g. when pip
+# prepares the metadata of a source distribution), and so need neither the
+# extensions nor the custom commands
+METADATA_COMMANDS = ('egg_info', 'dist_info')
+
+
+def get_metadata_only_commands():
+    """ Returns the commands given on the command line if they are all
+    metadata-only commands (`METADATA_COMMANDS`), an empty list if only
+    display options such as --name or --version were given, or `None`
+    otherwise (including for --help, which shows the options of the custom
+    commands).
+
+    This does not require `astropy_helpers.setup_helpers.register_commands`
+    to be called first.
+    """
+
+    # dist_info is not one of the display options
+    if (not is_distutils_display_option() and
+            not set(sys.argv[1:]).intersection(METADATA_COMMANDS)):
+        return None
+
+    # A setuptools distribution is used since it knows the options of
+    # setuptools' commands (such as --egg-base for egg_info), and the display
+    # options are silenced since they print the metadata of this distribution
+    from setuptools.dist import Distribution as SetuptoolsDistribution
+
+    dist = SetuptoolsDistribution({'script_name': os.path.basename(sys.argv[0]),
+                                   'script_args': sys.argv[1:]})
+
+    with silence():
+        try:
+            dist.parse_command_line()
+        except (DistutilsError, AttributeError, SystemExit):
+            return None
+
+    if dist.help or dist.help_commands:
+        return None
+
+    if not all(cmd in METADATA_COMMANDS for cmd in dist.commands):
+        return None
+
+    return list(dist.commands)
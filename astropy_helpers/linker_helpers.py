@@ -0,0 +1,178 @@
+# This module defines functions that can be used to check which of the faster
+# alternatives to the default (BFD) GNU linker, namely mold, lld and gold, are
+# installed and can be used by the compiler to link Python extensions. These
+# are used by the build_ext command when the --fast-linker option (or the
+# ASTROPY_HELPERS_FAST_LINKER environment variable) is set, e.g.:
+#
+#     python setup.py build_ext --fast-linker=auto
+#
+# which links the extensions with the fastest linker that works, if any. The
+# linker that was used is recorded in the build_info module of the package.
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+from importlib.machinery import EXTENSION_SUFFIXES
+
+from distutils import log
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler, get_python_inc
+from distutils.errors import CompileError, LinkError
+
+__all__ = ['check_linker_support', 'find_fast_linker', 'get_linker_flags',
+           'FAST_LINKERS', 'FAST_LINKER_MODES']
+
+# The linkers, from the fastest to the slowest, and the names of their
+# executables as searched for by the compiler drivers
+FAST_LINKERS = ('mold', 'lld', 'gold')
+
+_LINKER_EXECUTABLES = {
+    'mold': ('ld.mold', 'mold'),
+    'lld': ('ld.lld', 'lld'),
+    'gold': ('ld.gold', 'gold'),
+}
+
+FAST_LINKER_MODES = ('auto',) + FAST_LINKERS + ('none',)
+
+ENV_VARIABLE = 'ASTROPY_HELPERS_FAST_LINKER'
+
+CCODE = """
+#include <Python.h>
+static struct PyModuleDef moduledef = {
+    PyModuleDef_HEAD_INIT, "test_linker", NULL, -1, NULL
+};
+PyMODINIT_FUNC
+PyInit_test_linker(void) {
+    PyObject *module = PyModule_Create(&moduledef);
+    PyModule_AddIntConstant(module, "answer", 42);
+    return module;
+}
+"""
+
+# The results of check_linker_support, keyed by the linker
+_support_cache = {}
+
+
+def get_linker_flags(linker):
+    """
+    Returns the flags that make the compiler driver (GCC or Clang) link with
+    ``linker``, which should be one of `FAST_LINKERS`.
+    """
+
+    if linker not in FAST_LINKERS:
+        raise ValueError('linker should be one of {0}, got '
+                         '{1!r}'.format(', '.join(FAST_LINKERS), linker))
+
+    return ['-fuse-ld=' + linker]
+
+
+def check_linker_support(linker):
+    """
+    Check whether a test Python extension can be linked with the given
+    linker, and imported.
+
+    Parameters
+    ----------
+    linker : str
+        The linker to test, one of `FAST_LINKERS`.
+
+    Returns
+    -------
+    result : bool
+        `True` if the test passed, `False` otherwise.
+    """
+
+    if linker in _support_cache:
+        return _support_cache[linker]
+
+    flags = get_linker_flags(linker)
+
+    ccompiler = new_compiler()
+    customize_compiler(ccompiler)
+
+    # The MSVC linker can't be replaced, and there is no point in compiling
+    # anything if the linker is not installed
+    if (ccompiler.compiler_type == 'msvc' or
+            not any(shutil.which(executable)
+                    for executable in _LINKER_EXECUTABLES[linker])):
+        _support_cache[linker] = False
+        return False
+
+    tmp_dir = tempfile.mkdtemp()
+
+    # Absolute paths are used rather than changing the working directory,
+    # which would affect other threads (see get_package_info)
+    try:
+        # Write test extension
+        source = os.path.join(tmp_dir, 'test_linker.c')
+        with open(source, 'w') as f:
+            f.write(CCODE)
+
+        # Compile test extension
+        objects = ccompiler.compile([source],
+                                    output_dir=os.path.join(tmp_dir, 'objects'),
+                                    include_dirs=[get_python_inc()])
+
+        # Link test extension
+        ccompiler.link_shared_object(objects,
+                                     'test_linker' + EXTENSION_SUFFIXES[0],
+                                     output_dir=tmp_dir, extra_postargs=flags)
+
+        # Import test extension
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys; sys.path.insert(0, ""); '
+             'import test_linker; print(test_linker.answer)'],
+            cwd=tmp_dir, stderr=subprocess.DEVNULL)
+        output = output.decode(sys.stdout.encoding or 'utf-8').strip()
+
+        if output == '42':
+            is_linker_supported = True
+        else:
+            log.warn("Unexpected output from test {0} extension (output was "
+                     "{1})".format(linker, output))
+            is_linker_supported = False
+    except (CompileError, LinkError, OSError, subprocess.CalledProcessError):
+        is_linker_supported = False
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _support_cache[linker] = is_linker_supported
+
+    return is_linker_supported
+
+
+def find_fast_linker(mode='auto'):
+    """
+    Returns the fastest linker that works for the given ``mode``, or `None`
+    if there is none (in which case the default linker should be used).
+
+    Parameters
+    ----------
+    mode : str, optional
+        One of ``'auto'`` (the fastest of `FAST_LINKERS` that works), the name
+        of one of `FAST_LINKERS` (that linker, if it works), or ``'none'``.
+    """
+
+    if mode not in FAST_LINKER_MODES:
+        raise ValueError('fast linker mode should be one of {0}, got '
+                         '{1!r}'.format(', '.join(FAST_LINKER_MODES), mode))
+
+    if mode == 'none':
+        return None
+
+    candidates = FAST_LINKERS if mode == 'auto' else (mode,)
+
+    # The probes are silenced since failures are expected for most candidates
+    log_threshold = log.set_threshold(log.FATAL)
+    try:
+        for linker in candidates:
+            if check_linker_support(linker):
+                return linker
+    finally:
+        log.set_threshold(log_threshold)
+
+    return None
@@ -13,7 +13,6 @@
 
 import os
 import sys
-import glob
 import time
 import datetime
 import tempfile
@@ -175,28 +174,29 @@ def check_openmp_support(openmp_flags=None):
     link_flags = openmp_flags.get('linker_flags')
 
     tmp_dir = tempfile.mkdtemp()
-    start_dir = os.path.abspath('.')
 
+    # The test program is built with absolute paths in the temporary
+    # directory rather than by changing the working directory, which would
+    # affect other threads (see get_package_info)
     try:
-        os.chdir(tmp_dir)
-
         # Write test program
-        with open('test_openmp.c', 'w') as f:
+        source = os.path.join(tmp_dir, 'test_openmp.c')
+        with open(source, 'w') as f:
             f.write(CCODE)
 
-        os.mkdir('objects')
-
         # Compile, test program
-        ccompiler.compile(['test_openmp.c'], output_dir='objects',
-                          extra_postargs=compile_flags)
+        objects = ccompiler.compile([source],
+                                    output_dir=os.path.join(tmp_dir, 'objects'),
+                                    extra_postargs=compile_flags)
 
         # Link test program
-        objects = glob.glob(os.path.join('objects', '*' + ccompiler.obj_extension))
-        ccompiler.link_executable(objects, 'test_openmp',
+        ccompiler.link_executable(objects, 'test_openmp', output_dir=tmp_dir,
                                   extra_postargs=link_flags)
 
         # Run test program
-        output = subprocess.check_output('./test_openmp')
+        output = subprocess.check_output(
+            [os.path.join(tmp_dir, 'test_openmp' +
+                          (ccompiler.exe_extension or ''))])
         output = output.decode(sys.stdout.encoding or 'utf-8').splitlines()
 
         if 'nthreads=' in output[0]:
@@ -214,9 +214,6 @@ def check_openmp_support(openmp_flags=None):
     except (CompileError, LinkError, subprocess.CalledProcessError):
         is_openmp_supported = False
 
-    finally:
-        os.chdir(start_dir)
-
     return is_openmp_supported
 
 
@@ -5,17 +5,20 @@ setup/build/packaging that are useful to astropy as a whole.
 """
 
 import collections
+import io
 import os
 import re
 import subprocess
 import sys
 import traceback
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 import builtins
 
 from distutils import log
-from distutils.errors import DistutilsOptionError, DistutilsModuleError
+from distutils.errors import (DistutilsOptionError, DistutilsModuleError,
+                              DistutilsSetupError)
 from distutils.core import Extension
 from distutils.core import Command
 from distutils.command.sdist import sdist as DistutilsSdist
@@ -26,20 +29,30 @@ from setuptools import find_packages as _find_packages
 
 from .distutils_helpers import (add_command_option, get_compiler_option,
                                 get_dummy_distribution, get_distutils_build_option,
-                                get_distutils_build_or_install_option)
-from .version_helpers import get_pkg_version_module, generate_version_py
+                                get_distutils_build_or_install_option,
+                                get_metadata_only_commands)
+from .version_helpers import generate_version_py
 from .utils import (walk_skip_hidden, import_file, extends_doc,
-                    resolve_name, AstropyDeprecationWarning)
+                    resolve_name, get_cpu_count, capture_output,
+                    thread_streams, AstropyDeprecationWarning)
 
+from . import _package_info
+from ._setup_package_cfg import SETUP_PACKAGE_CFG, SetupPackageConfig
+from .commands._parallel import capture_log, grouped_log, replay_log
 from .commands.build_ext import AstropyHelpersBuildExt
+from .commands.cython_annotate import AstropyCythonAnnotate
+from .commands.cython_profile import AstropyCythonProfile
 from .commands.test import AstropyTest
 
 # These imports are not used in this module, but are included for backwards
 # compat with older versions of this module
 from .utils import get_numpy_include_path, write_if_different  # noqa
+from .version_helpers import get_pkg_version_module  # noqa
 
 __all__ = ['register_commands', 'get_package_info']
 
+_HOOK_RE = re.compile(r'^(pre|post)_(.+)_hook$')
+
 _module_state = {'registered_commands': None,
                  'have_sphinx': False,
                  'package_cache': None,
@@ -72,6 +85,12 @@ def setup(**kwargs):
     A wrapper around setuptools' setup() function that automatically sets up
     custom commands, generates a version file, and customizes the setup process
     via the ``setup_package.py`` files.
+
+    If ``setup.py`` is only called with display options such as ``--name`` or
+    ``--version``, or with metadata-only commands such as ``egg_info`` (see
+    `~astropy_helpers.distutils_helpers.METADATA_COMMANDS`), only the
+    information these need is computed: the custom commands are not set up
+    and the ``setup_package.py`` modules are not imported.
     """
 
     # DEPRECATED: store the package name in a built-in variable so it's easy
@@ -81,6 +100,12 @@ def setup(**kwargs):
     conf = read_configuration('setup.cfg')
     builtins._ASTROPY_PACKAGE_NAME_ = conf['metadata']['name']
 
+    metadata_commands = get_metadata_only_commands()
+    if metadata_commands is not None:
+        setuptools_setup(**_get_metadata_package_info(metadata_commands,
+                                                      kwargs))
+        return
+
     # Create a dictionary with setup command overrides. Note that this gets
     # information about the package (name and version) from the setup.cfg file.
     cmdclass = register_commands()
@@ -102,6 +127,34 @@ def setup(**kwargs):
     setuptools_setup(**package_info)
 
 
+def _get_metadata_package_info(commands, kwargs):
+    """
+    Returns the arguments to setuptools' setup() for the metadata-only
+    ``commands`` (or for display options only, if ``commands`` is empty),
+    updated with ``kwargs``.
+    """
+
+    package_info = {}
+
+    # The version is only needed by the commands and by the display options
+    # that show it, and computing it may require calling git
+    if commands or set(sys.argv[1:]) & {'--version', '-V', '--fullname'}:
+        package_info['version'] = generate_version_py()
+
+    # The metadata of the packages is needed (e.g. for top_level.txt), but
+    # not the extensions or the package data from setup_package.py modules.
+    # The packages are found as in get_package_info, so that they honor
+    # add_exclude_packages.
+    if commands:
+        packages, package_dir = _find_package_dirs()
+        package_info['packages'] = packages
+        package_info['package_dir'] = package_dir
+
+    package_info.update(kwargs)
+
+    return package_info
+
+
 def adjust_compiler(package):
     warnings.warn(
         'The adjust_compiler function in setup.py is '
@@ -121,8 +174,8 @@ def get_debug_option(packagename):
     """
 
     try:
-        current_debug = get_pkg_version_module(packagename,
-                                               fromlist=['debug'])[0]
+        current_debug = _load_registered(
+            os.path.join(packagename, 'version.py'), 'version').debug
     except (ImportError, AttributeError):
         current_debug = None
 
@@ -130,13 +183,16 @@ def get_debug_option(packagename):
     # run (i.e. not as a sub-command of something else)
     dist = get_dummy_distribution()
     if any(cmd in dist.commands for cmd in ['build', 'build_ext']):
-        debug = bool(get_distutils_build_option('debug'))
+        variant = (get_distutils_build_option('variant') or
+                   os.environ.get('ASTROPY_HELPERS_BUILD_VARIANT') or '')
+        debug = (bool(get_distutils_build_option('debug')) or
+                 variant.lower() == 'debug')
     else:
         debug = bool(current_debug)
 
-    if current_debug is not None and current_debug != debug:
-        build_ext_cmd = dist.get_command_class('build_ext')
-        build_ext_cmd._force_rebuild = True
+    # Note that a change of the debug flag no longer forces a rebuild of all
+    # extensions, since builds with and without it are built in separate
+    # temporary directories (see the --variant option of build_ext)
 
     return debug
 
@@ -214,6 +270,8 @@ def register_commands(package=None, version=None, release=None, srcdir='.'):
         'sdist': DistutilsSdist,
 
         'build_ext': AstropyHelpersBuildExt,
+        'cython_profile': AstropyCythonProfile,
+        'cython_annotate': AstropyCythonAnnotate,
         'build_sphinx': AstropyBuildSphinx,
         'build_docs': AstropyBuildDocs
     }
@@ -251,8 +309,6 @@ def add_command_hooks(commands, srcdir='.'):
     hooks for them (e.g. `AstropyBuildPy`).
     """
 
-    hook_re = re.compile(r'^(pre|post)_(.+)_hook$')
-
     # Distutils commands have a method of the same name, but it is not a
     # *classmethod* (which probably didn't exist when distutils was first
     # written)
@@ -262,14 +318,23 @@ def add_command_hooks(commands, srcdir='.'):
         else:
             return cmdcls.__name__
 
-    packages = find_packages(srcdir)
     dist = get_dummy_distribution()
 
     hooks = collections.defaultdict(dict)
 
-    for setuppkg in iter_setup_packages(srcdir, packages):
+    # With the package information cache, only the setup_package.py modules
+    # which define hooks are imported
+    cached = _load_package_info(srcdir)
+    if cached is not None:
+        setup_packages = [_load_registered(filename, name)
+                          for filename, name in cached['hook_modules']]
+    else:
+        packages = find_packages(srcdir)
+        setup_packages = iter_setup_packages(srcdir, packages)
+
+    for setuppkg in setup_packages:
         for name, obj in vars(setuppkg).items():
-            match = hook_re.match(name)
+            match = _HOOK_RE.match(name)
             if not match:
                 continue
 
@@ -367,7 +432,7 @@ def update_package_files(srcdir, extensions, package_data, packagenames,
     package_dirs.update(info['package_dir'])
 
 
-def get_package_info(srcdir='.', exclude=()):
+def get_package_info(srcdir='.', exclude=(), jobs=None):
     """
     Collates all of the information for building all subpackages
     and returns a dictionary of keyword arguments that can
@@ -384,7 +449,12 @@ def get_package_info(srcdir='.', exclude=()):
     packages in ``srcdir`` and locating a ``setup_package.py`` module.
     This module can contain the following functions:
     ``get_extensions()``, ``get_package_data()``,
-    ``get_build_options()``, and ``get_external_libraries()``.
+    ``get_build_options()``, and ``get_external_libraries()`` (bundled
+    libraries declared by ``get_bundled_libraries()`` are found and built by
+    the ``build_ext`` command). Extensions and package data can also be
+    declared in a ``setup_package.cfg`` file, which is parsed without
+    executing any Python code, and whose extensions come before those of
+    the ``setup_package.py`` module of the same package.
 
     Each of those functions take no arguments.
 
@@ -400,10 +470,45 @@ def get_package_info(srcdir='.', exclude=()):
     - ``get_external_libraries()`` returns
       a list of libraries that can optionally be built using external
       dependencies.
+
+    If the ``ASTROPY_HELPERS_PACKAGE_INFO_CACHE`` environment variable is
+    set, the results are cached in the ``build`` directory, and restored
+    without importing any ``setup_package.py`` module as long as the
+    packages, their ``setup_package.py`` and source files, the sources of the
+    extensions, ``setup.py``, ``setup.cfg``, the command line and the
+    environment are unchanged.
+
+    The ``get_extensions()`` and ``get_package_data()`` functions of different
+    ``setup_package.py`` modules can be called concurrently on a pool of
+    ``jobs`` threads (by default, ``$ASTROPY_HELPERS_PACKAGE_INFO_JOBS`` or 1,
+    and ``'auto'`` to use all the CPUs available), which helps when they run
+    external programs (such as ``pkg-config`` or the OpenMP checks). Their
+    results are merged, and their log messages shown, in the order of the
+    packages, and any exception is reported as a
+    `~distutils.errors.DistutilsSetupError` naming the function that raised
+    it. The functions should then not change the working directory, or other
+    process-wide state.
     """
+
+    if exclude:
+        warnings.warn(
+            "Use of the exclude parameter is no longer supported since it does "
+            "not work as expected. Use add_exclude_packages instead. Note that "
+            "it must be called prior to any other calls from setup helpers.",
+            AstropyDeprecationWarning)
+
+    cached = _load_package_info(srcdir, exclude=exclude)
+    if cached is not None:
+        log.info('using the cached package information from '
+                 '{0}'.format(cached['filename']))
+        for option in cached['build_options']:
+            add_command_option('build', *option)
+        for library in cached['external_libraries']:
+            add_external_library(library)
+        _module_state['package_cache'] = cached['package_info']['packages']
+        return cached['package_info']
+
     ext_modules = []
-    packages = []
-    package_dir = {}
 
     # Read in existing package data, and add to it below
     setup_cfg = os.path.join(srcdir, 'setup.cfg')
@@ -416,41 +521,37 @@ def get_package_info(srcdir='.', exclude=()):
     else:
         package_data = {}
 
-    if exclude:
-        warnings.warn(
-            "Use of the exclude parameter is no longer supported since it does "
-            "not work as expected. Use add_exclude_packages instead. Note that "
-            "it must be called prior to any other calls from setup helpers.",
-            AstropyDeprecationWarning)
-
-    # Use the find_packages tool to locate all packages and modules
-    packages = find_packages(srcdir, exclude=exclude)
+    packages, package_dir = _find_package_dirs(srcdir, exclude)
 
-    # Update package_dir if the package lies in a subdirectory
-    if srcdir != '.':
-        package_dir[''] = srcdir
+    # The setup_package.py modules are imported once (see
+    # iter_setup_packages) and used for both passes below
+    setup_packages = list(iter_setup_packages(srcdir, packages))
 
     # For each of the setup_package.py modules, extract any
     # information that is needed to install them.  The build options
     # are extracted first, so that their values will be available in
     # subsequent calls to `get_extensions`, etc.
-    for setuppkg in iter_setup_packages(srcdir, packages):
+    build_options = []
+    external_libraries = []
+
+    for setuppkg in setup_packages:
         if hasattr(setuppkg, 'get_build_options'):
             options = setuppkg.get_build_options()
             for option in options:
                 add_command_option('build', *option)
+                build_options.append(tuple(option))
         if hasattr(setuppkg, 'get_external_libraries'):
             libraries = setuppkg.get_external_libraries()
             for library in libraries:
                 add_external_library(library)
+                external_libraries.append(library)
 
-    for setuppkg in iter_setup_packages(srcdir, packages):
-        # get_extensions must include any Cython extensions by their .pyx
-        # filename.
-        if hasattr(setuppkg, 'get_extensions'):
-            ext_modules.extend(setuppkg.get_extensions())
-        if hasattr(setuppkg, 'get_package_data'):
-            package_data.update(setuppkg.get_package_data())
+    # get_extensions must include any Cython extensions by their .pyx
+    # filename.
+    for extensions, data in _collect_package_info(
+            setup_packages, _get_package_info_jobs(jobs)):
+        ext_modules.extend(extensions)
+        package_data.update(data)
 
     # Locate any .pyx files not already specified, and add their extensions in.
     # The default include dirs include numpy to facilitate numerical work.
@@ -471,18 +572,209 @@ def get_package_info(srcdir='.', exclude=()):
         for ext in ext_modules:
             ext.extra_link_args.append('/MANIFEST')
 
-    return {
+    package_info = {
         'ext_modules': ext_modules,
         'packages': packages,
         'package_dir': package_dir,
         'package_data': package_data,
         }
 
+    _store_package_info(srcdir, exclude, package_info, setup_packages,
+                        build_options, external_libraries)
+
+    return package_info
+
+
+def _find_package_dirs(srcdir='.', exclude=()):
+    """
+    Returns the packages in ``srcdir`` and the ``package_dir`` argument to
+    setup() for them, as used by both `get_package_info` and the metadata
+    fast path of `setup`.
+    """
+
+    # Use the find_packages tool to locate all packages and modules
+    packages = find_packages(srcdir, exclude=exclude)
+
+    # Update package_dir if the package lies in a subdirectory
+    package_dir = {}
+    if srcdir != '.':
+        package_dir[''] = srcdir
+
+    return packages, package_dir
+
+
+def _get_package_info_jobs(jobs):
+    """
+    Returns the number of threads on which `get_package_info` calls the
+    functions of the ``setup_package.py`` modules.
+    """
+
+    if jobs is None:
+        jobs = os.environ.get('ASTROPY_HELPERS_PACKAGE_INFO_JOBS') or 1
+
+    if jobs == 'auto':
+        return get_cpu_count()
+
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        raise DistutilsOptionError(
+            "the number of jobs for get_package_info should be an integer or "
+            "'auto', got {0!r}".format(jobs))
+
+    return max(jobs, 1)
+
+
+def _call_collection_functions(setuppkg, report_errors=False):
+    """
+    Returns the results of the ``get_extensions()`` and ``get_package_data()``
+    functions of ``setuppkg``, if defined. If ``report_errors`` is `True`, any
+    exception is re-raised as a `~distutils.errors.DistutilsSetupError` which
+    names the function.
+    """
+
+    results = []
+
+    for name, default in (('get_extensions', []), ('get_package_data', {})):
+        function = getattr(setuppkg, name, None)
+        if function is None:
+            results.append(default)
+            continue
+        try:
+            results.append(function())
+        except Exception as exc:
+            if not report_errors:
+                raise
+            raise DistutilsSetupError('{0}.{1}() failed: {2}: {3}'.format(
+                setuppkg.__name__, name, type(exc).__name__, exc)) from exc
+
+    return tuple(results)
+
+
+def _collect_package_info(setup_packages, jobs=1):
+    """
+    Returns the ``(extensions, package_data)`` of each of the
+    ``setup_packages`` modules, in the same order, calling the functions of
+    different modules on a pool of ``jobs`` threads.
+    """
+
+    if jobs <= 1 or len(setup_packages) <= 1:
+        return [_call_collection_functions(setuppkg)
+                for setuppkg in setup_packages]
+
+    # The log messages and the output of each module are captured, so that
+    # they are not interleaved with those of other modules, and so that a
+    # module silencing its output does not silence the others
+    def collect(setuppkg, records, stdout, stderr):
+        with capture_log(records), capture_output(stdout, stderr):
+            return _call_collection_functions(setuppkg, report_errors=True)
+
+    results = []
+
+    with thread_streams(), grouped_log(), \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        tasks = []
+        for setuppkg in setup_packages:
+            output = ([], io.StringIO(), io.StringIO())
+            tasks.append((output, executor.submit(collect, setuppkg,
+                                                  *output)))
+
+        for idx, ((records, stdout, stderr), future) in enumerate(tasks):
+            exc = future.exception()
+            replay_log(records)
+            sys.stdout.write(stdout.getvalue())
+            sys.stderr.write(stderr.getvalue())
+            if exc is not None:
+                # The first error in the order of the packages is reported,
+                # and the calls which did not start yet are cancelled
+                for _, other in tasks[idx + 1:]:
+                    other.cancel()
+                raise exc
+            results.append(future.result())
+
+    return results
+
+
+def _load_package_info(srcdir, exclude=()):
+    """
+    Returns the results of `get_package_info` for ``srcdir`` from the package
+    information cache, if it is enabled and they are up to date, or `None`.
+    """
+
+    if not _package_info.is_enabled():
+        return None
+
+    # As for find_packages, the excluded packages can no longer change
+    _module_state['excludes_too_late'] = True
+
+    cache = _package_info.PackageInfoCache(srcdir)
+    key = _package_info.get_cache_key(
+        srcdir, _module_state['exclude_packages'] | set(exclude))
+
+    cached = cache.load(key)
+    if cached is None:
+        return None
+
+    # Sources found with glob patterns may have been added or removed
+    if not _package_info.extension_inputs_unchanged(
+            cached['extension_inputs']):
+        return None
+
+    cached['filename'] = cache.filename
+
+    return cached
+
+
+def _store_package_info(srcdir, exclude, package_info, setup_packages,
+                        build_options, external_libraries):
+    """
+    Store the results of `get_package_info` in the package information
+    cache, if it is enabled.
+    """
+
+    if not _package_info.is_enabled():
+        return
+
+    # Extensions of classes defined in setup_package.py modules could not be
+    # unpickled without importing the packages
+    for ext in package_info['ext_modules']:
+        if type(ext).__module__.endswith('setup_package'):
+            log.info('the package information is not cached since the {0} '
+                     'extension is an instance of a class defined in '
+                     '{1}'.format(ext.name, type(ext).__module__))
+            return
+
+    hook_modules = []
+    for setuppkg in setup_packages:
+        if any(_HOOK_RE.match(name) for name in vars(setuppkg)):
+            hook_modules.append((os.path.abspath(setuppkg.__file__),
+                                 setuppkg.__name__))
+
+    cache = _package_info.PackageInfoCache(srcdir)
+    key = _package_info.get_cache_key(
+        srcdir, _module_state['exclude_packages'] | set(exclude))
+
+    cache.store(key, {'package_info': package_info,
+                      'build_options': build_options,
+                      'external_libraries': external_libraries,
+                      'hook_modules': hook_modules,
+                      'extension_inputs': _package_info.get_extension_inputs(
+                          package_info['ext_modules'])})
+
 
 def iter_setup_packages(srcdir, packages):
     """ A generator that finds and imports all of the ``setup_package.py``
     modules in the source packages.
 
+    The declarative ``setup_package.cfg`` files of the packages are parsed
+    into objects providing the same ``get_extensions()`` and
+    ``get_package_data()`` functions, which are yielded before the module of
+    the same package, if any.
+
+    The modules and the parsed files are kept in a registry shared by
+    `get_package_info`, `add_command_hooks` and the build commands, and are
+    only imported or parsed again if their file was modified since.
+
     Returns
     -------
     modgen : generator
@@ -494,15 +786,57 @@ def iter_setup_packages(srcdir, packages):
     for packagename in packages:
         package_parts = packagename.split('.')
         package_path = os.path.join(srcdir, *package_parts)
+        setup_package_cfg = os.path.relpath(
+            os.path.join(package_path, SETUP_PACKAGE_CFG))
         setup_package = os.path.relpath(
             os.path.join(package_path, 'setup_package.py'))
 
+        if os.path.isfile(setup_package_cfg):
+            yield _load_registered(setup_package_cfg, packagename,
+                                   loader=SetupPackageConfig)
+
         if os.path.isfile(setup_package):
-            module = import_file(setup_package,
-                                 name=packagename + '.setup_package')
+            module = _load_registered(setup_package,
+                                      packagename + '.setup_package')
             yield module
 
 
+# The modules loaded by _load_registered, as (signature, module) tuples keyed
+# by filename and module name. This is kept out of _module_state, which only
+# holds plain (copyable) values.
+_module_registry = {}
+
+
+def _load_registered(filename, name, loader=import_file):
+    """
+    Imports the module ``filename`` under ``name`` with `import_file` (or
+    loads it with another ``loader``), unless it was already loaded under
+    that name and the file was not modified (as given by its modification
+    time and size) since.
+    """
+
+    registry = _module_registry
+
+    key = (os.path.abspath(filename), name)
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        registry.pop(key, None)
+        raise ImportError('Could not import file {0}'.format(filename))
+
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    entry = registry.get(key)
+    if entry is not None and entry[0] == signature:
+        return entry[1]
+
+    module = loader(filename, name)
+    registry[key] = (signature, module)
+
+    return module
+
+
 def iter_pyx_files(package_dir, package_name):
     """
     A generator that yields Cython source files (ending in '.pyx') in the
@@ -0,0 +1,84 @@
+import os
+import types
+from copy import deepcopy
+from importlib import machinery
+from distutils.core import Extension
+
+import pytest
+
+from .. import cpu_helpers
+from ..cpu_helpers import (add_cpu_optimization_flags_if_available,
+                           check_cpu_optimization_support,
+                           get_cpu_optimization_flags)
+from ..setup_helpers import _module_state, register_commands
+
+_state = None
+
+
+def setup_function(function):
+    global _state
+    _state = deepcopy(_module_state)
+    cpu_helpers._cpu_optimization.clear()
+
+
+def teardown_function(function):
+    _module_state.clear()
+    _module_state.update(_state)
+    cpu_helpers._cpu_optimization.clear()
+
+
+def test_check_cpu_optimization_support():
+
+    register_commands('cpu_testing', '0.0', False)
+
+    # Flags that the compiler does not know about are rejected
+    assert check_cpu_optimization_support(['-mno-such-option=42']) is None
+
+
+def test_get_cpu_optimization_flags():
+
+    register_commands('cpu_testing', '0.0', False)
+
+    flags, features = get_cpu_optimization_flags('avx2')
+    if flags:
+        assert 'avx2' in features
+    else:
+        assert features == []
+
+    assert get_cpu_optimization_flags('none') == ([], [])
+
+    with pytest.raises(ValueError) as exc:
+        get_cpu_optimization_flags('sse9')
+    assert 'should be one of native, avx512, avx2, none' in str(exc.value)
+
+
+def test_add_cpu_optimization_flags_if_available(tmpdir, monkeypatch):
+
+    register_commands('cpu_testing', '0.0', False)
+
+    tmpdir.mkdir('cpupkg')
+    monkeypatch.chdir(tmpdir)
+
+    extension = Extension('cpupkg._ext', [])
+    flags = add_cpu_optimization_flags_if_available(extension)
+    assert extension.extra_compile_args == flags
+
+    # The optimization level can be overridden, e.g. for binary distributions
+    monkeypatch.setenv('ASTROPY_HELPERS_CPU_OPTIMIZATION', 'none')
+    assert add_cpu_optimization_flags_if_available(
+        Extension('cpupkg._other', [])) == []
+
+    # Load cpu_optimization file as a module to check the result
+    loader = machinery.SourceFileLoader(
+        'cpu_optimization', os.path.join('cpupkg', 'cpu_optimization.py'))
+    mod = types.ModuleType(loader.name)
+    loader.exec_module(mod)
+
+    cpu_optimization = mod.get_cpu_optimization()
+
+    if flags:
+        assert cpu_optimization == {
+            'cpupkg._ext': {'level': 'native', 'flags': flags,
+                            'features': get_cpu_optimization_flags()[1]}}
+    else:
+        assert cpu_optimization == {}
@@ -0,0 +1,41 @@
+import pytest
+
+from .. import linker_helpers
+from ..linker_helpers import (FAST_LINKERS, check_linker_support,
+                              find_fast_linker, get_linker_flags)
+
+
+def setup_function(function):
+    linker_helpers._support_cache.clear()
+
+
+def teardown_function(function):
+    linker_helpers._support_cache.clear()
+
+
+def test_get_linker_flags():
+
+    assert get_linker_flags('lld') == ['-fuse-ld=lld']
+
+    with pytest.raises(ValueError) as exc:
+        get_linker_flags('bfd')
+    assert 'should be one of mold, lld, gold' in str(exc.value)
+
+
+def test_find_fast_linker(monkeypatch):
+
+    assert find_fast_linker('none') is None
+
+    with pytest.raises(ValueError) as exc:
+        find_fast_linker('fastest')
+    assert 'should be one of auto, mold, lld, gold, none' in str(exc.value)
+
+    # The fastest linker that works is used
+    linker = find_fast_linker('auto')
+    supported = [name for name in FAST_LINKERS if check_linker_support(name)]
+    assert linker == (supported[0] if supported else None)
+
+    # Linkers that are not installed are not used
+    monkeypatch.setattr(linker_helpers.shutil, 'which', lambda name: None)
+    linker_helpers._support_cache.clear()
+    assert find_fast_linker('auto') is None
@@ -1,12 +1,21 @@
 import os
+import glob
+import json
+import platform
+import shutil
+import subprocess
 import sys
 import importlib
+from importlib.machinery import EXTENSION_SUFFIXES
 
 import pytest
 
+from distutils.errors import DistutilsSetupError
+
 from textwrap import dedent
 
 from ..setup_helpers import get_package_info, register_commands
+from ..utils import import_file
 
 from . import reset_setup_helpers, reset_distutils_log  # noqa
 from . import run_setup, cleanup_import
@@ -164,8 +173,8 @@ def test_cython_autoextensions(tmpdir):
 
 def test_compiler_module(capsys, c_extension_test_package):
     """
-    Test ensuring that the compiler module is built and installed for packages
-    that have extension modules.
+    Test ensuring that the build_info and compiler_version modules are
+    generated and installed for packages that have extension modules.
     """
 
     test_pkg = c_extension_test_package
@@ -189,8 +198,29 @@ def test_compiler_module(capsys, c_extension_test_package):
         dirname = os.path.abspath(os.path.dirname(apyhtest_eva.__file__))
         assert dirname == str(install_temp.join('apyhtest_eva'))
 
+        # The build information is only evaluated when first accessed
+        import apyhtest_eva.build_info
+        build_info = apyhtest_eva.build_info
+        assert vars(build_info)['_info'] is None
+
         import apyhtest_eva.compiler_version
-        assert apyhtest_eva.compiler_version != 'unknown'
+
+        # The compiler_version module is no longer an extension
+        assert apyhtest_eva.compiler_version.__file__.endswith('.py')
+        assert not glob.glob(str(install_temp.join('apyhtest_eva',
+                                                    'compiler_version.*.*')))
+
+        assert build_info.compiler == apyhtest_eva.compiler_version.compiler
+        assert build_info.compiler_version in build_info.compiler
+        assert build_info.compiler.split(' version ')[0] in (
+            'GCC', 'Clang', 'Intel C compiler', 'Microsoft Visual C++')
+        assert sorted(build_info.extensions) == ['apyhtest_eva.unit01']
+        assert build_info.openmp_enabled is False
+        assert not build_info.debug
+        assert 'compiler' in dir(build_info)
+
+        with pytest.raises(AttributeError):
+            build_info.nonexistent
 
 
 def test_no_cython_buildext(capsys, c_extension_test_package, monkeypatch):
@@ -246,49 +276,49 @@ def test_missing_cython_c_files(capsys, pyx_extension_test_package,
         assert msg in stderr
 
 
-@pytest.mark.parametrize('mode', ['cli', 'cli-w', 'cli-sphinx', 'cli-l', 'cli-parallel'])
-def test_build_docs(capsys, tmpdir, mode):
+def _multi_extension_test_package(tmpdir, broken=()):
     """
-    Test for build_docs
+    Creates a test package with several C extension modules, some of which
+    may be broken (i.e. fail to compile).
     """
 
     test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('apyhtest_multi').ensure('__init__.py')
 
-    test_pkg.mkdir('mypackage')
-
-    test_pkg.join('mypackage').join('__init__.py').write(dedent("""\
-        def test_function():
-            pass
-
-        class A():
-            pass
-
-        class B(A):
-            pass
-    """))
+    names = ['unit01', 'unit02', 'unit03', 'unit04']
 
-    test_pkg.mkdir('docs')
+    for name in names:
+        source = dedent("""\
+            #include <Python.h>
 
-    docs_dir = test_pkg.join('docs')
-    docs_dir.join('conf.py').write(dedent("""\
-        import warnings
-        with warnings.catch_warnings():  # ignore matplotlib warning
-            warnings.simplefilter("ignore")
-            from sphinx_astropy.conf import *
-        exclude_patterns.append('_templates')
-        suppress_warnings = ['app.add_directive', 'app.add_node', 'app.add_role']
-    """))  # noqa
+            static struct PyModuleDef moduledef = {{
+                PyModuleDef_HEAD_INIT,
+                "{0}",
+                NULL,
+                -1,
+                NULL
+            }};
+            PyMODINIT_FUNC
+            PyInit_{0}(void) {{
+                return PyModule_Create(&moduledef);
+            }}
+        """.format(name))
+        if name in broken:
+            source += '#error {0} is broken\n'.format(name)
+        test_pkg.join('apyhtest_multi', name + '.c').write(source)
 
-    docs_dir.join('index.rst').write(dedent("""\
-        .. automodapi:: mypackage
-           :no-inheritance-diagram:
-    """))
+    test_pkg.join('apyhtest_multi', 'setup_package.py').write(dedent("""\
+        from setuptools import Extension
+        from os.path import join
+        def get_extensions():
+            return [Extension('apyhtest_multi.' + name,
+                              [join('apyhtest_multi', name + '.c')])
+                    for name in {0!r}]
+    """.format(names)))
 
-    # For this test we try out the new way of calling register_commands without
-    # arugments, instead getting the information from setup.cfg.
-    test_pkg.join('setup.cfg').write(dedent("""
+    test_pkg.join('setup.cfg').write(dedent("""\
         [metadata]
-        name = mypackage
+        name = apyhtest_multi
         version = 0.1
     """))
 
@@ -299,77 +329,1754 @@ def test_build_docs(capsys, tmpdir, mode):
         setup()
     """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
 
+    return test_pkg
+
+
+@pytest.mark.parametrize('jobs', ['1', '3', 'auto'])
+def test_build_ext_jobs(tmpdir, capsys, jobs):
+    """
+    Test building several extensions in parallel with the --jobs option.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
     with test_pkg.as_cwd():
+        run_setup('setup.py', ['build_ext', '--inplace', '--jobs', jobs])
 
-        if mode == 'cli':
-            run_setup('setup.py', ['build_docs'])
-        elif mode == 'cli-w':
-            run_setup('setup.py', ['build_docs', '-w'])
-        elif mode == 'cli-l':
-            run_setup('setup.py', ['build_docs', '-l'])
-        elif mode == 'cli-sphinx':
-            run_setup('setup.py', ['build_sphinx'])
-        elif mode == 'cli-parallel':
-            run_setup('setup.py', ['build_docs', '--parallel=2'])
+    stdout, stderr = capsys.readouterr()
 
-    assert os.path.exists(docs_dir.join('_build', 'html', 'index.html').strpath)
+    # The output for each extension should not be interleaved with that for
+    # other extensions, and should be in the order the extensions are defined
+    building = [line for line in stdout.splitlines()
+                if line.startswith('building ')]
+    assert building[-4:] == ["building 'apyhtest_multi.unit0{0}' "
+                             "extension".format(idx) for idx in range(1, 5)]
 
+    for idx in range(1, 5):
+        section = stdout.split("building 'apyhtest_multi.unit0{0}' "
+                               "extension".format(idx))[1]
+        section = section.split("building '")[0]
+        assert 'unit0{0}.c'.format(idx) in section
+        assert 'unit0{0}.cpython'.format(idx) in section
 
-def test_command_hooks(tmpdir, capsys):
-    """A basic test for pre- and post-command hooks."""
+    sys.path.insert(0, str(test_pkg))
+    try:
+        import apyhtest_multi.unit04  # noqa
+    finally:
+        sys.path.remove(str(test_pkg))
+        cleanup_import('apyhtest_multi')
 
-    test_pkg = tmpdir.mkdir('test_pkg')
-    test_pkg.mkdir('_welltall_')
-    test_pkg.join('_welltall_', '__init__.py').ensure()
 
-    # Create a setup_package module with a couple of command hooks in it
-    test_pkg.join('_welltall_', 'setup_package.py').write(dedent("""\
-        def pre_build_hook(cmd_obj):
-            print('Hello build!')
+def test_build_ext_jobs_failure(tmpdir, capsys):
+    """
+    When building in parallel, the error reported should be for the first
+    broken extension, regardless of which extension finishes first.
+    """
 
-        def post_build_hook(cmd_obj):
-            print('Goodbye build!')
+    test_pkg = _multi_extension_test_package(tmpdir,
+                                             broken=('unit02', 'unit04'))
+
+    with test_pkg.as_cwd():
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--inplace', '-j', '4'])
+
+    stdout, stderr = capsys.readouterr()
+
+    assert 'unit02 is broken' in stdout + stderr
+    assert 'unit04 is broken' not in stdout + stderr
+
+
+def test_build_ext_skips_unchanged(tmpdir, capsys):
+    """
+    Extensions whose inputs have not changed should not be rebuilt, even if
+    the timestamps of the source files have changed.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    package = test_pkg.join('apyhtest_multi')
+    package.join('common.h').write('#define COMMON 1\n')
+    unit03 = package.join('unit03.c')
+    unit03.write('#include "common.h"\n' + unit03.read())
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        capsys.readouterr()
+
+        # Touching the files should not trigger a rebuild
+        for filename in package.listdir():
+            filename.setmtime(filename.mtime() + 10)
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+
+        for idx in range(1, 5):
+            assert ("skipping 'apyhtest_multi.unit0{0}' extension "
+                    "(unchanged)".format(idx)) in stdout
+
+        # But changing an included header should, and only for extensions
+        # that include it
+        package.join('common.h').write('#define COMMON 2\n')
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+
+        assert "building 'apyhtest_multi.unit03' extension" in stdout
+        assert "skipping 'apyhtest_multi.unit01' extension (unchanged)" in stdout
+
+        # Finally, --force should rebuild everything
+        run_setup('setup.py', ['build_ext', '--inplace', '--force'])
+        stdout, stderr = capsys.readouterr()
+
+        assert 'skipping' not in stdout
+
+
+def test_dependency_graph(tmpdir):
+    """
+    Test the scanning of C includes and Cython cimports/includes, and that
+    scan results are reused for unchanged files.
+    """
+
+    from ..commands._depends import DependencyGraph
 
+    pkg = tmpdir.mkdir('pkg')
+    pkg.ensure('__init__.py')
+    pkg.join('core.pyx').write(dedent("""\
+        cimport numpy as np
+        from pkg.sub cimport tools, helpers as h
+        from . cimport local
+        include "extra.pxi"
     """))
+    pkg.join('core.pxd').write('cdef int x\n')
+    pkg.join('local.pxd').write('from .sub.tools cimport y\n')
+    pkg.join('extra.pxi').write('\n')
+    sub = pkg.mkdir('sub')
+    sub.join('__init__.pxd').write('\n')
+    sub.join('tools.pxd').write('cdef int y\n')
+    sub.join('helpers.pxd').write('\n')
+    include = tmpdir.mkdir('include')
+    pkg.join('ext.c').write('#include <outer.h>\n#include "missing.h"\n'
+                            '#include <stdio.h>\n')
+    include.join('outer.h').write('#include "inner.h"\n')
+    include.join('inner.h').write('\n')
+
+    graph_file = str(tmpdir.join('build', 'depends.json'))
+
+    with tmpdir.as_cwd():
+        graph = DependencyGraph(graph_file)
+
+        pyx_deps = graph.dependencies(os.path.join('pkg', 'core.pyx'))
+        assert pyx_deps == sorted(os.path.join('pkg', *path) for path in [
+            ('core.pxd',), ('extra.pxi',), ('local.pxd',),
+            ('sub', '__init__.pxd'), ('sub', 'tools.pxd'),
+            ('sub', 'helpers.pxd')])
+
+        c_deps = graph.dependencies(os.path.join('pkg', 'ext.c'),
+                                    [str(include)])
+        assert c_deps == [str(include.join('inner.h')),
+                          str(include.join('outer.h'))]
+
+        graph.save()
+
+        # Scan results for unchanged files are reused from the saved graph
+        graph = DependencyGraph(graph_file)
+        key = str(pkg.join('local.pxd'))
+        graph.entries[key]['directives'] = []
+        assert (os.path.join('pkg', 'sub', 'tools.pxd') not in
+                graph.dependencies(os.path.join('pkg', 'local.pxd')))
+
+        # but changed files are scanned again
+        pkg.join('local.pxd').write('from pkg.sub.tools cimport y, z\n')
+        assert (graph.dependencies(os.path.join('pkg', 'local.pxd')) ==
+                [os.path.join('pkg', 'sub', 'tools.pxd')])
+
+
+def test_build_ext_rebuilds_dependents(tmpdir, capsys):
+    """
+    Changing a header included indirectly, or a .pxd file cimported by a
+    Cython extension, should rebuild only the extensions that depend on it.
+    """
 
-    # A simple setup.py for the test package--running register_commands should
-    # discover and enable the command hooks
-    test_pkg.join('setup.py').write(dedent("""\
-        import sys
-        from os.path import join
-        from setuptools import setup, Extension
-        sys.path.insert(0, r'{astropy_helpers_path}')
-        from astropy_helpers.setup_helpers import register_commands, get_package_info
+    test_pkg = _multi_extension_test_package(tmpdir)
+    package = test_pkg.join('apyhtest_multi')
+    package.join('common.h').write('#include "inner.h"\n')
+    package.join('inner.h').write('#define INNER 1\n')
+    unit02 = package.join('unit02.c')
+    unit02.write('#include "common.h"\n' + unit02.read())
 
-        NAME = '_welltall_'
-        VERSION = '0.1'
-        RELEASE = True
+    with test_pkg.as_cwd():
 
-        cmdclassd = register_commands(NAME, VERSION, RELEASE)
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        capsys.readouterr()
 
-        setup(
-            name=NAME,
-            version=VERSION,
-            cmdclass=cmdclassd
-        )
-    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+        package.join('inner.h').write('#define INNER 2\n')
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+
+        assert "building 'apyhtest_multi.unit02' extension" in stdout
+        for idx in (1, 3, 4):
+            assert ("skipping 'apyhtest_multi.unit0{0}' extension "
+                    "(unchanged)".format(idx)) in stdout
+
+
+def test_build_ext_rebuilds_cimport_dependents(tmpdir, capsys):
+    """
+    Changing a .pxd file cimported by a Cython extension should cythonize and
+    rebuild that extension again, but not other Cython extensions.
+    """
+
+    pytest.importorskip('Cython')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    # Cython is only used for developer versions once C files exist
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = apyhtest_multi
+        version = 0.1.dev
+    """))
+
+    package = test_pkg.join('apyhtest_multi')
+    package.join('shared.pxd').write(dedent("""\
+        cdef inline int value():
+            return 1
+    """))
+    package.join('unit05.pyx').write(dedent("""\
+        from apyhtest_multi.shared cimport value
+        VALUE = value()
+    """))
+    package.join('unit06.pyx').write('VALUE = 0\n')
 
     with test_pkg.as_cwd():
-        try:
-            run_setup('setup.py', ['build'])
-        finally:
-            cleanup_import('_welltall_')
 
-    stdout, stderr = capsys.readouterr()
-    want = dedent("""\
-        running build
-        running pre_hook from _welltall_.setup_package for build command
-        Hello build!
-        running post_hook from _welltall_.setup_package for build command
-        Goodbye build!
-    """).strip()
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        capsys.readouterr()
 
-    assert want in stdout.replace('\r\n', '\n').replace('\r', '\n')
+        package.join('shared.pxd').write(dedent("""\
+            cdef inline int value():
+                return 2
+        """))
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+
+        assert "building 'apyhtest_multi.unit05' extension" in stdout
+        assert "skipping 'apyhtest_multi.unit06' extension (unchanged)" in stdout
+
+    sys.path.insert(0, str(test_pkg))
+    try:
+        from apyhtest_multi.unit05 import VALUE
+        assert VALUE == 2
+    finally:
+        sys.path.remove(str(test_pkg))
+        cleanup_import('apyhtest_multi')
+
+
+def test_build_ext_cython_cache(tmpdir, capsys):
+    """
+    Files generated by Cython are cached, so that reverting a change to a
+    .pyx file does not require running Cython again.
+    """
+
+    pytest.importorskip('Cython')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = apyhtest_multi
+        version = 0.1.dev
+    """))
+
+    package = test_pkg.join('apyhtest_multi')
+    unit05 = package.join('unit05.pyx')
+    unit05.write('VALUE = 1\n')
+    package.join('unit06.pyx').write('VALUE = 0\n')
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+
+        for name in ('unit05', 'unit06'):
+            assert 'cythoning {0} to {1}'.format(
+                os.path.join('apyhtest_multi', name + '.pyx'),
+                os.path.join('apyhtest_multi', name + '.c')) in stdout
+
+        unit05.write('VALUE = 2\n')
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+
+        assert 'cythoning ' + os.path.join('apyhtest_multi', 'unit05.pyx') in stdout
+        assert 'cythoning ' + os.path.join('apyhtest_multi', 'unit06.pyx') not in stdout
+
+        unit05.write('VALUE = 1\n')
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+
+        assert 'cythoning' not in stdout
+        assert 'copying cached Cython output for unit05.c' in stdout
+
+        # Errors from Cython should be reported as such
+        unit05.write('VALUE = \n')
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--inplace', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+
+        assert "errors while compiling {0!r} with Cython".format(
+            os.path.join('apyhtest_multi', 'unit05.pyx')) in stdout + stderr
+
+
+def test_build_ext_cython_directives_profile(tmpdir, capsys):
+    """
+    The profiles of Cython directives defined in setup.cfg should be selected
+    depending on whether this is a debug build, and can be overridden for
+    specific packages.
+    """
+
+    pytest.importorskip('Cython')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = apyhtest_multi
+        version = 0.1.dev
+
+        [cython_directives:release]
+        cdivision = True
+        boundscheck = False
+
+        [cython_directives:debug]
+        cdivision = False
+
+        [cython_directives:release:apyhtest_multi.unit06]
+        cdivision = False
+    """))
+
+    package = test_pkg.join('apyhtest_multi')
+    for name in ('unit05', 'unit06'):
+        package.join(name + '.pyx').write(dedent("""\
+            def remainder(int a, int b):
+                return a % b
+        """))
+
+    def remainders():
+        # Extension modules can't be reloaded, so they are imported in a
+        # separate process
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit05, unit06; '
+            'print(unit05.remainder(-7, 2), unit06.remainder(-7, 2))'])
+        return [int(value) for value in output.split()]
+
+    with test_pkg.as_cwd():
+
+        # With cdivision, the result has the sign of the dividend like in C
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        assert remainders() == [-1, 1]
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.cython_directives_profile == 'release'
+
+        run_setup('setup.py', ['build_ext', '--inplace', '--debug'])
+        assert remainders() == [1, 1]
+
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--inplace',
+                                   '--cython-directives-profile=fast'])
+        stdout, stderr = capsys.readouterr()
+        assert "Cython directives profile 'fast' is not defined" in stderr
+
+        test_pkg.join('setup.cfg').write(
+            '[cython_directives:release:apyhtest_multi.unit05]\n'
+            'cdivison = True\n', mode='a')
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+        assert "unknown Cython directive 'cdivison'" in stdout + stderr
+
+
+def test_cython_profile(tmpdir, capsys):
+    """
+    The cython_profile command should build the Cython extensions with
+    profiling and line tracing in a separate build tree, leaving the
+    extensions built in place as they are, and report the hottest Cython
+    functions and lines of the workload.
+    """
+
+    pytest.importorskip('Cython')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    test_pkg.join('apyhtest_multi', 'unit05.pyx').write(dedent("""\
+        def total(int n):
+            cdef long s = 0
+            for i in range(n):
+                s += square(i)
+            return s
+
+        cdef long square(long x):
+            return x * x
+    """))
+    test_pkg.join('workload.py').write(dedent("""\
+        from apyhtest_multi.unit05 import total
+        for i in range(20):
+            total(1000)
+    """))
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        inplace = glob.glob(os.path.join('apyhtest_multi', 'unit05.*.so'))
+        assert inplace
+        with open(inplace[0], 'rb') as f:
+            inplace_data = f.read()
+        with open(os.path.join('apyhtest_multi', 'unit05.c')) as f:
+            c_source = f.read()
+
+        run_setup('setup.py', ['cython_profile', '--workload=workload.py',
+                               '--limit=5'])
+        stdout, stderr = capsys.readouterr()
+
+        assert '-DCYTHON_TRACE=1' in stdout
+        with open(inplace[0], 'rb') as f:
+            assert f.read() == inplace_data
+        # The C files generated with tracing enabled are not written to the
+        # source tree
+        with open(os.path.join('apyhtest_multi', 'unit05.c')) as f:
+            assert f.read() == c_source
+        assert glob.glob(os.path.join('build', 'temp.*-cython-profile', 'src',
+                                      'apyhtest_multi', 'unit05.c'))
+
+        with open(os.path.join('build', 'cython_profile.txt')) as f:
+            report = f.read()
+        assert report in stdout
+
+        unit05 = os.path.join('apyhtest_multi', 'unit05.pyx')
+        assert '{0}:1(total)'.format(unit05) in report
+        assert '{0}:7(square)'.format(unit05) in report
+        assert '20000  {0}:4  s += square(i)'.format(unit05) in report
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert not build_info.cython_profile
+        build_info = import_file(glob.glob(os.path.join(
+            'build', 'lib.*-cython-profile', 'apyhtest_multi',
+            'build_info.py'))[0])
+        assert build_info.cython_profile
+
+        # The workload is required unless there are PGO training workloads
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['cython_profile'])
+        stdout, stderr = capsys.readouterr()
+        assert '--workload is required' in stderr
+
+
+def test_cython_annotate(tmpdir, capsys):
+    """
+    The cython_annotate command should rank the functions and loops of all
+    the .pyx files by their annotation scores, and compare the scores with a
+    previous report.
+    """
+
+    pytest.importorskip('Cython')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    package = test_pkg.join('apyhtest_multi')
+    package.join('unit05.pyx').write(dedent("""\
+        def fast(int n):
+            cdef int i, s = 0
+            for i in range(n):
+                s += i
+            return s
+
+        cdef class Items:
+            cdef list items
+            def add(self, values):
+                for value in values:
+                    self.items.append(value)
+    """))
+    package.join('unit06.pyx').write(dedent("""\
+        def slow(values):
+            return [value * 2 for value in values]
+    """))
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['cython_annotate', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+
+        with open(os.path.join('build', 'cython_annotate.json')) as f:
+            report = json.load(f)
+
+        unit05 = 'apyhtest_multi/unit05.pyx'
+        functions = dict((item['name'], item) for item in report['functions'])
+        assert sorted(functions) == ['Items.add', 'fast', 'slow']
+        assert functions['Items.add']['file'] == unit05
+        assert functions['Items.add']['line'] == 9
+        assert functions['Items.add']['score'] > 0
+        assert functions['slow']['file'] == 'apyhtest_multi/unit06.pyx'
+        assert [item['name'] for item in report['loops']] == [
+            'Items.add: for value in values:', 'fast: for i in range(n):']
+        assert report['total'] == sum(report['files'].values())
+
+        with open(os.path.join('build', 'cython_annotate.txt')) as f:
+            text = f.read()
+        assert text in stdout
+        assert '{0}:9  Items.add'.format(unit05) in text
+
+        # Python operations in the loop increase its score
+        package.join('unit05.pyx').write(
+            package.join('unit05.pyx').read().replace('s += i',
+                                                      's += len(str(i))'))
+        shutil.copy(os.path.join('build', 'cython_annotate.json'),
+                    'previous.json')
+        run_setup('setup.py', ['-q', 'cython_annotate',
+                               '--compare=previous.json', '--output=current'])
+        stdout, stderr = capsys.readouterr()
+
+        with open('current.txt') as f:
+            text = f.read()
+        # The report is only written to the file with -q
+        assert 'Changes since the previous report' not in stdout
+        changes = text.split('Changes since the previous report')[1]
+        assert 'function  {0}:1  fast'.format(unit05) in changes
+        assert 'loop      {0}:3  fast: for i in range(n):'.format(
+            unit05) in changes
+        assert 'Items.add' not in changes
+
+
+def test_build_ext_object_cache(tmpdir, capsys):
+    """
+    With --object-cache=builtin, rebuilding unchanged sources in a clean
+    build directory should reuse the cached object files.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    cache_dir = str(tmpdir.join('cache'))
+    args = ['build_ext', '--inplace', '--object-cache=builtin',
+            '--object-cache-dir', cache_dir]
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', args)
+        stdout, stderr = capsys.readouterr()
+
+        assert 'object cache: 0 hits, 4 misses, 0 uncacheable' in stdout
+
+        shutil.rmtree('build')
+        for filename in test_pkg.join('apyhtest_multi').listdir('*.so'):
+            filename.remove()
+
+        run_setup('setup.py', args)
+        stdout, stderr = capsys.readouterr()
+
+        assert 'object cache: 4 hits, 0 misses, 0 uncacheable' in stdout
+        for idx in range(1, 5):
+            assert 'using cached object file for {0}'.format(
+                os.path.join('apyhtest_multi', 'unit0{0}.c'.format(idx))) in stdout
+
+    sys.path.insert(0, str(test_pkg))
+    try:
+        import apyhtest_multi.unit04  # noqa
+    finally:
+        sys.path.remove(str(test_pkg))
+        cleanup_import('apyhtest_multi')
+
+    with open(os.path.join(cache_dir, 'stats.json')) as f:
+        assert json.load(f) == {'hits': 4, 'misses': 4, 'uncacheable': 0}
+
+
+def test_object_cache_cleanup(tmpdir):
+    """
+    The least recently used object files should be removed once the cache
+    exceeds its maximum size.
+    """
+
+    from ..commands._objcache import ObjectCache, parse_size
+
+    assert parse_size('2048') == 2048
+    assert parse_size('1.5K') == 1536
+    assert parse_size('5G') == 5 * 1024 ** 3
+
+    cache = ObjectCache(str(tmpdir.join('cache')), max_size=3000)
+    obj = tmpdir.join('source.o')
+
+    for idx, key in enumerate(['aa' + str(idx) * 62 for idx in range(4)]):
+        obj.write(str(idx) * 1000)
+        cache.store(key, str(obj))
+        os.utime(cache._path(key), (idx, idx))
+
+    assert cache.cleanup() == 2000
+
+    assert not cache.fetch('aa' + '0' * 62, str(obj))
+    assert not cache.fetch('aa' + '1' * 62, str(obj))
+    assert cache.fetch('aa' + '3' * 62, str(obj))
+    assert obj.read() == '3' * 1000
+    assert cache.stats == {'hits': 1, 'misses': 2, 'uncacheable': 0}
+
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_build_ext_timings(tmpdir, capsys, jobs):
+    """
+    Test the report written by the --timings option.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    report_file = str(tmpdir.join('timings.json'))
+
+    # The preprocessed sizes are recorded when the object cache preprocesses
+    # the sources
+    with test_pkg.as_cwd():
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', jobs,
+                               '--timings-file', report_file,
+                               '--object-cache=builtin', '--object-cache-dir',
+                               str(tmpdir.join('cache'))])
+
+    stdout, stderr = capsys.readouterr()
+
+    with open(report_file) as f:
+        report = json.load(f)
+
+    assert report['jobs'] == int(jobs)
+
+    extensions = dict((ext['name'], ext) for ext in report['extensions'])
+    assert sorted(extensions) == [
+        'apyhtest_multi.unit0{0}'.format(idx) for idx in range(1, 5)]
+
+    for idx in range(1, 5):
+        ext = extensions['apyhtest_multi.unit0{0}'.format(idx)]
+        assert not ext['skipped']
+        assert ext['wall_time'] > 0
+        assert len(ext['compile']) == 1
+        assert ext['compile'][0]['source'] == os.path.join(
+            'apyhtest_multi', 'unit0{0}.c'.format(idx))
+        assert ext['compile'][0]['preprocessed_size'] > 0
+        assert ext['link']['wall_time'] > 0
+        if hasattr(os, 'wait4'):
+            assert ext['cpu_time'] > 0
+            assert ext['max_rss'] > 0
+
+    # The summary table should be sorted by CPU time
+    table = stdout.split('preprocessed [KiB]')[1].split('total wall time')[0]
+    names = [line.split()[0] for line in table.splitlines()[2:]]
+    assert sorted(names) == sorted(extensions)
+    if hasattr(os, 'wait4'):
+        cpu_times = [extensions[name]['cpu_time'] for name in names]
+        assert cpu_times == sorted(cpu_times, reverse=True)
+
+
+def _pgo_supported():
+    from distutils.ccompiler import new_compiler
+    from distutils.sysconfig import customize_compiler
+    from ..commands._pgo import get_compiler_family
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    return get_compiler_family(compiler) == 'gcc'
+
+
+@pytest.mark.skipif('not _pgo_supported()')
+def test_build_ext_pgo(tmpdir, capsys):
+    """
+    Test building extensions with --pgo and --lto.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    package = test_pkg.join('apyhtest_multi')
+
+    with test_pkg.as_cwd():
+
+        # The training workload is required
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--inplace', '--pgo'])
+        stdout, stderr = capsys.readouterr()
+        assert 'requires a get_pgo_training() function' in stdout + stderr
+
+        package.join('setup_package.py').write(
+            package.join('setup_package.py').read() + dedent("""
+                def _train():
+                    import apyhtest_multi.unit02
+                    assert join('pgo', 'lib') in apyhtest_multi.unit02.__file__
+
+                def get_pgo_training():
+                    return _train
+            """))
+
+        run_setup('setup.py', ['build_ext', '--inplace', '--pgo', '--lto'])
+        stdout, stderr = capsys.readouterr()
+
+        instrumented, optimized = stdout.split(
+            'building extensions using the collected profiles')
+        assert 'building instrumented extensions' in instrumented
+        assert ('running the PGO training workload from '
+                'apyhtest_multi.setup_package') in instrumented
+        assert '-fprofile-generate=' in instrumented
+        assert '-fprofile-use=' not in instrumented
+        assert '-fprofile-use=' in optimized
+        assert '-flto' in optimized
+
+        # The training should have imported the instrumented extension
+        profiles = glob.glob(os.path.join('build', '*', 'pgo', 'profiles',
+                                          '*.gcda'))
+        assert any('unit02' in profile for profile in profiles)
+        assert not any('unit03' in profile for profile in profiles)
+
+    sys.path.insert(0, str(test_pkg))
+    try:
+        import apyhtest_multi.unit02  # noqa
+        assert apyhtest_multi.unit02.__file__.startswith(str(package))
+    finally:
+        sys.path.remove(str(test_pkg))
+        cleanup_import('apyhtest_multi')
+
+
+@pytest.mark.skipif("sys.platform.startswith('win')")
+def test_find_llvm_profdata(tmpdir, monkeypatch):
+    """
+    The llvm-profdata matching the version of Clang is preferred, and
+    otherwise the most recent of the versioned executables.
+    """
+
+    from ..commands._pgo import find_llvm_profdata
+
+    for version in ('9', '10', '14'):
+        path = tmpdir.join('llvm-profdata-' + version)
+        path.write('')
+        path.chmod(0o755)
+
+    monkeypatch.setenv('PATH', str(tmpdir))
+    monkeypatch.setattr(sys, 'platform', 'linux')
+
+    assert find_llvm_profdata() == str(tmpdir.join('llvm-profdata-14'))
+    assert find_llvm_profdata('10.0.1') == str(tmpdir.join('llvm-profdata-10'))
+    assert find_llvm_profdata('12.0.0') == str(tmpdir.join('llvm-profdata-14'))
+
+
+def test_build_ext_variants(tmpdir, capsys):
+    """
+    Each build variant should be built in its own temporary directory, so
+    that switching between variants does not rebuild the extensions.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    def build(*args):
+        run_setup('setup.py', ['build_ext', '--inplace'] + list(args))
+        stdout, stderr = capsys.readouterr()
+        built = test_pkg.join('apyhtest_multi').listdir('unit01.*')
+        return stdout, [path.read_binary() for path in built
+                        if path.ext != '.c'][0]
+
+    with test_pkg.as_cwd():
+
+        stdout, release = build()
+        assert 'skipping' not in stdout
+
+        stdout, debug = build('--variant=debug')
+        assert 'skipping' not in stdout
+        assert '-UNDEBUG' in stdout
+        assert debug != release
+
+        temp_dirs = glob.glob(os.path.join('build', 'temp.*'))
+        assert len(temp_dirs) == 2
+        assert len([path for path in temp_dirs
+                    if path.endswith('-debug')]) == 1
+
+        # Switching back to a variant should only copy its extensions
+        for args, expected in [((), release), (('--variant=debug',), debug),
+                               (('--variant=release',), release)]:
+            stdout, built = build(*args)
+            for idx in range(1, 5):
+                assert ("skipping 'apyhtest_multi.unit0{0}' extension "
+                        "(unchanged)".format(idx)) in stdout
+            assert built == expected
+
+        # --debug on its own does not select the debug variant, but is built
+        # in its own temporary directory
+        stdout, built = build('--debug')
+        assert '-UNDEBUG' not in stdout
+        assert '-O0' not in stdout
+        assert len(glob.glob(os.path.join('build', 'temp.*-release-g'))) == 1
+
+        # The build information records the variant
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.variant == 'release'
+        assert build_info.debug
+
+        # so that switching back to a release build does not rebuild either
+        stdout, built = build()
+        assert ("skipping 'apyhtest_multi.unit01' extension "
+                "(unchanged)") in stdout
+        assert built == release
+
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--variant=fast'])
+        stdout, stderr = capsys.readouterr()
+        assert '--variant should be one of' in stderr
+
+
+def test_build_ext_bundled_libraries(tmpdir, capsys):
+    """
+    Bundled libraries should be built once into a static archive linked into
+    the extensions that use them (compiling their sources in parallel with
+    --jobs), and sources compiled with the same arguments by several
+    extensions should only be compiled once.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    cextern = test_pkg.mkdir('cextern')
+    cextern.join('answer.h').write('int answer(void);\n')
+    cextern.join('answer.c').write(
+        '#include "answer.h"\nint answer(void) { return half() * 2; }\n')
+    cextern.join('half.c').write('int half(void) { return 21; }\n')
+    cextern.join('shared.c').write('int shared(void) { return 1; }\n')
+
+    # unit01 and unit02 use the bundled library, and unit03 and unit04 share
+    # a source file
+    source = dedent("""\
+        #include <Python.h>
+        #include "answer.h"
+        static struct PyModuleDef moduledef = {{
+            PyModuleDef_HEAD_INIT, "{0}", NULL, -1, NULL
+        }};
+        PyMODINIT_FUNC
+        PyInit_{0}(void) {{
+            PyObject *module = PyModule_Create(&moduledef);
+            PyModule_AddIntConstant(module, "answer", answer());
+            return module;
+        }}
+    """)
+    for name in ('unit01', 'unit02'):
+        test_pkg.join('apyhtest_multi', name + '.c').write(source.format(name))
+
+    test_pkg.join('apyhtest_multi', 'setup_package.py').write(dedent("""\
+        from setuptools import Extension
+        from os.path import join
+
+        from astropy_helpers.commands import _parallel
+
+        # Record the sources compiled through the jobserver (this module may
+        # be imported more than once)
+        _run_command = getattr(_parallel.run_command, 'wrapped',
+                               _parallel.run_command)
+
+        def run_command(cmd, env=None):
+            for arg in cmd:
+                if arg.endswith('.c'):
+                    print('jobserver: ' + arg)
+            return _run_command(cmd, env=env)
+
+        run_command.wrapped = _run_command
+        _parallel.run_command = run_command
+
+        def get_bundled_libraries():
+            return [('apyhtestlib',
+                     {'sources': [join('cextern', 'answer.c'),
+                                  join('cextern', 'half.c')],
+                      'include_dirs': ['cextern']})]
+
+        def get_extensions():
+            return ([Extension('apyhtest_multi.' + name,
+                               [join('apyhtest_multi', name + '.c')],
+                               libraries=['apyhtestlib'])
+                     for name in ('unit01', 'unit02')] +
+                    [Extension('apyhtest_multi.' + name,
+                               [join('apyhtest_multi', name + '.c'),
+                                join('cextern', 'shared.c')])
+                     for name in ('unit03', 'unit04')])
+    """))
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', '1'])
+        stdout, stderr = capsys.readouterr()
+
+        assert ("building bundled library 'apyhtestlib' for "
+                "apyhtest_multi.unit01, apyhtest_multi.unit02") in stdout
+        assert stdout.count(os.path.join('cextern', 'half.c')) == 1
+        assert stdout.count(os.path.join('cextern', 'shared.c')) == 1
+        assert ('reused 1 object file(s) compiled for other extensions'
+                in stdout)
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01, unit02; '
+            'print(unit01.answer, unit02.answer)'])
+        assert output.split() == [b'42', b'42']
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.bundled_libraries == ['apyhtestlib']
+
+        # Changing the library rebuilds it, and relinks the extensions using
+        # it, but not the other extensions
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        stdout, stderr = capsys.readouterr()
+        assert "skipping bundled library 'apyhtestlib' (unchanged)" in stdout
+
+        # With --jobs, the sources of the library are compiled through the
+        # jobserver too
+        cextern.join('half.c').write('int half(void) { return 5; }\n')
+        run_setup('setup.py', ['build_ext', '--inplace', '-j', '2'])
+        stdout, stderr = capsys.readouterr()
+        assert "building bundled library 'apyhtestlib'" in stdout
+        assert 'jobserver: ' + os.path.join('cextern', 'half.c') in stdout
+        for name in ('unit03', 'unit04'):
+            assert ("skipping 'apyhtest_multi.{0}' extension "
+                    "(unchanged)".format(name)) in stdout
+        for name in ('unit01', 'unit02'):
+            assert ("skipping 'apyhtest_multi.{0}' extension "
+                    "(unchanged)".format(name)) not in stdout
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01; '
+            'print(unit01.answer)'])
+        assert output.split() == [b'10']
+
+
+def test_build_ext_library_cache(tmpdir, capsys):
+    """
+    With --library-cache, the archives of bundled libraries should be
+    restored from the cache by builds of the same sources in other locations.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+    cache_dir = str(tmpdir.join('library_cache'))
+
+    cextern = test_pkg.mkdir('cextern')
+    cextern.join('answer.c').write('int answer(void) { return 42; }\n')
+
+    test_pkg.join('apyhtest_multi', 'unit01.c').write(dedent("""\
+        #include <Python.h>
+        int answer(void);
+        static struct PyModuleDef moduledef = {
+            PyModuleDef_HEAD_INIT, "unit01", NULL, -1, NULL
+        };
+        PyMODINIT_FUNC
+        PyInit_unit01(void) {
+            PyObject *module = PyModule_Create(&moduledef);
+            PyModule_AddIntConstant(module, "answer", answer());
+            return module;
+        }
+    """))
+
+    test_pkg.join('apyhtest_multi', 'setup_package.py').write(dedent("""\
+        from setuptools import Extension
+        from os.path import join
+
+        def get_bundled_libraries():
+            return [('apyhtestlib',
+                     {'sources': [join('cextern', 'answer.c')]})]
+
+        def get_extensions():
+            return [Extension('apyhtest_multi.unit01',
+                              [join('apyhtest_multi', 'unit01.c')],
+                              libraries=['apyhtestlib'])]
+    """))
+
+    other_pkg = str(tmpdir.join('other_pkg'))
+    shutil.copytree(str(test_pkg), other_pkg)
+
+    args = ['build_ext', '--inplace', '--library-cache',
+            '--library-cache-dir', cache_dir]
+
+    with test_pkg.as_cwd():
+        run_setup('setup.py', args)
+        stdout, stderr = capsys.readouterr()
+        assert "building bundled library 'apyhtestlib'" in stdout
+
+    assert len(os.listdir(cache_dir)) == 1
+
+    # The same sources in another directory use the cached archive
+    with tmpdir.join('other_pkg').as_cwd():
+        run_setup('setup.py', args)
+        stdout, stderr = capsys.readouterr()
+        assert ("restored bundled library 'apyhtestlib' from the library "
+                "cache") in stdout
+        assert "building bundled library 'apyhtestlib'" not in stdout
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01; '
+            'print(unit01.answer)'])
+        assert output.split() == [b'42']
+
+        # Changing the sources of the library changes the key
+        tmpdir.join('other_pkg', 'cextern', 'answer.c').write(
+            'int answer(void) { return 7; }\n')
+        run_setup('setup.py', args)
+        stdout, stderr = capsys.readouterr()
+        assert "building bundled library 'apyhtestlib'" in stdout
+
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_build_ext_fast_linker(tmpdir, capsys, monkeypatch):
+    """
+    With --fast-linker=auto, extensions should be linked with the fastest
+    linker that works, which is recorded in the build_info module. The
+    default is set by ASTROPY_HELPERS_FAST_LINKER.
+    """
+
+    from ..linker_helpers import find_fast_linker
+
+    linker = find_fast_linker('auto')
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace',
+                               '--fast-linker=auto'])
+        stdout, stderr = capsys.readouterr()
+
+        if linker is None:
+            assert ('none of the faster linkers could be used' in
+                    stdout + stderr)
+        else:
+            assert 'linking extensions with {0}'.format(linker) in stdout
+            assert '-fuse-ld=' + linker in stdout
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01; '
+            'print(unit01.__name__)'])
+        assert output.split() == [b'apyhtest_multi.unit01']
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.linker == linker
+
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext', '--fast-linker=bfd'])
+        stdout, stderr = capsys.readouterr()
+        assert '--fast-linker should be one of' in stderr
+
+        monkeypatch.setenv('ASTROPY_HELPERS_FAST_LINKER', 'bfd')
+        with pytest.raises(SystemExit):
+            run_setup('setup.py', ['build_ext'])
+        stdout, stderr = capsys.readouterr()
+        assert '--fast-linker should be one of' in stderr
+
+        # The option takes precedence over the environment variable
+        run_setup('setup.py', ['build_ext', '--fast-linker=none'])
+        capsys.readouterr()
+
+
+@pytest.mark.skipif("sys.platform.startswith('win')")
+def test_build_ext_optimize_output(tmpdir, capsys):
+    """
+    With --optimize-output, the debug information of the extensions should be
+    moved to separate files, and the sizes before and after reported.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    # A helper function which is only visible within the extension
+    test_pkg.join('apyhtest_multi', 'unit01.c').write(
+        'int apyhtest_helper(void) { return 1; }\n' +
+        test_pkg.join('apyhtest_multi', 'unit01.c').read())
+
+    with test_pkg.as_cwd():
+
+        run_setup('setup.py', ['build_ext', '--inplace', '--optimize-output',
+                               '--debug-info-dir', 'debug-info'])
+        stdout, stderr = capsys.readouterr()
+
+        assert '-ffunction-sections' in stdout
+        assert 'before [KiB]' in stdout
+        for name in ('unit01', 'unit02', 'unit03', 'unit04'):
+            assert 'apyhtest_multi.' + name in stdout
+
+        debug_files = os.listdir(os.path.join('debug-info', 'apyhtest_multi'))
+        assert len(debug_files) == 4
+
+        # Debuggers find the debug files from the build ID of the extensions
+        if sys.platform.startswith('linux'):
+            from ..commands._output import get_build_id
+            ext_path = glob.glob(os.path.join('apyhtest_multi',
+                                              'unit01*.so'))[0]
+            build_id = get_build_id(ext_path)
+            if build_id is not None:
+                link = os.path.join('debug-info', '.build-id', build_id[:2],
+                                    build_id[2:] + '.debug')
+                assert os.path.realpath(link) == os.path.realpath(
+                    os.path.join('debug-info', 'apyhtest_multi',
+                                 os.path.basename(ext_path) + '.debug'))
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.optimize_output
+
+        output = subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01; '
+            'print(unit01.__name__)'])
+        assert output.split() == [b'apyhtest_multi.unit01']
+
+        # Only the module initialization functions are exported
+        if sys.version_info >= (3, 9) and sys.platform.startswith('linux'):
+            ext_path = glob.glob(os.path.join('apyhtest_multi',
+                                              'unit01*.so'))[0]
+            try:
+                symbols = subprocess.check_output(['nm', '-D',
+                                                   '--defined-only',
+                                                   ext_path])
+            except OSError:
+                pytest.skip('nm is not available')
+            assert b'PyInit_unit01' in symbols
+            assert b'apyhtest_helper' not in symbols
+
+
+@pytest.mark.skipif("platform.machine().lower() not in "
+                    "('x86_64', 'amd64', 'i686')")
+def test_build_ext_isa_variants(tmpdir, capsys):
+    """
+    Extensions marked with add_isa_variants should be built for each
+    instruction set level, and imported through a dispatcher module which
+    selects the best variant, or the one set in ASTROPY_HELPERS_ISA.
+    """
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    test_pkg.join('apyhtest_multi', 'unit01.c').write(dedent("""\
+        #include <Python.h>
+        static struct PyModuleDef moduledef = {
+            PyModuleDef_HEAD_INIT, "unit01", NULL, -1, NULL
+        };
+        PyMODINIT_FUNC
+        PyInit_unit01(void) {
+            PyObject *module = PyModule_Create(&moduledef);
+        #if defined(__AVX512F__)
+            PyModule_AddStringConstant(module, "isa", "avx512");
+        #elif defined(__AVX2__)
+            PyModule_AddStringConstant(module, "isa", "avx2");
+        #else
+            PyModule_AddStringConstant(module, "isa", "baseline");
+        #endif
+            return module;
+        }
+    """))
+
+    test_pkg.join('apyhtest_multi', 'setup_package.py').write(dedent("""\
+        from setuptools import Extension
+        from os.path import join
+        from astropy_helpers.cpu_helpers import add_isa_variants
+
+        def get_extensions():
+            return [add_isa_variants(
+                        Extension('apyhtest_multi.unit01',
+                                  [join('apyhtest_multi', 'unit01.c')]),
+                        levels=['avx2']),
+                    Extension('apyhtest_multi.unit02',
+                              [join('apyhtest_multi', 'unit02.c')])]
+    """))
+
+    def import_unit01(level=None):
+        env = dict(os.environ)
+        env.pop('ASTROPY_HELPERS_ISA', None)
+        if level is not None:
+            env['ASTROPY_HELPERS_ISA'] = level
+        return subprocess.check_output([
+            sys.executable, '-c', 'from apyhtest_multi import unit01; '
+            'print(unit01.__name__, unit01.isa, unit01.__isa_level__)'],
+            env=env).decode('ascii').split()
+
+    with test_pkg.as_cwd():
+
+        # Builds outside of the source tree write the dispatcher to the build
+        # directory, and leave the source tree alone
+        in_place = os.path.join('apyhtest_multi',
+                                'unit01' + EXTENSION_SUFFIXES[0])
+        with open(in_place, 'wb') as f:
+            f.write(b'previous in-place build')
+        run_setup('setup.py', ['build_ext'])
+        stdout, stderr = capsys.readouterr()
+        assert not os.path.exists(os.path.join('apyhtest_multi', 'unit01.py'))
+        assert os.path.isfile(in_place)
+        assert glob.glob(os.path.join('build', 'lib*', 'apyhtest_multi',
+                                      'unit01.py'))
+
+        for level in ('avx2', 'baseline'):
+            assert ("building 'apyhtest_multi.unit01__{0}' "
+                    "extension".format(level)) in stdout
+        assert "building 'apyhtest_multi.unit02' extension" in stdout
+
+        run_setup('setup.py', ['build_ext', '--inplace'])
+        capsys.readouterr()
+        assert not os.path.exists(in_place)
+
+        for level in ('avx2', 'baseline'):
+            assert glob.glob(os.path.join(
+                'apyhtest_multi', 'unit01__{0}.*'.format(level)))
+        assert os.path.isfile(os.path.join('apyhtest_multi', 'unit01.py'))
+
+        build_info = import_file(os.path.join('apyhtest_multi',
+                                              'build_info.py'))
+        assert build_info.isa_variants == {
+            'apyhtest_multi.unit01': ['avx2', 'baseline']}
+
+        name, isa, level = import_unit01()
+        assert name == 'apyhtest_multi.unit01'
+        assert isa == level and level in ('avx2', 'baseline')
+
+        assert import_unit01('baseline') == ['apyhtest_multi.unit01',
+                                             'baseline', 'baseline']
+
+        with pytest.raises(subprocess.CalledProcessError):
+            import_unit01('avx512')
+
+
+def test_build_ext_precompiled_headers(tmpdir, capsys):
+    """
+    With --precompiled-headers, the Python headers should be precompiled once
+    for all the sources that include them with the same options.
+    """
+
+    from ..commands._pch import scan_source
+
+    test_pkg = _multi_extension_test_package(tmpdir)
+
+    with test_pkg.as_cwd():
+
+        # Sources that include another header first are not eligible
+        test_pkg.join('apyhtest_multi', 'unit04.c').write(
+            '#include <stdio.h>\n' +
+            test_pkg.join('apyhtest_multi', 'unit04.c').read())
+        assert scan_source(os.path.join('apyhtest_multi', 'unit04.c')) is None
+        assert scan_source(os.path.join('apyhtest_multi', 'unit01.c')) == (
+            [], False)
+
+        run_setup('setup.py', ['build_ext', '--inplace',
+                               '--precompiled-headers'])
+        stdout, stderr = capsys.readouterr()
+
+        if 'precompiled headers can\'t be used' in stdout + stderr:
+            pytest.skip('precompiled headers are not supported by the '
+                        'compiler')
+
+        assert ('precompiled headers: 1 built, used for 3 source(s), 0 '
+                'source(s) compiled without them after a failure, 1 source(s) '
+                'not eligible') in stdout
+
+        for idx in range(1, 5):
+            assert len(glob.glob(os.path.join(
+                'apyhtest_multi', 'unit0{0}.*'.format(idx)))) == 2
+
+
+@pytest.mark.parametrize('mode', ['cli', 'cli-w', 'cli-sphinx', 'cli-l', 'cli-parallel'])
+def test_build_docs(capsys, tmpdir, mode):
+    """
+    Test for build_docs
+    """
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+
+    test_pkg.mkdir('mypackage')
+
+    test_pkg.join('mypackage').join('__init__.py').write(dedent("""\
+        def test_function():
+            pass
+
+        class A():
+            pass
+
+        class B(A):
+            pass
+    """))
+
+    test_pkg.mkdir('docs')
+
+    docs_dir = test_pkg.join('docs')
+    docs_dir.join('conf.py').write(dedent("""\
+        import warnings
+        with warnings.catch_warnings():  # ignore matplotlib warning
+            warnings.simplefilter("ignore")
+            from sphinx_astropy.conf import *
+        exclude_patterns.append('_templates')
+        suppress_warnings = ['app.add_directive', 'app.add_node', 'app.add_role']
+    """))  # noqa
+
+    docs_dir.join('index.rst').write(dedent("""\
+        .. automodapi:: mypackage
+           :no-inheritance-diagram:
+    """))
+
+    # For this test we try out the new way of calling register_commands without
+    # arugments, instead getting the information from setup.cfg.
+    test_pkg.join('setup.cfg').write(dedent("""
+        [metadata]
+        name = mypackage
+        version = 0.1
+    """))
+
+    test_pkg.join('setup.py').write(dedent("""\
+        import sys
+        sys.path.insert(0, r'{astropy_helpers_path}')
+        from astropy_helpers.setup_helpers import setup
+        setup()
+    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+
+    with test_pkg.as_cwd():
+
+        if mode == 'cli':
+            run_setup('setup.py', ['build_docs'])
+        elif mode == 'cli-w':
+            run_setup('setup.py', ['build_docs', '-w'])
+        elif mode == 'cli-l':
+            run_setup('setup.py', ['build_docs', '-l'])
+        elif mode == 'cli-sphinx':
+            run_setup('setup.py', ['build_sphinx'])
+        elif mode == 'cli-parallel':
+            run_setup('setup.py', ['build_docs', '--parallel=2'])
+
+    assert os.path.exists(docs_dir.join('_build', 'html', 'index.html').strpath)
+
+
+def test_command_hooks(tmpdir, capsys):
+    """A basic test for pre- and post-command hooks."""
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('_welltall_')
+    test_pkg.join('_welltall_', '__init__.py').ensure()
+
+    # Create a setup_package module with a couple of command hooks in it
+    test_pkg.join('_welltall_', 'setup_package.py').write(dedent("""\
+        def pre_build_hook(cmd_obj):
+            print('Hello build!')
+
+        def post_build_hook(cmd_obj):
+            print('Goodbye build!')
+
+    """))
+
+    # A simple setup.py for the test package--running register_commands should
+    # discover and enable the command hooks
+    test_pkg.join('setup.py').write(dedent("""\
+        import sys
+        from os.path import join
+        from setuptools import setup, Extension
+        sys.path.insert(0, r'{astropy_helpers_path}')
+        from astropy_helpers.setup_helpers import register_commands, get_package_info
+
+        NAME = '_welltall_'
+        VERSION = '0.1'
+        RELEASE = True
+
+        cmdclassd = register_commands(NAME, VERSION, RELEASE)
+
+        setup(
+            name=NAME,
+            version=VERSION,
+            cmdclass=cmdclassd
+        )
+    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+
+    with test_pkg.as_cwd():
+        try:
+            run_setup('setup.py', ['build'])
+        finally:
+            cleanup_import('_welltall_')
+
+    stdout, stderr = capsys.readouterr()
+    want = dedent("""\
+        running build
+        running pre_hook from _welltall_.setup_package for build command
+        Hello build!
+        running post_hook from _welltall_.setup_package for build command
+        Goodbye build!
+    """).strip()
+
+    assert want in stdout.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def test_setup_package_registry(tmpdir, capsys):
+    """
+    The setup_package.py modules are imported once and shared by
+    get_package_info and add_command_hooks, unless they are modified.
+    """
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('_registry_')
+    test_pkg.join('_registry_', '__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = _registry_
+    """))
+
+    setup_package = test_pkg.join('_registry_', 'setup_package.py')
+    setup_package.write(dedent("""\
+        print('importing setup_package')
+
+        def get_package_data():
+            return {'_registry_': ['data.txt']}
+
+        def pre_build_hook(cmd_obj):
+            pass
+    """))
+
+    with test_pkg.as_cwd():
+        try:
+            commands = register_commands()
+            assert 'build' in commands
+            get_package_info()
+            package_info = get_package_info()
+            assert package_info['package_data']['_registry_'] == ['data.txt']
+
+            stdout, stderr = capsys.readouterr()
+            assert stdout.count('importing setup_package') == 1
+
+            setup_package.write(setup_package.read().replace('data.txt',
+                                                             'other.txt'))
+            package_info = get_package_info()
+            assert package_info['package_data']['_registry_'] == ['other.txt']
+
+            stdout, stderr = capsys.readouterr()
+            assert stdout.count('importing setup_package') == 1
+        finally:
+            cleanup_import('_registry_')
+
+
+def test_package_info_cache(tmpdir, capsys, monkeypatch):
+    """
+    With ASTROPY_HELPERS_PACKAGE_INFO_CACHE, the results of get_package_info
+    are restored without importing the setup_package.py modules, until they,
+    the source files or the sources of the extensions change.
+    """
+
+    monkeypatch.setenv('ASTROPY_HELPERS_PACKAGE_INFO_CACHE', '1')
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('_cachedinfo_')
+    test_pkg.join('_cachedinfo_', '__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = _cachedinfo_
+    """))
+
+    setup_package = test_pkg.join('_cachedinfo_', 'setup_package.py')
+    setup_package.write(dedent("""\
+        from glob import glob
+        from distutils.core import Extension
+
+        print('importing setup_package')
+
+        def get_extensions():
+            sources = ['_cachedinfo_/ext.c'] + sorted(glob('cextern/*.c'))
+            return [Extension('_cachedinfo_.ext', sources,
+                              define_macros=[('ANSWER', '42')])]
+
+        def get_build_options():
+            return [('with-answer', 'Build with the answer', True)]
+    """))
+
+    test_pkg.join('setup.py').write(dedent("""\
+        import sys
+        sys.path.insert(0, r'{astropy_helpers_path}')
+        from astropy_helpers.setup_helpers import (register_commands,
+                                                   get_package_info)
+        from astropy_helpers.distutils_helpers import get_distutils_build_option
+
+        cmdclassd = register_commands()
+        package_info = get_package_info()
+        for ext in package_info['ext_modules']:
+            print('extension', ext.name, ext.define_macros)
+        print('with-answer', get_distutils_build_option('with_answer'))
+        print('sources', package_info['ext_modules'][0].sources)
+    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+
+    test_pkg.mkdir('cextern')
+    test_pkg.join('cextern', 'a.c').write('int a;\n')
+
+    def run():
+        with test_pkg.as_cwd():
+            run_setup('setup.py', ['build', '--with-answer'])
+        stdout, stderr = capsys.readouterr()
+        return stdout
+
+    stdout = run()
+    assert stdout.count('importing setup_package') == 1
+    assert "extension _cachedinfo_.ext [('ANSWER', '42')]" in stdout
+    assert 'with-answer 1' in stdout
+    assert test_pkg.join('build', 'package_info.pickle').check()
+
+    stdout = run()
+    assert 'importing setup_package' not in stdout
+    assert "extension _cachedinfo_.ext [('ANSWER', '42')]" in stdout
+    assert 'with-answer 1' in stdout
+
+    # New .pyx files and changes to setup_package.py invalidate the cache
+    test_pkg.join('_cachedinfo_', 'fast.pyx').ensure()
+    stdout = run()
+    assert stdout.count('importing setup_package') == 1
+    assert 'extension _cachedinfo_.fast' in stdout
+
+    setup_package.write(setup_package.read().replace("'42'", "'43'"))
+    stdout = run()
+    assert stdout.count('importing setup_package') == 1
+    assert "extension _cachedinfo_.ext [('ANSWER', '43')]" in stdout
+
+    # So do new files next to the sources of the extensions, even outside of
+    # the packages, and new C files in the packages
+    test_pkg.join('cextern', 'b.c').write('int b;\n')
+    stdout = run()
+    assert stdout.count('importing setup_package') == 1
+    assert "'cextern/a.c', 'cextern/b.c'" in stdout
+
+    stdout = run()
+    assert 'importing setup_package' not in stdout
+
+    test_pkg.join('_cachedinfo_', 'ext.c').write('int ext;\n')
+    stdout = run()
+    assert stdout.count('importing setup_package') == 1
+
+
+def test_setup_metadata_fast_path(tmpdir, capsys, monkeypatch):
+    """
+    The setup_package.py modules are not imported for display options and
+    metadata-only commands.
+    """
+
+    from ..distutils_helpers import get_metadata_only_commands
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('metaonly')
+    test_pkg.join('metaonly', '__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = metaonly
+        version = 0.2
+    """))
+    test_pkg.join('metaonly', 'setup_package.py').write(dedent("""\
+        print('importing setup_package')
+    """))
+    test_pkg.join('setup.py').write(dedent("""\
+        import sys
+        sys.path.insert(0, r'{astropy_helpers_path}')
+        from astropy_helpers.setup_helpers import setup
+        setup()
+    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+
+    with test_pkg.as_cwd():
+        run_setup('setup.py', ['--name'])
+        stdout, stderr = capsys.readouterr()
+        assert stdout.strip() == 'metaonly'
+
+        run_setup('setup.py', ['--version'])
+        stdout, stderr = capsys.readouterr()
+        assert stdout.strip() == '0.2'
+
+        run_setup('setup.py', ['egg_info', '--egg-base', str(tmpdir)])
+        stdout, stderr = capsys.readouterr()
+        assert 'importing setup_package' not in stdout
+        assert tmpdir.join('metaonly.egg-info',
+                           'top_level.txt').read().strip() == 'metaonly'
+
+        # dist_info is not a display option, but is a metadata command too
+        # (running it needs the wheel package)
+        monkeypatch.setattr(sys, 'argv', ['setup.py', 'dist_info'])
+        assert get_metadata_only_commands() == ['dist_info']
+        monkeypatch.setattr(sys, 'argv', ['setup.py', 'dist_info', 'build'])
+        assert get_metadata_only_commands() is None
+
+        run_setup('setup.py', ['build'])
+        stdout, stderr = capsys.readouterr()
+        assert 'importing setup_package' in stdout
+
+
+def test_setup_metadata_fast_path_excludes(tmpdir, capsys):
+    """
+    The metadata fast path finds the same packages as get_package_info,
+    honoring add_exclude_packages.
+    """
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('metaexcl')
+    test_pkg.join('metaexcl', '__init__.py').ensure()
+    test_pkg.join('metaexcl', 'kept').mkdir()
+    test_pkg.join('metaexcl', 'kept', '__init__.py').ensure()
+    test_pkg.join('metaexcl', 'skipped').mkdir()
+    test_pkg.join('metaexcl', 'skipped', '__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = metaexcl
+        version = 0.2
+    """))
+    test_pkg.join('setup.py').write(dedent("""\
+        import sys
+        sys.path.insert(0, r'{astropy_helpers_path}')
+        from astropy_helpers.setup_helpers import add_exclude_packages, setup
+        add_exclude_packages(['metaexcl.skipped'])
+        setup()
+    """.format(astropy_helpers_path=ASTROPY_HELPERS_PATH)))
+
+    with test_pkg.as_cwd():
+        run_setup('setup.py', ['egg_info', '--egg-base', str(tmpdir)])
+        capsys.readouterr()
+
+    sources = tmpdir.join('metaexcl.egg-info', 'SOURCES.txt').read()
+    assert 'metaexcl/kept/__init__.py' in sources
+    assert 'metaexcl/skipped' not in sources
+
+
+def test_get_package_info_jobs(tmpdir, capsys):
+    """
+    The get_extensions() and get_package_data() functions can be called
+    concurrently, with the results and output in the order of the packages,
+    and without one of them silencing the output of the others.
+    """
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    test_pkg.mkdir('_concurrent_')
+    test_pkg.join('_concurrent_', '__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = _concurrent_
+    """))
+
+    # The first packages take the longest, so that they finish last
+    for idx in range(4):
+        subpkg = test_pkg.join('_concurrent_').mkdir('sub{0}'.format(idx))
+        subpkg.join('__init__.py').ensure()
+        subpkg.join('setup_package.py').write(dedent("""\
+            import time
+            from distutils import log
+            from distutils.core import Extension
+            from astropy_helpers.utils import silence
+
+            def get_extensions():
+                with silence():
+                    print('silenced sub{idx}')
+                    time.sleep({delay})
+                print('printed sub{idx}')
+                log.warn('collecting sub{idx}')
+                return [Extension('_concurrent_.sub{idx}.ext', ['ext.c'])]
+
+            def get_package_data():
+                return {{'_concurrent_.sub{idx}': ['data.txt']}}
+        """.format(idx=idx, delay=0.1 * (4 - idx))))
+
+    with test_pkg.as_cwd():
+        try:
+            register_commands()
+            package_info = get_package_info(jobs=4)
+        finally:
+            cleanup_import('_concurrent_')
+
+    # The same order as when the functions are called sequentially
+    subpackages = [package for package in package_info['packages']
+                   if package != '_concurrent_']
+    assert len(subpackages) == 4
+    assert [ext.name for ext in package_info['ext_modules']] == [
+        package + '.ext' for package in subpackages]
+    assert list(package_info['package_data']) == subpackages
+
+    stdout, stderr = capsys.readouterr()
+    output = stdout + stderr
+    positions = [output.index('collecting ' + package.split('.')[-1])
+                 for package in subpackages]
+    assert positions == sorted(positions)
+    positions = [stdout.index('printed ' + package.split('.')[-1])
+                 for package in subpackages]
+    assert positions == sorted(positions)
+    assert 'silenced' not in output
+
+    test_pkg.join('_concurrent_', 'sub2', 'setup_package.py').write(dedent("""\
+        def get_extensions():
+            raise ValueError('no extensions here')
+    """))
+
+    with test_pkg.as_cwd():
+        try:
+            with pytest.raises(DistutilsSetupError) as exc:
+                get_package_info(jobs=4)
+        finally:
+            cleanup_import('_concurrent_')
+
+    assert str(exc.value) == ('_concurrent_.sub2.setup_package.'
+                              'get_extensions() failed: ValueError: no '
+                              'extensions here')
+
+
+def test_setup_package_cfg(tmpdir, capsys):
+    """
+    Extensions and package data declared in setup_package.cfg files are
+    combined with those from setup_package.py modules.
+    """
+
+    test_pkg = tmpdir.mkdir('test_pkg')
+    package = test_pkg.mkdir('_declared_')
+    package.join('__init__.py').ensure()
+    test_pkg.join('setup.cfg').write(dedent("""\
+        [metadata]
+        name = _declared_
+    """))
+
+    src = package.mkdir('src')
+    src.join('a.c').ensure()
+    src.join('b.c').ensure()
+    package.join('setup_package.cfg').write(dedent("""\
+        [extension:._fast]
+        sources = src/*.c
+        include_dirs = numpy
+                       src
+        define_macros = NDEBUG HAVE_FAST=1
+        extra_compile_args = -O3
+        optional = true
+
+        [package_data]
+        . = data/*.txt
+    """))
+
+    subpackage = package.mkdir('both')
+    subpackage.join('__init__.py').ensure()
+    subpackage.join('setup_package.cfg').write(dedent("""\
+        [extension:_declared_.both.first]
+        sources = first.c
+    """))
+    subpackage.join('setup_package.py').write(dedent("""\
+        from distutils.core import Extension
+
+        def get_extensions():
+            return [Extension('_declared_.both.second', ['second.c'])]
+    """))
+
+    with test_pkg.as_cwd():
+        try:
+            register_commands()
+            package_info = get_package_info()
+        finally:
+            cleanup_import('_declared_')
+
+    extensions = dict((ext.name, ext) for ext in package_info['ext_modules'])
+
+    fast = extensions['_declared_._fast']
+    assert fast.sources == [os.path.join('_declared_', 'src', 'a.c'),
+                            os.path.join('_declared_', 'src', 'b.c')]
+    assert fast.include_dirs == ['numpy', os.path.join('_declared_', 'src')]
+    assert fast.define_macros == [('NDEBUG', None), ('HAVE_FAST', '1')]
+    assert fast.extra_compile_args == ['-O3']
+    assert fast.optional is True
+
+    names = [ext.name for ext in package_info['ext_modules']]
+    assert names.index('_declared_.both.first') + 1 == names.index(
+        '_declared_.both.second')
+    assert extensions['_declared_.both.first'].sources == [
+        os.path.join('_declared_', 'both', 'first.c')]
+
+    assert package_info['package_data']['_declared_'] == ['data/*.txt']
+
+    package.join('setup_package.cfg').write(dedent("""\
+        [extension:._fast]
+        source = src/*.c
+    """))
+
+    with test_pkg.as_cwd():
+        try:
+            with pytest.raises(DistutilsSetupError) as exc:
+                get_package_info()
+        finally:
+            cleanup_import('_declared_')
+
+    assert "unknown option 'source'" in str(exc.value)
 
 
 def test_invalid_package_exclusion(tmpdir, capsys):
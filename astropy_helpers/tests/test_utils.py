@@ -1,5 +1,9 @@
 import os
-from ..utils import find_data_files
+import sys
+
+from .. import utils
+from ..utils import (find_data_files, get_cpu_count, get_numpy_include_path,
+                     get_user_cache_dir)
 
 
 def test_find_data_files(tmpdir):
@@ -22,3 +26,68 @@ def test_find_data_files(tmpdir):
     assert filenames[1] == os.path.join('sub1', 'data.dat')
     assert filenames[2] == os.path.join('sub1', 'sub3', 'data.dat')
     assert filenames[3] == os.path.join('sub2', 'data.dat')
+
+
+def test_get_cpu_count_cgroup_quota(tmpdir, monkeypatch):
+
+    cpu_max = tmpdir.join('cpu.max')
+    monkeypatch.setattr(utils, '_CGROUP_CPU_MAX', cpu_max.strpath)
+
+    cpu_max.write('max 100000\n')
+    assert utils._get_cgroup_cpu_quota() is None
+
+    cpu_max.write('150000 100000\n')
+    assert utils._get_cgroup_cpu_quota() == 2
+
+    cpu_max.write('50000 100000\n')
+    assert utils._get_cgroup_cpu_quota() == 1
+
+    assert 1 <= get_cpu_count() <= 2
+
+
+def test_get_cpu_count_cgroup_v1_quota(tmpdir, monkeypatch):
+
+    quota = tmpdir.join('cpu.cfs_quota_us')
+    period = tmpdir.join('cpu.cfs_period_us')
+    monkeypatch.setattr(utils, '_CGROUP_CPU_MAX', tmpdir.join('missing').strpath)
+    monkeypatch.setattr(utils, '_CGROUP_CFS_QUOTA', quota.strpath)
+    monkeypatch.setattr(utils, '_CGROUP_CFS_PERIOD', period.strpath)
+
+    quota.write('-1\n')
+    period.write('100000\n')
+    assert utils._get_cgroup_cpu_quota() is None
+
+    quota.write('400000\n')
+    assert utils._get_cgroup_cpu_quota() == 4
+
+
+def test_get_user_cache_dir(tmpdir, monkeypatch):
+
+    monkeypatch.setenv('ASTROPY_HELPERS_CACHE_DIR', tmpdir.join('cache').strpath)
+    cache_dir = get_user_cache_dir('objects')
+    assert cache_dir == tmpdir.join('cache', 'objects').strpath
+    assert os.path.isdir(cache_dir)
+
+    monkeypatch.delenv('ASTROPY_HELPERS_CACHE_DIR')
+    monkeypatch.setenv('XDG_CACHE_HOME', tmpdir.join('xdg').strpath)
+    monkeypatch.setattr(utils.sys, 'platform', 'linux')
+    assert get_user_cache_dir() == tmpdir.join('xdg', 'astropy-helpers').strpath
+
+
+def test_get_numpy_include_path(tmpdir, monkeypatch):
+
+    # A fake numpy package with the layout of Numpy 2.x, which should be
+    # found without being imported
+    numpy_dir = tmpdir.mkdir('numpy')
+    numpy_dir.join('__init__.py').write('raise ImportError("imported")\n')
+    include_dir = numpy_dir.mkdir('_core').mkdir('include')
+    include_dir.mkdir('numpy').join('arrayobject.h').write('')
+
+    monkeypatch.syspath_prepend(tmpdir.strpath)
+    monkeypatch.delitem(sys.modules, 'numpy', raising=False)
+    monkeypatch.setattr(utils, '_numpy_include_cache', {})
+
+    assert get_numpy_include_path() == include_dir.strpath
+    assert 'numpy' not in sys.modules
+    assert utils._numpy_include_cache == {numpy_dir.strpath:
+                                          include_dir.strpath}
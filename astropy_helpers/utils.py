@@ -2,9 +2,11 @@
 
 import contextlib
 import imp
+import math
 import os
 import sys
 import glob
+import threading
 
 from importlib import machinery as import_machinery
 
@@ -42,10 +44,60 @@ def _get_platlib_dir(cmd):
     return os.path.join(cmd.build_base, 'lib' + plat_specifier)
 
 
+# The Numpy include directory found by get_numpy_include_path, along with the
+# Numpy package directory it was found in
+_numpy_include_cache = {}
+
+# The locations of the headers relative to the Numpy package, for Numpy 2.x
+# and 1.x respectively
+_NUMPY_INCLUDE_DIRS = [os.path.join('_core', 'include'),
+                       os.path.join('core', 'include')]
+
+
+def _find_numpy_include_path():
+    """
+    Returns the path to the numpy headers found from the layout of the
+    installed numpy package, without importing numpy, or `None` if numpy is
+    not installed or its layout is not recognized.
+    """
+
+    import importlib.util
+
+    try:
+        spec = importlib.util.find_spec('numpy')
+    except (ImportError, ValueError):
+        return None
+
+    if spec is None or not spec.submodule_search_locations:
+        return None
+
+    for package_dir in spec.submodule_search_locations:
+        cached = _numpy_include_cache.get(package_dir)
+        if cached is not None and os.path.isdir(cached):
+            return cached
+        for include_dir in _NUMPY_INCLUDE_DIRS:
+            include_dir = os.path.join(package_dir, include_dir)
+            if os.path.isfile(os.path.join(include_dir, 'numpy',
+                                           'arrayobject.h')):
+                _numpy_include_cache[package_dir] = include_dir
+                return include_dir
+
+    return None
+
+
 def get_numpy_include_path():
     """
     Gets the path to the numpy headers.
+
+    The path is found from the layout of the installed numpy package if
+    possible (and cached), so that numpy does not need to be imported. Numpy
+    is only imported if this fails.
     """
+
+    numpy_include = _find_numpy_include_path()
+    if numpy_include is not None:
+        return numpy_include
+
     # We need to go through this nonsense in case setuptools
     # downloaded and installed Numpy for us as part of the build or
     # install, since Numpy may still think it's in "setup mode", when
@@ -65,6 +117,100 @@ def get_numpy_include_path():
     return numpy_include
 
 
+# The files from which the CPU quota imposed through cgroups (v2 and v1
+# respectively) can be read - these are typically set inside containers.
+_CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP_CFS_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+_CGROUP_CFS_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+
+def _get_cgroup_cpu_quota():
+    """
+    Returns the number of CPUs allowed by the cgroup CPU quota of the current
+    process, or `None` if no quota is set (or cgroups are not available).
+    """
+
+    try:
+        with open(_CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        pass
+    else:
+        if quota == 'max':
+            return None
+        try:
+            return max(1, math.ceil(int(quota) / int(period)))
+        except (ValueError, ZeroDivisionError):
+            return None
+
+    try:
+        with open(_CGROUP_CFS_QUOTA) as f:
+            quota = int(f.read())
+        with open(_CGROUP_CFS_PERIOD) as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if quota > 0 and period > 0:
+        return max(1, math.ceil(quota / period))
+
+    return None
+
+
+def get_cpu_count():
+    """
+    Returns the number of CPUs that the current process can actually use.
+
+    Unlike `os.cpu_count`, this takes into account the CPU affinity of the
+    process as well as any CPU quota set through cgroups, which is how the
+    number of CPUs is usually limited inside containers.
+    """
+
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+
+    quota = _get_cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, quota)
+
+    return max(count, 1)
+
+
+def get_user_cache_dir(*subdirs):
+    """
+    Returns the path to a directory in which astropy-helpers can cache files
+    between builds of any package (for all virtual environments of the current
+    user), creating it if it does not exist.
+
+    This is ``$ASTROPY_HELPERS_CACHE_DIR`` if set, and otherwise an
+    ``astropy-helpers`` directory in the platform's user cache directory (e.g.
+    ``~/.cache`` or ``$XDG_CACHE_HOME`` on Linux). Any ``subdirs`` are
+    appended to the path.
+    """
+
+    cache_dir = os.environ.get('ASTROPY_HELPERS_CACHE_DIR')
+
+    if not cache_dir:
+        if sys.platform.startswith('win'):
+            base_dir = (os.environ.get('LOCALAPPDATA') or
+                        os.path.join(os.path.expanduser('~'), 'AppData',
+                                     'Local'))
+        elif sys.platform == 'darwin':
+            base_dir = os.path.join(os.path.expanduser('~'), 'Library',
+                                    'Caches')
+        else:
+            base_dir = (os.environ.get('XDG_CACHE_HOME') or
+                        os.path.join(os.path.expanduser('~'), '.cache'))
+        cache_dir = os.path.join(base_dir, 'astropy-helpers')
+
+    cache_dir = os.path.join(cache_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
 class _DummyFile(object):
     """A noop writeable object."""
 
@@ -77,10 +223,83 @@ class _DummyFile(object):
         pass
 
 
+class _ThreadStream(object):
+    """
+    A writeable object which passes everything on to ``stream``, unless the
+    current thread redirected it to another stream with `capture_output`.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @property
+    def _target(self):
+        return getattr(self._local, 'target', self._stream)
+
+    def write(self, s):
+        return self._target.write(s)
+
+    def flush(self):
+        self._target.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._target, attr)
+
+
+@contextlib.contextmanager
+def thread_streams():
+    """
+    A context manager that replaces sys.stdout and sys.stderr with streams
+    which can be redirected for the current thread only, with
+    `capture_output`. Inside this context, `silence` only silences the
+    thread calling it.
+    """
+
+    old_stdout = sys.stdout
+    old_stderr = sys.stderr
+    sys.stdout = _ThreadStream(old_stdout)
+    sys.stderr = _ThreadStream(old_stderr)
+    try:
+        yield
+    finally:
+        sys.stdout = old_stdout
+        sys.stderr = old_stderr
+
+
+@contextlib.contextmanager
+def capture_output(stdout, stderr):
+    """
+    A context manager that redirects what the current thread writes to
+    sys.stdout and sys.stderr to the ``stdout`` and ``stderr`` files. This
+    can only be used inside a `thread_streams` block.
+    """
+
+    streams = (sys.stdout, sys.stderr)
+    previous = [getattr(stream._local, 'target', None) for stream in streams]
+    for stream, target in zip(streams, (stdout, stderr)):
+        stream._local.target = target
+    try:
+        yield
+    finally:
+        for stream, target in zip(streams, previous):
+            if target is None:
+                del stream._local.target
+            else:
+                stream._local.target = target
+
+
 @contextlib.contextmanager
 def silence():
     """A context manager that silences sys.stdout and sys.stderr."""
 
+    if (isinstance(sys.stdout, _ThreadStream) and
+            isinstance(sys.stderr, _ThreadStream)):
+        # Other threads should not be silenced
+        with capture_output(_DummyFile(), _DummyFile()):
+            yield
+        return
+
     old_stdout = sys.stdout
     old_stderr = sys.stderr
     sys.stdout = _DummyFile()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Times ``setup.py --version`` and ``setup.py egg_info`` on a generated package
+with many subpackages, with and without the metadata fast path of
+`astropy_helpers.setup_helpers.setup`.
+
+The package is written to a temporary directory, with two setup scripts:
+``setup_fast.py`` calls `~astropy_helpers.setup_helpers.setup`, which skips
+the custom commands and the ``setup_package.py`` modules for these commands,
+and ``setup_full.py`` always registers the commands and calls
+`~astropy_helpers.setup_helpers.get_package_info`, as ``setup()`` did before
+the fast path. Each ``setup_package.py`` module defines a C extension and the
+packages contain ``.pyx`` files, and ``--import-delay`` can be used to model
+``setup_package.py`` modules with expensive imports. Run with::
+
+    python benchmarks/bench_metadata_fast_path.py --packages 200 --repeat 5
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from textwrap import dedent
+
+ASTROPY_HELPERS_PATH = os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))
+
+PACKAGE_NAME = 'benchpkg'
+
+SETUP_FAST = """\
+import sys
+sys.path.insert(0, {path!r})
+from astropy_helpers.setup_helpers import setup
+setup()
+"""
+
+SETUP_FULL = """\
+import sys
+sys.path.insert(0, {path!r})
+import builtins
+from setuptools import setup
+from astropy_helpers.setup_helpers import (register_commands,
+                                           generate_version_py,
+                                           get_package_info)
+builtins._ASTROPY_PACKAGE_NAME_ = {name!r}
+cmdclass = register_commands()
+version = generate_version_py()
+package_info = get_package_info()
+package_info['cmdclass'] = cmdclass
+package_info['version'] = version
+setup(**package_info)
+"""
+
+SETUP_PACKAGE = """\
+import os
+import time
+from distutils.core import Extension
+
+time.sleep({delay!r})
+
+
+def get_extensions():
+    here = os.path.relpath(os.path.dirname(__file__))
+    return [Extension({name!r} + '._ext', [os.path.join(here, 'ext.c')])]
+
+
+def get_package_data():
+    return {{{name!r}: ['data/*.dat']}}
+"""
+
+
+def make_package(root, packages, delay):
+    """
+    Writes a package with ``packages`` subpackages to ``root``.
+    """
+
+    with open(os.path.join(root, 'setup.cfg'), 'w') as f:
+        f.write(dedent("""\
+            [metadata]
+            name = {0}
+            version = 0.1
+        """.format(PACKAGE_NAME)))
+
+    for filename, template in (('setup_fast.py', SETUP_FAST),
+                               ('setup_full.py', SETUP_FULL)):
+        with open(os.path.join(root, filename), 'w') as f:
+            f.write(template.format(path=ASTROPY_HELPERS_PATH,
+                                    name=PACKAGE_NAME))
+
+    os.mkdir(os.path.join(root, PACKAGE_NAME))
+    open(os.path.join(root, PACKAGE_NAME, '__init__.py'), 'w').close()
+
+    for idx in range(packages):
+        name = '{0}.sub{1:04d}'.format(PACKAGE_NAME, idx)
+        subdir = os.path.join(root, *name.split('.'))
+        os.makedirs(os.path.join(subdir, 'data'))
+        open(os.path.join(subdir, '__init__.py'), 'w').close()
+        with open(os.path.join(subdir, 'setup_package.py'), 'w') as f:
+            f.write(SETUP_PACKAGE.format(name=name, delay=delay))
+        with open(os.path.join(subdir, 'ext.c'), 'w') as f:
+            f.write('int answer(void) { return 42; }\n')
+        with open(os.path.join(subdir, 'fast.pyx'), 'w') as f:
+            f.write('def answer():\n    return 42\n')
+
+
+def time_command(root, script, args, repeat):
+    """
+    Returns the best of ``repeat`` wall times of ``script`` with ``args``.
+    """
+
+    times = []
+    for _ in range(repeat):
+        egg_info = os.path.join(root, PACKAGE_NAME + '.egg-info')
+        if os.path.exists(egg_info):
+            shutil.rmtree(egg_info)
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, script] + args, cwd=root,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--packages', type=int, default=100,
+                        help='number of subpackages (default: 100)')
+    parser.add_argument('--import-delay', type=float, default=0.,
+                        help='time spent importing each setup_package.py '
+                             'module, in seconds (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each command, of which the '
+                             'best is shown (default: 3)')
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='bench_metadata_')
+    try:
+        make_package(root, args.packages, args.import_delay)
+
+        print('{0} subpackages, best of {1} runs'.format(args.packages,
+                                                         args.repeat))
+        print('{0:<12} {1:>10} {2:>10} {3:>8}'.format(
+            'command', 'full (s)', 'fast (s)', 'speedup'))
+        for command in (['--version'], ['egg_info']):
+            full = time_command(root, 'setup_full.py', command, args.repeat)
+            fast = time_command(root, 'setup_fast.py', command, args.repeat)
+            print('{0:<12} {1:>10.3f} {2:>10.3f} {3:>7.1f}x'.format(
+                ' '.join(command), full, fast, full / fast))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()